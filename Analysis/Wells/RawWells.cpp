@@ -1506,7 +1506,7 @@ void RawWells::ReadWells()
         hsize_t offset_out[3];  /* hyperslab offset in memory */
         offset[0] = currentRowStart;
         offset[1] = currentColStart;
-        offset[2] = 0;
+        offset[2] = mChunk.flowStart;
         count[0] = currentRowEnd - currentRowStart;
         count[1] = currentColEnd - currentColStart;
         count[2] = mChunk.flowDepth;
@@ -1592,7 +1592,7 @@ void RawWells::ReadWells()
             {
               for ( size_t flow = mChunk.flowStart; flow < mChunk.flowStart + mChunk.flowDepth; flow++ )
               {
-				float val = inputBuffer[localCount * mChunk.flowDepth + flow];
+				float val = inputBuffer[localCount * mChunk.flowDepth + flow - mChunk.flowStart];
 				if(mSaveAsUShort && mConvertWithCopies)
 				{
 					if(mWellsCopies2[ row * mCols + col] > 0)
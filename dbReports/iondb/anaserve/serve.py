@@ -39,6 +39,7 @@ blocked), the job server will raise an exception and terminate.
 This module requires Twisted's XMLRPC server. On Ubuntu, this can be installed
 with ``sudo apt-get install python-twisted``.
 """
+import collections
 import datetime
 import json
 import simplejson
@@ -201,6 +202,14 @@ def have_drmaa(host):
     return HAVE_DRMAA
 
 
+def _elapsed(start, end=None):
+    """Return time elapsed since 'start' as a string of whole seconds."""
+    if start is None:
+        return "0s"
+    diff = (end or datetime.datetime.now()) - start
+    return "%ds" % (diff.days * 24 * 3600 + diff.seconds)
+
+
 class Analysis(object):
     """``Analysis`` objects capture the properties of a single running
     analysis job. While ``Analysis`` is an abstract base class,
@@ -242,6 +251,34 @@ class Analysis(object):
                 assert isinstance(ele, (str, unicode))
         self.files = files
         self.job_type = job_type
+        # parameters are parsed once, the queue sorts on user and priority
+        params = self._parsed_params()
+        self.user = params.get('username', '') or ''
+        self.priority = self._priority(params)
+        self.queued_at = None
+        self.started_at = None
+
+    def _parsed_params(self):
+        """Returns the analysis parameters as a dictionary, they may be
+        passed in either as a dictionary or as JSON text."""
+        params = self.params
+        if not isinstance(params, dict):
+            try:
+                params = json.loads(params)
+            except (TypeError, ValueError):
+                return {}
+        if not isinstance(params, dict):
+            return {}
+        return params
+
+    def _priority(self, params):
+        """Return the priority class of the analysis, lower classes are
+        started first. Thumbnail analyses come before full chip analyses,
+        and within each, automatic analyses come before manual reanalyses
+        and other user requested jobs."""
+        thumbnail = self.job_type == 'thumbnail'
+        manual = (self.job_type not in ('', 'thumbnail')) or bool(params.get('reanalysis', False))
+        return (0 if thumbnail else 2) + (1 if manual else 0)
 
     def get_id(self):
         """Returns the running job's ID number given by the underlying
@@ -575,13 +612,13 @@ class AnalysisQueue(object):
        acquires a lock and calls
        the analysis object's ``conclude()`` method to clean up.
 
-    The reason for acquiring a lock is to allow the ``AnalysisQueue`` to keep
-    track of which analyses are running, and to make it easier to implement
-    queuing in the future. For example, it would be straightforward to
-    have the ``AnalysisQueue``'s main thread wait until there are less than
-    N analyses running before initiating another.
+    The lock also lets the main thread wait until there are less than
+    ``max_running`` analyses in progress before initiating another. Waiting
+    analyses are started by priority class (see ``Analysis.priority``),
+    then by the fewest analyses in progress for the same user, then in
+    order of arrival.
     """
-    def __init__(self, rootdir):
+    def __init__(self, rootdir, max_running=None):
         if rootdir.startswith("../"):
             rootdir = path.join(os.getcwd(), rootdir)
         self.cv = threading.Condition()
@@ -589,48 +626,88 @@ class AnalysisQueue(object):
         self.q = []
         self.monitors = []
         self.running = {}
+        self.active = {}
         self.rootdir = rootdir
         self.start_time = None
+        if max_running is None:
+            max_running = getattr(settings, 'JOBSERVER_MAX_RUNNING', 0)
+        self.max_running = max_running
 
     def is_running(self, pk):
         """Determine if an analysis identified by ``pk`` is in progress."""
         return pk in self.running
 
+    def is_queued(self, pk):
+        """Determine if an analysis identified by ``pk`` is waiting to start."""
+        return any(a.pk == pk for a in self.q)
+
     def run_analysis(self, a):
-        """Spawn a thread which attempts to start an analysis."""
+        """Spawn a thread which attempts to start an analysis.
+        The analysis must already be registered in ``self.active``."""
         def go():
-            # acquire a lock while initiating
-            self.cv.acquire()
             try:
-                waiter = a.initiate(self.rootdir)
+                # acquire a lock while initiating
+                self.cv.acquire()
+                try:
+                    waiter = a.initiate(self.rootdir)
+                finally:
+                    self.cv.release()
+                if waiter is not None:
+                    # analysis was successfully initiated
+                    logger.info("%s successfully started" % str(a.name))
+                    assert a.pk not in self.running
+                    self.running[a.pk] = a
+                    # wait for analysis to conclude
+                    comm_result = waiter.communicate()
+                    # acquire lock before terminating
+                    self.cv.acquire()
+                    try:
+                        a.conclude(comm_result)
+                    finally:
+                        if a.pk in self.running:
+                            del self.running[a.pk]
+                        self.cv.release()
+                    logger.info("%s completed, run time %s" % (str(a.name), _elapsed(a.started_at)))
+                else:
+                    # bail, initiation failed
+                    logger.error("%s failed to start" % str(a.name))
             finally:
-                self.cv.release()
-            if waiter is not None:
-                # analysis was successfully initiated
-                logger.info("%s successfully started" % str(a.name))
-                assert a.pk not in self.running
-                self.running[a.pk] = a
-                # wait for analysis to conclude
-                comm_result = waiter.communicate()
-                # acquire lock before terminating
+                # free the slot and let the main loop start the next analysis
                 self.cv.acquire()
                 try:
-                    a.conclude(comm_result)
+                    self.active.pop(a.pk, None)
+                    if threading.current_thread() in self.monitors:
+                        self.monitors.remove(threading.current_thread())
+                    self.cv.notify()
                 finally:
-                    if a.pk in self.running:
-                        del self.running[a.pk]
                     self.cv.release()
-                logger.info("%s completed" % str(a.name))
-            else:
-                # bail, initiation failed
-                logger.error("%s failed to start" % str(a.name))
-                return
         tr = threading.Thread(target=go)
         tr.setDaemon(True)
-        self.monitors.append(tr)
+        self.cv.acquire()
+        try:
+            self.monitors.append(tr)
+        finally:
+            self.cv.release()
         tr.start()
         return tr
 
+    def _can_start(self):
+        """Return ``True`` if another analysis may be started. Call with
+        the lock held."""
+        return len(self.q) > 0 and (self.max_running <= 0 or len(self.active) < self.max_running)
+
+    def _pop_next(self):
+        """Remove and return the waiting analysis to start next. Call with
+        the lock held."""
+        per_user = {}
+        for a in self.active.values():
+            per_user[a.user] = per_user.get(a.user, 0) + 1
+        # self.q is in order of arrival, so min() keeps the oldest on ties
+        index, a = min(enumerate(self.q),
+                       key=lambda item: (item[1].priority, per_user.get(item[1].user, 0), item[0]))
+        del self.q[index]
+        return a
+
     def loop(self):
         """Remove un-initiated analyses from the analysis queue, and
         run them."""
@@ -639,13 +716,19 @@ class AnalysisQueue(object):
         def _loop():
             while not self.exit_event.isSet():
                 self.cv.acquire()
-                while len(self.q) == 0:
-                    self.cv.wait()
-                    if self.exit_event.is_set():
-                        logger.info("Main loop exiting")
-                        return  # leave loop if we're done
-                a = self.q.pop(0)
-                self.cv.release()
+                try:
+                    while not self._can_start():
+                        self.cv.wait()
+                        if self.exit_event.is_set():
+                            logger.info("Main loop exiting")
+                            return  # leave loop if we're done
+                    a = self._pop_next()
+                    a.started_at = datetime.datetime.now()
+                    self.active[a.pk] = a
+                    logger.info("Starting analysis %s, waited %s, %d queued, %d running" % (
+                        a.name, _elapsed(a.queued_at, a.started_at), len(self.q), len(self.active)))
+                finally:
+                    self.cv.release()
                 self.run_analysis(a)
         tr = threading.Thread(target=_loop)
         tr.setDaemon(True)
@@ -655,23 +738,48 @@ class AnalysisQueue(object):
     def add_analysis(self, a):
         """Add an analysis to the queue."""
         self.cv.acquire()
+        a.queued_at = datetime.datetime.now()
         self.q.append(a)
         self.cv.notify()
         self.cv.release()
-        logger.info("Added analysis %s" % a.name)
+        logger.info("Added analysis %s, priority %d, user '%s'" % (a.name, a.priority, a.user))
 
     def stop(self):
         """Terminate the main loop."""
         self.exit_event.set()
+        self.cv.acquire()
         self.cv.notify()
+        self.cv.release()
+
+    def queue_position(self, pk):
+        """Return the 1-based position in which the waiting analysis
+        identified by ``pk`` would be started, or ``None``. Call with
+        the lock held."""
+        per_user = {}
+        for a in self.active.values():
+            per_user[a.user] = per_user.get(a.user, 0) + 1
+        order = sorted(enumerate(self.q),
+                       key=lambda item: (item[1].priority, per_user.get(item[1].user, 0), item[0]))
+        for position, (index, a) in enumerate(order):
+            if a.pk == pk:
+                return position + 1
+        return None
 
     def status(self, save_path, pk):
         """Determine the status of an analysis identified by 'pk' running
-        at 'save_path'."""
+        at 'save_path'. Waiting analyses report their place in the queue
+        and wait time, running analyses their run time."""
         self.cv.acquire()
         try:
             if pk in self.running:
-                ret = (True, self.running[pk].status_string())
+                a = self.running[pk]
+                ret = (True, "%s, run time %s" % (a.status_string(), _elapsed(a.started_at)))
+            elif pk in self.active:
+                ret = (True, "Starting")
+            elif self.is_queued(pk):
+                a = [a for a in self.q if a.pk == pk][0]
+                ret = (True, "Queued %d of %d, waiting %s" % (
+                    self.queue_position(pk), len(self.q), _elapsed(a.queued_at)))
             else:
                 fname = path.join(save_path, "status.txt")
                 if not path.exists(fname):
@@ -692,6 +800,14 @@ class AnalysisQueue(object):
         """Return a list of (pk,proxy) for all currently running jobs."""
         return self.running.items()
 
+    def queued_jobs(self):
+        """Return a list of (pk,proxy) for all jobs waiting to start."""
+        self.cv.acquire()
+        try:
+            return [(a.pk, a) for a in self.q]
+        finally:
+            self.cv.release()
+
     def n_jobs(self):
         """Return the number of jobs currently running."""
         return len(self.running)
@@ -712,7 +828,10 @@ class AnalysisQueue(object):
         """Terminate, suspend, or resume a job."""
         self.cv.acquire()
         try:
-            if not self.is_running(pk):
+            if self.is_queued(pk) and signal.lower() == "term":
+                self.q = [a for a in self.q if a.pk != pk]
+                ret = (True, "removed from queue")
+            elif not self.is_running(pk):
                 ret = (False, "not running")
             else:
                 a = self.running[pk]
@@ -743,6 +862,38 @@ class AnalysisServer(xmlrpc.XMLRPC):
     def __init__(self, analysis_queue):
         xmlrpc.XMLRPC.__init__(self)
         self.q = analysis_queue
+        # job ids of cluster jobs submitted for each result pk, oldest results are dropped
+        self.result_jobs = collections.OrderedDict()
+        self.max_results = getattr(settings, 'JOBSERVER_RESULT_JOBS_MAX', 500)
+
+    def _record_jobs(self, pk, jobids):
+        if pk is None or pk == "":
+            return
+        pk = str(pk)
+        jobs = self.result_jobs.pop(pk, [])
+        jobs.extend(jobid for jobid in jobids if jobid)
+        self.result_jobs[pk] = jobs
+        while len(self.result_jobs) > self.max_results:
+            self.result_jobs.popitem(last=False)
+
+    def _run_job(self, jt, template):
+        """Submit one job with the fields of the ``template`` dict set on
+        the DRMAA job template ``jt``"""
+        jt.nativeSpecification = template.get('nativeSpecification', '')
+        jt.remoteCommand = template['remoteCommand']
+        jt.workingDirectory = template['workingDirectory']
+        jt.outputPath = template['outputPath']
+        jt.errorPath = template['errorPath']
+        jt.args = template.get('args', [])
+        jt.joinFiles = template.get('joinFiles', False)
+        return _session.runJob(jt)
+
+    def _job_status(self, jobid):
+        try:
+            return _session.jobStatus(jobid)
+        except:
+            logger.error("Job Status failure for %s" % jobid)
+            return "DRMAA BUG"
 
     def xmlrpc_updatestatus(self,
                             primarykeyPath,
@@ -809,28 +960,61 @@ class AnalysisServer(xmlrpc.XMLRPC):
 
     def xmlrpc_submitjob(self, jt_nativeSpecification, jt_remoteCommand,
                          jt_workingDirectory, jt_outputPath,
-                         jt_errorPath, jt_args, jt_joinFiles):
+                         jt_errorPath, jt_args, jt_joinFiles, pk=None):
         jt = _session.createJobTemplate()
-        jt.nativeSpecification = jt_nativeSpecification
-        jt.remoteCommand = jt_remoteCommand
-        jt.workingDirectory = jt_workingDirectory
-        jt.outputPath = jt_outputPath
-        jt.errorPath = jt_errorPath
-        jt.args = jt_args
-        jt.joinFiles = jt_joinFiles
-        jobid = _session.runJob(jt)
-        _session.deleteJobTemplate(jt)
+        try:
+            jobid = self._run_job(jt, {
+                'nativeSpecification': jt_nativeSpecification,
+                'remoteCommand': jt_remoteCommand,
+                'workingDirectory': jt_workingDirectory,
+                'outputPath': jt_outputPath,
+                'errorPath': jt_errorPath,
+                'args': jt_args,
+                'joinFiles': jt_joinFiles,
+            })
+        finally:
+            _session.deleteJobTemplate(jt)
+        self._record_jobs(pk, [jobid])
         return jobid
 
+    def xmlrpc_submitjob_many(self, templates, pk=None):
+        """Submit a job for each dict in ``templates``, with the keys
+        nativeSpecification, remoteCommand, workingDirectory, outputPath,
+        errorPath, args and joinFiles. One DRMAA job template is reused for
+        all jobs. Returns the list of job ids, an empty string for each job
+        which could not be submitted."""
+        logger.debug("xmlrpc submitjob for %d jobs" % len(templates))
+        jobids = []
+        jt = _session.createJobTemplate()
+        try:
+            for template in templates:
+                try:
+                    jobids.append(self._run_job(jt, template))
+                except:
+                    logger.error("Job submission failure for %s" % template.get('args'))
+                    logger.error(traceback.format_exc())
+                    jobids.append("")
+        finally:
+            _session.deleteJobTemplate(jt)
+        self._record_jobs(pk, jobids)
+        return jobids
+
     def xmlrpc_jobstatus(self, jobid):
         """Get the status of the job"""
-        try:
-            logger.debug("xmlrpc jobstatus for %s" % jobid)
-            status = _session.jobStatus(jobid)
-        except:
-            logger.error("Job Status failure for %s" % jobid)
-            status = "DRMAA BUG"
-        return status
+        logger.debug("xmlrpc jobstatus for %s" % jobid)
+        return self._job_status(jobid)
+
+    def xmlrpc_jobstatus_many(self, jobids):
+        """Get the status of each of the jobs in one call, returns a dict
+        of job id to status"""
+        logger.debug("xmlrpc jobstatus for %d jobs" % len(jobids))
+        return dict((str(jobid), self._job_status(jobid)) for jobid in jobids)
+
+    def xmlrpc_result_jobs(self, pk):
+        """Get the status of all cluster jobs submitted for the result
+        ``pk``, returns a dict of job id to status"""
+        jobids = self.result_jobs.get(str(pk), [])
+        return dict((str(jobid), self._job_status(jobid)) for jobid in jobids)
 
     def xmlrpc_startanalysis(self, name, script, parameters, files, savePath, pk, chipType, chips, job_type):
         """Add an analysis to the ``AnalysisQueue``'s queue of waiting
@@ -857,12 +1041,15 @@ class AnalysisServer(xmlrpc.XMLRPC):
         return self.q.uptime()
 
     def xmlrpc_running(self):
-        """Return status information about all jobs currently running."""
+        """Return status information about all jobs currently running,
+        followed by the jobs waiting to start."""
         items = self.q.all_jobs()
         ret = []
         for pk, a in items:
             ret.append((a.name, a.get_id(), a.pk, a.ANALYSIS_TYPE, a.status_string()))
             logger.debug("Name:%s JobId:%s PK:%s State:'%s'" % (a.name, a.get_id(), a.pk, a.status_string()))
+        for pk, a in self.q.queued_jobs():
+            ret.append((a.name, "", a.pk, a.ANALYSIS_TYPE, "queued, waiting %s" % _elapsed(a.queued_at)))
         return ret
 
     def xmlrpc_control_job(self, pk, signal):
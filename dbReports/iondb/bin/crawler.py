@@ -21,6 +21,13 @@ Throughout the loop, the crawler generates logging information as well as
 status information that can be accessed over XMLRPC. The ``Status`` class
 provides the XMLRPC access.
 
+With ``--incremental`` the crawler keeps an in-memory ``CrawlIndex`` of
+experiment folders and their FTP status, loaded with one bulk query, and a
+``CrawlWatcher`` uses inotify to wake the loop as soon as something changes
+in a Rig folder or an in-progress run folder. Only those folders are crawled;
+the full folder listing is still repeated every ``CRAWLER_PERIOD`` seconds as
+a fallback for missed events and filesystems without inotify support.
+
 This module uses the Twisted XMLRPC server, which on Ubuntu can be installed
 with ``sudo apt-get install python-twisted``.
 """
@@ -53,6 +60,12 @@ try:
     GITHASH = version.IonVersionGetGitHash()
 except:
     GITHASH = ""
+try:
+    from twisted.internet import inotify
+    from twisted.python import filepath
+    HAVE_INOTIFY = True
+except ImportError:
+    HAVE_INOTIFY = False
 
 LOG_BASENAME = "explog.txt"
 LOG_FINAL_BASENAME = "explog_final.txt"
@@ -63,9 +76,13 @@ RUN_STATUS_COMPLETE = "Complete"
 RUN_STATUS_MISSING = "Missing File(s)"
 RUN_STATUS_ABORT = "User Aborted"
 RUN_STATUS_SYS_CRIT = "Lost Chip Connection"
+RUN_STATUS_FINISHED = (RUN_STATUS_COMPLETE, RUN_STATUS_ABORT, RUN_STATUS_MISSING, RUN_STATUS_SYS_CRIT)
 
 DO_THUMBNAIL = True
 
+# seconds to let a burst of filesystem events settle before crawling
+EVENT_SETTLE_TIME = 0.2
+
 
 class CrawlLog(object):
 
@@ -208,6 +225,154 @@ class Status(xmlrpc.XMLRPC):
         return sorted(ret, key=lambda l: l[0], reverse=True)
 
 
+class CrawlIndex(object):
+
+    """In-memory index of experiment folders, keyed by expDir.
+    Holds the FTP status of every experiment, loaded with a single bulk
+    query and kept up to date by ``crawl``, and the acq file names seen in
+    watched run folders so file counts don't need a glob every pass."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ftp_status = {}
+        self.acq_files = {}
+
+    def load(self):
+        """Reload the FTP status of all experiments from the database."""
+        ftp_status = dict(models.Experiment.objects.values_list('expDir', 'ftpStatus'))
+        with self.lock:
+            self.ftp_status = ftp_status
+
+    def update(self, expDir, ftpStatus):
+        with self.lock:
+            self.ftp_status[expDir] = ftpStatus
+
+    def is_finished(self, expDir):
+        """Return True if the run in ``expDir`` needs no more crawling."""
+        with self.lock:
+            return self.ftp_status.get(expDir) in RUN_STATUS_FINISHED
+
+    def track_acq(self, acq_dir):
+        """Start counting acq files in ``acq_dir``."""
+        names = set(os.path.basename(f) for f in glob.glob(os.path.join(acq_dir, "acq*.dat")))
+        with self.lock:
+            self.acq_files.setdefault(acq_dir, set()).update(names)
+
+    def untrack_acq(self, acq_dir):
+        with self.lock:
+            self.acq_files.pop(acq_dir, None)
+
+    def add_acq(self, acq_dir, name):
+        with self.lock:
+            if acq_dir in self.acq_files:
+                self.acq_files[acq_dir].add(name)
+
+    def get_acq_count(self, acq_dir):
+        """Return the number of acq files in ``acq_dir``, or None if the
+        folder is not tracked."""
+        with self.lock:
+            names = self.acq_files.get(acq_dir)
+            return len(names) if names is not None else None
+
+
+class CrawlWatcher(object):
+
+    """Watches Rig folders and in-progress run folders with inotify and
+    collects the run folders that changed. All watch management happens in
+    the reactor thread; the crawl thread calls ``wait`` and ``pop_changed``."""
+
+    RUN_MASK = inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE if HAVE_INOTIFY else 0
+    RIG_MASK = inotify.IN_CREATE | inotify.IN_MOVED_TO if HAVE_INOTIFY else 0
+
+    def __init__(self, logger, index):
+        self.logger = logger
+        self.index = index
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.event = threading.Event()
+        self.rigs = set()
+        self.runs = set()
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+
+    def _watch(self, path, mask, callback):
+        try:
+            self.notifier.watch(filepath.FilePath(path), mask=mask, callbacks=[callback])
+            return True
+        except:
+            self.logger.errors.warn("Unable to watch %s: %s" % (path, sys.exc_info()[1]))
+            return False
+
+    def _ignore(self, path):
+        try:
+            self.notifier.ignore(filepath.FilePath(path))
+        except KeyError:
+            pass
+
+    def sync(self, rig_folders, run_folders):
+        """Watch any new Rig and in-progress run folders."""
+        for rig_folder in rig_folders:
+            if rig_folder not in self.rigs and self._watch(rig_folder, self.RIG_MASK, self._rig_event):
+                self.rigs.add(rig_folder)
+        for folder in run_folders:
+            self.watch_run(folder)
+
+    def watch_run(self, folder):
+        if folder in self.runs:
+            return
+        if self._watch(folder, self.RUN_MASK, self._run_event):
+            self.runs.add(folder)
+            self.index.track_acq(folder)
+            thumbnail = os.path.join(folder, 'thumbnail')
+            if os.path.isdir(thumbnail) and self._watch(thumbnail, self.RUN_MASK, self._run_event):
+                self.index.track_acq(thumbnail)
+
+    def unwatch_runs(self, folders):
+        """Stop watching runs that finished transferring."""
+        for folder in folders:
+            if folder in self.runs:
+                self.runs.discard(folder)
+                for path in (folder, os.path.join(folder, 'thumbnail')):
+                    self._ignore(path)
+                    self.index.untrack_acq(path)
+
+    def _rig_event(self, ignored, fpath, mask):
+        if mask & inotify.IN_ISDIR:
+            self.watch_run(fpath.path)
+            self.set_changed(fpath.path)
+
+    def _run_event(self, ignored, fpath, mask):
+        parent = fpath.parent().path
+        name = fpath.basename()
+        if os.path.basename(parent) == 'thumbnail':
+            folder = os.path.dirname(parent)
+        else:
+            folder = parent
+            if name == 'thumbnail' and mask & inotify.IN_ISDIR:
+                if self._watch(fpath.path, self.RUN_MASK, self._run_event):
+                    self.index.track_acq(fpath.path)
+        if name.startswith('acq') and name.endswith('.dat') and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            self.index.add_acq(parent, name)
+        self.set_changed(folder)
+
+    def set_changed(self, folder):
+        with self.lock:
+            self.changed.add(folder)
+        self.event.set()
+
+    def wait(self, timeout):
+        """Block until a watched folder changes or ``timeout`` expires."""
+        if self.event.wait(timeout):
+            time.sleep(EVENT_SETTLE_TIME)
+
+    def pop_changed(self):
+        """Return and clear the set of changed run folders."""
+        self.event.clear()
+        with self.lock:
+            ret, self.changed = self.changed, set()
+        return ret
+
+
 def extract_prefix(folder):
     """Given the name of a folder storing experiment data, return the
     name of the directory under which all PGMs at a given location
@@ -223,55 +388,69 @@ def tdelt2secs(td):
     return day_seconds + float(td.seconds) + ms_seconds
 
 
-def construct_crawl_directories(logger):
-    """Query the database and build a list of directories to crawl.
-    Returns an array.
-    For every Rig in the database, construct a filesystem path and
-    get all subdirectories in that path."""
-    def dbase_isComplete(name, explist):
-        '''
-        explist consists of tuples containing experiment name and ftpstatus
-        '''
-        for item in explist:
-            if name == item[0]:
-                if item[1] in [RUN_STATUS_COMPLETE, RUN_STATUS_ABORT, RUN_STATUS_MISSING, RUN_STATUS_SYS_CRIT]:
-                    return True
-        return False
-
-    fserves = models.FileServer.objects.all()
+def get_rig_folders(logger):
+    """Return a list of existing Rig folders, one for every Rig at every
+    FileServer location."""
     ret = []
-    for fs in fserves:
+    for fs in models.FileServer.objects.all():
         l = fs.location
         rigs = models.Rig.objects.filter(location=l)
-        if rigs.count() == 0:
+        if not rigs:
             logger.errors.info("No rigs at this location: %s" % l.name)
         for r in rigs:
             rig_folder = os.path.join(fs.filesPrefix, r.name)
             if os.path.exists(rig_folder):
-                logger.errors.debug("Checking %s" % rig_folder)
-                exp_val_list = models.Experiment.objects.filter(
-                    expDir__startswith=rig_folder).values_list('expDir', 'ftpStatus')
-                try:
-                    subdir_bases = os.listdir(rig_folder)
-                    # create array of paths for all directories in Rig's directory
-                    s1 = [os.path.join(rig_folder, subd) for subd in subdir_bases]
-                    s2 = [subd for subd in s1 if os.path.isdir(subd)]
-                    # create array of paths of not complete ftp transfer only
-                    s3 = [subd for subd in s2 if dbase_isComplete(subd, exp_val_list) is False]
-                    ret.extend(s3)
-                except:
-                    logger.errors.error(traceback.format_exc())
-                    logger.set_state('error')
+                ret.append(rig_folder)
     return ret
 
 
-def get_filecount(exp):
-    '''Return number of acq files'''
-    if 'tiled' in exp.rawdatastyle:
+def construct_crawl_directories(logger, index=None):
+    """Query the database and build a list of directories to crawl.
+    Returns an array.
+    For every Rig in the database, construct a filesystem path and
+    get all subdirectories in that path.
+    If a ``CrawlIndex`` is given it is used to skip finished runs instead
+    of querying the database for every Rig folder."""
+    ret = []
+    for rig_folder in get_rig_folders(logger):
+        logger.errors.debug("Checking %s" % rig_folder)
+        if index is None:
+            finished = set(expDir for expDir, ftpStatus in models.Experiment.objects.filter(
+                expDir__startswith=rig_folder).values_list('expDir', 'ftpStatus')
+                if ftpStatus in RUN_STATUS_FINISHED)
+            is_finished = lambda subd: subd in finished
+        else:
+            is_finished = index.is_finished
+        try:
+            subdir_bases = os.listdir(rig_folder)
+            # create array of paths for all directories in Rig's directory
+            s1 = [os.path.join(rig_folder, subd) for subd in subdir_bases]
+            s2 = [subd for subd in s1 if os.path.isdir(subd)]
+            # create array of paths of not complete ftp transfer only
+            s3 = [subd for subd in s2 if not is_finished(subd)]
+            ret.extend(s3)
+        except:
+            logger.errors.error(traceback.format_exc())
+            logger.set_state('error')
+    return ret
+
+
+def get_acq_dir(expDir, rawdatastyle):
+    '''Return the directory whose acq files determine ftp status'''
+    if 'tiled' in (rawdatastyle or ''):
         # N.B. Hack - we check ftp status of thumbnail data only
-        expDir = os.path.join(exp.expDir, 'thumbnail')
-    else:
-        expDir = exp.expDir
+        return os.path.join(expDir, 'thumbnail')
+    return expDir
+
+
+def get_filecount(exp, index=None):
+    '''Return number of acq files'''
+    expDir = get_acq_dir(exp.expDir, exp.rawdatastyle)
+
+    if index is not None:
+        file_count = index.get_acq_count(expDir)
+        if file_count is not None:
+            return file_count
 
     file_count = len(glob.glob(os.path.join(expDir, "acq*.dat")))
     return file_count
@@ -556,9 +735,10 @@ def reports_exist(exp):
     return composite, thumbnail
 
 
-def crawl(folders, logger):
+def crawl(folders, logger, index=None):
     """Crawl over ``folders``, reporting information to the ``CrawlLog``
-    ``logger``."""
+    ``logger``. If a ``CrawlIndex`` is given, acq file counts are taken from
+    it and it is updated with the new FTP status of every crawled folder."""
 
     def get_expobj(_folder):
         '''Returns Experiment object associated with given folder'''
@@ -596,7 +776,7 @@ def crawl(folders, logger):
     def update_expobj_ftptransfer(_expobj):
         '''Update Experiment object with in-transfer ftp status'''
         if _expobj.ftpStatus != RUN_STATUS_MISSING:
-            _expobj.ftpStatus = get_filecount(_expobj)
+            _expobj.ftpStatus = get_filecount(_expobj, index)
             _expobj.save()
             logger.errors.info("FTP status: Transferring")
         return
@@ -685,6 +865,9 @@ def crawl(folders, logger):
                 else:
                     logger.errors.info("auto-analysis start has been disabled")
 
+                if index is not None:
+                    index.update(folder, exp.ftpStatus)
+
         except:
             logger.errors.exception(traceback.format_exc())
 
@@ -713,6 +896,58 @@ def loop(logger, end_event, delay):
     sys.exit(0)
 
 
+def incremental_loop(logger, end_event, delay, index, watcher=None):
+    """Outer loop of the crawl thread in incremental mode.
+    Crawls only folders reported by the ``CrawlWatcher``, as soon as they
+    change, and rebuilds the folder list from the ``CrawlIndex`` every
+    ``delay`` seconds."""
+    logger.start()
+    last_poll = None
+    while not end_event.isSet():
+        connection.close()  # Close any db connection to force new one.
+        try:
+            logger.set_state('working')
+            now = datetime.datetime.now()
+            if last_poll is None or tdelt2secs(now - last_poll) >= delay:
+                last_poll = now
+                index.load()
+                rig_folders = get_rig_folders(logger)
+                folders = set(construct_crawl_directories(logger, index))
+                if watcher:
+                    reactor.callFromThread(watcher.sync, rig_folders, folders)
+            else:
+                folders = set()
+
+            if watcher:
+                folders.update(watcher.pop_changed())
+            folders = [f for f in folders if not index.is_finished(f)]
+            crawl(sorted(folders), logger, index)
+
+            if watcher:
+                finished = [f for f in folders if index.is_finished(f)]
+                if finished:
+                    reactor.callFromThread(watcher.unwatch_runs, finished)
+            logger.set_state('sleeping')
+
+        except KeyboardInterrupt:
+            end_event.set()
+        except:
+            logger.errors.error(traceback.format_exc())
+            logger.set_state('error')
+            last_poll = None
+
+        if last_poll is None:
+            timeout = delay
+        else:
+            timeout = max(delay - tdelt2secs(datetime.datetime.now() - last_poll), 0)
+        if watcher:
+            watcher.wait(timeout)
+        else:
+            time.sleep(timeout)
+        db.reset_queries()
+    sys.exit(0)
+
+
 def checkThread(thread, log, reactor):
     '''Checks thread for aliveness.
     If a valid reactor object is passed, the reactor will be stopped
@@ -734,7 +969,19 @@ def main(args):
         logger.errors.info("Auto-Analysis has been disabled")
 
     exit_event = threading.Event()
-    loopfunc = lambda: loop(logger, exit_event, settings.CRAWLER_PERIOD)
+    if args.incremental:
+        index = CrawlIndex()
+        watcher = None
+        if HAVE_INOTIFY:
+            try:
+                watcher = CrawlWatcher(logger, index)
+            except:
+                logger.errors.error(traceback.format_exc())
+        if watcher is None:
+            logger.errors.warn("inotify is not available, falling back to polling")
+        loopfunc = lambda: incremental_loop(logger, exit_event, settings.CRAWLER_PERIOD, index, watcher)
+    else:
+        loopfunc = lambda: loop(logger, exit_event, settings.CRAWLER_PERIOD)
     lthread = threading.Thread(target=loopfunc)
     lthread.setDaemon(True)
     lthread.start()
@@ -758,6 +1005,10 @@ if __name__ == '__main__':
                         action="store_true",
                         default=False,
                         help='Disable launching analysis when new experiment data is detected')
+    parser.add_argument('--incremental',
+                        action="store_true",
+                        default=False,
+                        help='Watch Rig folders with inotify and crawl only folders that changed')
 
     args = parser.parse_args()
     sys.exit(main(args))
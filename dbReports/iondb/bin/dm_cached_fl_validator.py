@@ -2,21 +2,21 @@
 # Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
 '''
 There is a single cached.filelist file in the report directory.  All four file categories
-use this file.
+use this file.  It holds a FileManifest, which is compared here with a full walk of the
+report and raw data directories.
 '''
 import os
 import sys
 import argparse
-from cPickle import Unpickler
 
 from iondb.bin import djangoinit
 from iondb.rundb import models
 from iondb.rundb.data import dmactions_types as dmtypes
 
 try:
-    from dm_utils import get_walk_filelist, _file_selector
+    from dm_utils import FileManifest
 except:
-    from iondb.rundb.data.dm_utils import get_walk_filelist, _file_selector
+    from iondb.rundb.data.dm_utils import FileManifest
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
 
@@ -43,7 +43,7 @@ def validate_result(result,
     '''Validate cached.filelist for the given result'''
 
     path_to_report_dir = result.get_report_dir()
-    path_to_file = os.path.join(path_to_report_dir, 'cached.filelist')
+    path_to_file = os.path.join(path_to_report_dir, FileManifest.FILENAME)
     print "validating %s" % path_to_file
 
     if result.isThumbnail:
@@ -57,21 +57,24 @@ def validate_result(result,
 #            return None
     dmfs = result.get_filestat(dmtypes.SIG)
 
-    # Get the cached filelist from cached.filelist file
-    try:
-        with open(path_to_file, 'rb') as fhandle:
-            pickle = Unpickler(fhandle)
-            cached_filelist = pickle.load()
-    except IOError as ioerror:
-        print "%s" % ioerror
+    # Get the cached filelist from cached.filelist file, without refreshing it
+    if not os.path.isfile(path_to_file):
+        print "No such file: %s" % path_to_file
+        return None
+    cached_manifest = FileManifest(path_to_report_dir)
+    cached_manifest.load()
+    if not cached_manifest.dirs:
+        print "cannot validate: not a valid manifest"
         return None
+    cached_filelist = cached_manifest.filelist()
 
     # Get a list of files on the filesystem currently
     dirs = [dmfs.result.get_report_dir(), dmfs.result.experiment.expDir]
+    current_manifest = FileManifest(os.getcwd() if write_file else None)
+    current_manifest.refresh(dirs)
     if write_file:
-        current_fs_filelist = get_walk_filelist(dirs, list_dir=os.getcwd(), save_list=True)
-    else:
-        current_fs_filelist = get_walk_filelist(dirs)
+        current_manifest.save()
+    current_fs_filelist = current_manifest.filelist()
 
     # Ignore plugin_out directories
     if filter_plugins:
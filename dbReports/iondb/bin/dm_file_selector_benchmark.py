@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+'''
+CLI tool to benchmark the data management file selector on a synthetic
+Proton-sized report.  The file list of a full chip report and its raw data
+directory is generated in memory, then each DMFileSet category is selected
+with the compiled FileSelector and with the previous per-pattern regex loop,
+and the results are compared.
+'''
+import re
+import sys
+import time
+import argparse
+
+from iondb.bin import djangoinit
+from iondb.rundb import models
+from iondb.rundb.data.dm_utils import get_file_selector
+from django.conf import settings
+
+REPORT_DIR = '/results/analysis/output/Home/Auto_user_benchmark_001'
+RAW_DIR = '/results/PGM_test/R_2016_01_01_00_00_00_user_benchmark'
+
+
+def proton_blocks(rows=8, cols=12):
+    '''Returns block offsets of a Proton chip'''
+    return ['X%d_Y%d' % (col * 1288, row * 1332) for row in range(rows) for col in range(cols)]
+
+
+def synthetic_filelist(flows=400, plugins=50, plugin_files=200):
+    '''Returns list of files of a synthetic full chip report and raw data directory'''
+    filelist = []
+    blocks = proton_blocks()
+
+    # raw data directory
+    filelist += ['%s/%s' % (RAW_DIR, name) for name in ('explog.txt', 'explog_final.txt', 'InitLog.txt',
+                                                      'RawInit.txt', 'Controller', 'DataCollect.config')]
+    for block in blocks + ['thumbnail']:
+        filelist += ['%s/%s/acq_%04d.dat' % (RAW_DIR, block, flow) for flow in range(flows)]
+        filelist += ['%s/%s/beadfind_pre_%04d.dat' % (RAW_DIR, block, i) for i in range(4)]
+        filelist += ['%s/%s/prerun_%04d.dat' % (RAW_DIR, block, i) for i in range(8)]
+        filelist += ['%s/%s/%s' % (RAW_DIR, block, name) for name in ('explog.txt', 'expMeta.dat', 'histo.dat')]
+    filelist += ['%s/onboard_results/sigproc_results/block_%s/1.wells' % (RAW_DIR, block) for block in blocks]
+
+    # report directory
+    filelist += ['%s/%s' % (REPORT_DIR, name) for name in ('ion_params_00.json', 'report.pdf', 'status.txt',
+                                                         'drmaa_stdout.txt', 'sigproc.log', 'basecaller.log')]
+    for block in blocks:
+        block_dir = '%s/block_%s' % (REPORT_DIR, block)
+        filelist += ['%s/sigproc_results/%s' % (block_dir, name) for name in (
+            '1.wells', 'bfmask.bin', 'bfmask.stats', 'analysis.bfmask.bin', 'analysis.bfmask.stats',
+            'avgNukeTrace_ATCG.txt', 'avgNukeTrace_TCAG.txt', 'sigproc.log', 'processParameters.txt',
+            'analysis_return_code.txt')]
+        filelist += ['%s/basecaller_results/%s' % (block_dir, name) for name in (
+            'rawlib.basecaller.bam', 'datasets_basecaller.json', 'BaseCaller.json', 'ionstats_basecaller.json',
+            'rawtf.basecaller.bam')]
+        filelist += ['%s/basecaller_results/IonXpress_%03d_rawlib.basecaller.bam' % (block_dir, bc)
+                     for bc in range(1, 97)]
+        filelist += ['%s/%s' % (block_dir, name) for name in ('rawlib.bam', 'ionstats_alignment.json',
+                                                            'status.txt', 'drmaa_stdout.txt')]
+    filelist += ['%s/basecaller_results/IonXpress_%03d_rawlib.basecaller.bam' % (REPORT_DIR, bc)
+                 for bc in range(1, 97)]
+    filelist += ['%s/IonXpress_%03d_rawlib.bam' % (REPORT_DIR, bc) for bc in range(1, 97)]
+    for plugin in range(plugins):
+        filelist += ['%s/plugin_out/plugin%02d_out.%d/file_%04d.txt' % (REPORT_DIR, plugin, plugin, i)
+                     for i in range(plugin_files)]
+    return filelist
+
+
+def legacy_file_selector(start_dir, ipatterns, epatterns, kpatterns, cached):
+    '''Previous implementation: one regex compiled per pattern per file'''
+    to_include = []
+    to_exclude = []
+    to_keep = []
+    for filepath in cached:
+        for pattern in ipatterns:
+            if re.compile(r'(%s/)(%s)' % (start_dir, pattern)).match(filepath):
+                to_include.append(filepath)
+        for pattern in kpatterns:
+            if re.compile(r'(%s/)(%s)' % (start_dir, pattern)).match(filepath):
+                to_keep.append(filepath)
+    for pattern in epatterns:
+        file_filter = re.compile(r'(%s/)(%s)' % (start_dir, pattern))
+        for filename in to_include:
+            if file_filter.match(filename):
+                to_exclude.append(filename)
+    return list(set(to_include) - set(to_exclude)), to_keep
+
+
+def main(legacy_sample=0):
+    '''Main function'''
+    filelist = synthetic_filelist()
+    print "Synthetic Proton report: %d files" % len(filelist)
+
+    failed = False
+    for dmfileset in models.DMFileSet.objects.filter(version=settings.RELVERSION).order_by('type'):
+        ipatterns = dmfileset.include or []
+        epatterns = dmfileset.exclude or []
+        kpatterns = []
+        for patterns in (dmfileset.keepwith or {}).values():
+            kpatterns += patterns
+
+        starttime = time.time()
+        selector = get_file_selector(ipatterns, epatterns, kpatterns)
+        selected = []
+        keep = []
+        for start_dir in (REPORT_DIR, RAW_DIR):
+            tmp_process, tmp_keep = selector.select(start_dir, filelist)
+            selected += tmp_process
+            keep += tmp_keep
+        elapsed = time.time() - starttime
+        print "%-25s %7d selected %5d keep  %8.3f seconds" % (dmfileset.type, len(selected), len(keep), elapsed)
+
+        if legacy_sample:
+            sample = filelist[::max(len(filelist) // legacy_sample, 1)]
+            sample_set = set(sample)
+            starttime = time.time()
+            legacy_selected = []
+            legacy_keep = []
+            for start_dir in (REPORT_DIR, RAW_DIR):
+                tmp_process, tmp_keep = legacy_file_selector(start_dir, ipatterns, epatterns, kpatterns, sample)
+                legacy_selected += tmp_process
+                legacy_keep += tmp_keep
+            legacy_elapsed = time.time() - starttime
+            scale = float(len(filelist)) / len(sample)
+            print "%-25s legacy on %d files: %8.3f seconds (~%.1f seconds for all files)" % (
+                '', len(sample), legacy_elapsed, legacy_elapsed * scale)
+            if (set(legacy_selected) != set(f for f in selected if f in sample_set) or
+                    set(legacy_keep) != set(f for f in keep if f in sample_set)):
+                print "%-25s MISMATCH with legacy selection" % ''
+                failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''
+dm_file_selector_benchmark
+CLI tool to time DMFileSet file selection on a synthetic Proton-sized report
+''')
+    parser.add_argument('--legacy_sample',
+                        default=10000,
+                        help='Number of files to also run through the previous selector for comparison (0 to skip)')
+    args = parser.parse_args()
+
+    sys.exit(main(legacy_sample=int(args.legacy_sample)))
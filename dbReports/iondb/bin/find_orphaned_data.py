@@ -43,8 +43,9 @@ def search_for_files(dmfilestats, reset, report):
             to_process = []
             to_keep = []
             # For each dmfilestat object, check if files still exist in filesystem
-            # 1. Do not rely on cache.filelist
+            # 1. The cached.filelist manifest is refreshed for any directory that changed
             dirs = [dmfs.result.get_report_dir(), dmfs.result.experiment.expDir]
+            cached = get_walk_filelist(dirs, list_dir=dmfs.result.get_report_dir())
             for start_dir in [dir for dir in dirs if os.path.isdir(dir)]:
                 tmp_process, tmp_keep = _file_selector(start_dir,
                                                        dmfs.dmfileset.include,
@@ -52,7 +53,7 @@ def search_for_files(dmfilestats, reset, report):
                                                        _get_keeper_list(dmfs, 'delete'),
                                                        dmfs.result.isThumbnail,
                                                        False,
-                                                       cached=get_walk_filelist(dirs))
+                                                       cached=cached)
                 to_process += tmp_process
                 to_keep += tmp_keep
 
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+'''
+CLI tool to benchmark the report page section cache on a synthetic report.
+A report directory with the basecaller, beadfind and alignment outputs and
+the results of major block plugins is generated in a temporary directory.
+The file sections of the report page are then read for each render with the
+section cache and by reading and parsing all files as before, and the
+results are compared.  The exit code is 1 if they differ.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from iondb.bin import djangoinit
+from iondb.rundb.report import views
+from iondb.rundb.report import report_cache
+
+
+class Plugin(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.majorBlock = True
+
+
+class PluginResult(object):
+
+    def __init__(self, report_dir, name, pk):
+        self.plugin = Plugin(name)
+        self._path = os.path.join(report_dir, 'plugin_out', '%s_out.%d' % (name, pk))
+
+    def path(self):
+        return self._path
+
+
+class Experiment(object):
+    getPlatform = 's5'
+
+
+class Report(object):
+    resultsType = ''
+    experiment = Experiment()
+
+    def __init__(self, report_dir):
+        self.report_dir = report_dir
+
+    def get_report_dir(self):
+        return self.report_dir
+
+
+def write(report_dir, name, content):
+    path = os.path.join(report_dir, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content if isinstance(content, basestring) else json.dumps(content))
+
+
+def synthetic_report(report_dir, plugins=50, barcodes=96):
+    '''Writes the report files read for the report page, returns the plugin results'''
+    write(report_dir, 'basecaller_results/BaseCaller.json', {
+        'Filtering': {
+            'LibraryReport': {'final_library_reads': 80000000, 'filtered_polyclonal': 20000000,
+                              'filtered_low_quality': 5000000, 'filtered_primer_dimer': 100000},
+            'BaseDetails': {'final': 12000000000}}})
+    write(report_dir, 'basecaller_results/ionstats_basecaller.json', {
+        'full': {'num_reads': 80000000, 'num_bases': 12000000000,
+                 'read_length_histogram': [1000 * (i % 300) for i in range(600)]}})
+    read_groups = {}
+    for bc in range(1, barcodes + 1):
+        read_groups['ABCDE.IonXpress_%03d' % bc] = {
+            'barcode_name': 'IonXpress_%03d' % bc, 'index': bc, 'read_count': 800000, 'total_bases': 120000000,
+            'Q20_bases': 100000000, 'filtered': False, 'sample': 'sample_%d' % bc}
+    write(report_dir, 'basecaller_results/datasets_basecaller.json', {
+        'barcode_config': {'barcode_id': 'IonXpress'},
+        'datasets': [{'file_prefix': 'IonXpress_%03d_rawlib' % bc, 'read_groups': ['ABCDE.IonXpress_%03d' % bc]}
+                     for bc in range(1, barcodes + 1)],
+        'read_groups': read_groups})
+    write(report_dir, 'basecaller_results/TFStats.json', dict(
+        (tf, {'Num': 10000, '50Q17': 9000, '100Q17': 8000}) for tf in ('TF_A', 'TF_C', 'TF_1')))
+    write(report_dir, 'sigproc_results/analysis.bfmask.stats', '[global]\n' + ''.join(
+        '%s = %d\n' % (key, value) for key, value in (
+            ('Total Wells', 165000000), ('Excluded Wells', 25000000), ('Bead Wells', 120000000),
+            ('Live Beads', 110000000), ('Test Fragment Beads', 100000), ('Library Beads', 109900000))))
+    write(report_dir, 'ionstats_alignment.json', dict(
+        [(aq, {'num_reads': 70000000, 'num_bases': 10000000000, 'mean_read_length': 150, 'max_read_length': 400})
+         for aq in ('full', 'aligned', 'AQ17', 'AQ20', 'AQ47')] +
+        [('error_by_position', [1000 * i for i in range(600)])]))
+    write(report_dir, 'InitLog.txt', ''.join(
+        'productDesc: Solution %d\nlotNumber: %d\nexpDate: 2017/01/01\n' % (i, 1000 + i) for i in range(4)) +
+        'Rawtrace\n')
+
+    plugin_results = []
+    for pk in range(plugins):
+        result = PluginResult(report_dir, 'plugin%02d' % pk, pk)
+        write(result.path(), 'plugin%02d_block.html' % pk, '<html>%d</html>' % pk)
+        write(result.path(), 'results.json', {'plugin': pk})
+        for page in range(2):
+            write(report_dir, 'pdf/slice_plugin%02d_%d.png' % (pk, page), '')
+        plugin_results.append(result)
+    return plugin_results
+
+
+def uncached_sections(report, plugin_results):
+    '''The file sections of the report page read as before, without the cache'''
+    major_plugins = {}
+    major_plugins_images = {}
+    for result in plugin_results:
+        major_plugins[result.plugin.name], major_plugins_images[result.plugin.name] = \
+            views.major_plugin_read(report, result.path(), result.plugin.name)
+    return {
+        'major_plugins': major_plugins,
+        'major_plugins_images': major_plugins_images,
+        'basecaller': views.basecaller_read(report),
+        'read_stats': views.ionstats_read_stats(report),
+        'datasets': views.load_json(report, 'basecaller_results', 'datasets_basecaller.json'),
+        'testfragments': views.testfragments_read(report),
+        'beadfind': views.load_ini(report, 'sigproc_results', 'analysis.bfmask.stats'),
+        'ionstats_alignment': views.ionstats_alignment_read(report),
+        'S5_InitLog_read': views.InitLog_read(report),
+    }
+
+
+def cached_sections(report, plugin_results):
+    '''The file sections of the report page as read by the report view'''
+    sections = views.report_sections_read(report)
+    sections['major_plugins'], sections['major_plugins_images'], has_major_plugins = \
+        views.major_plugins_read(report, plugin_results)
+    return sections
+
+
+def timed(func, renders, *args):
+    '''Returns result of the last call and the sorted latencies in ms'''
+    latencies = []
+    for i in range(renders):
+        start_time = time.time()
+        result = func(*args)
+        latencies.append(1000.0 * (time.time() - start_time))
+    return result, sorted(latencies)
+
+
+def describe(latencies):
+    return 'mean %7.3f ms   p50 %7.3f ms   p99 %7.3f ms' % (
+        sum(latencies) / len(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)])
+
+
+def main(renders, plugins):
+    report_dir = tempfile.mkdtemp(prefix='report_context_benchmark_')
+    try:
+        report = Report(report_dir)
+        plugin_results = synthetic_report(report_dir, plugins)
+        report_cache.sections.clear()
+
+        expected, latencies = timed(uncached_sections, renders, report, plugin_results)
+        print('%d renders, %d major block plugins' % (renders, plugins))
+        print('uncached  %s' % describe(latencies))
+
+        sections, latencies = timed(cached_sections, renders, report, plugin_results)
+        stats = report_cache.sections.stats()
+        print('cached    %s   hit rate %5.1f%%   %d sections' % (describe(latencies), 100 * stats['hit_rate'],
+                                                                 stats['sections']))
+        failed = sections != expected
+
+        # a plugin writing its output changes only the section of that plugin
+        misses = stats['misses']
+        write(plugin_results[0].path(), 'new_output.txt', '')
+        sections = cached_sections(report, plugin_results)
+        rebuilt = report_cache.sections.stats()['misses'] - misses
+        print('after a plugin output changed: %d section rebuilt' % rebuilt)
+        failed |= rebuilt != 1 or sections != uncached_sections(report, plugin_results)
+
+        print('sections same' if not failed else 'sections DIFFERENT')
+    finally:
+        shutil.rmtree(report_dir)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', dest='renders', type=int, default=1000, help='number of report renders')
+    parser.add_argument('-p', dest='plugins', type=int, default=50, help='number of major block plugin results')
+    args = parser.parse_args()
+
+    sys.exit(main(args.renders, args.plugins))
@@ -1046,7 +1046,8 @@ class ResultsResource(BaseMetadataResource):
         return bundle
 
     class Meta:
-        queryset = models.Results.objects.all()
+        # filesystempath of a page of results is resolved in bulk
+        queryset = models.Results.objects.with_report_dirs()
 
         # allow ordering and filtering by all fields
         field_list = models.Results._meta.get_all_field_names()
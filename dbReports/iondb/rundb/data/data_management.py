@@ -3,9 +3,10 @@
 '''
 fileserver_space_check() is a periodic task that gets executed by celery daemon
 on a repeating schedule.  If there are any actions to take, it will execute a
-celery task called manage_data() which will archive or delete one fileset category
-for one Result object.  This function will in turn call a function to do the
-actual work in the filesystem.
+celery task called manage_data() for each partition and fileset category, which
+will archive or delete up to settings.DM_MAX_CONCURRENT_ACTIONS Result objects at
+once.  This function will in turn call a function to do the actual work in the
+filesystem.
 '''
 from __future__ import absolute_import
 import sys
@@ -20,7 +21,7 @@ from celery.task import task
 from celery.task import periodic_task
 from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
-from django.db.models import Q
+from django.db.models import Q, Sum
 from django.utils import timezone
 from django.core import mail
 from django.core.exceptions import ObjectDoesNotExist
@@ -28,6 +29,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from iondb.rundb.models import GlobalConfig, \
     DMFileSet, DMFileStat, User, Experiment, Backup, Results, EventLog, Message, PluginResult
 from iondb.utils.TaskLock import TaskLock
+from iondb.utils.files import disk_attributes
 import iondb.settings as settings
 from iondb.rundb.data.tasks import delete_action, archive_action, export_action
 from iondb.rundb.data import dmactions_types
@@ -164,77 +166,154 @@ def manage_manual_action():
     return
 
 
+def _acquire_slots(lock_prefix):
+    '''Returns list of TaskLock objects obtained out of the DM_MAX_CONCURRENT_ACTIONS action slots
+    of one partition and fileset category.  The first slot keeps the single-action lock_id.'''
+    slots = []
+    for slot in range(settings.DM_MAX_CONCURRENT_ACTIONS):
+        lock_id = lock_prefix if slot == 0 else "%s_%d" % (lock_prefix, slot)
+        applock = TaskLock(lock_id)
+        if applock.lock():
+            slots.append(applock)
+    return slots
+
+
+def _space_to_free(pathlist, auto_trigger_usage):
+    '''Returns MB to be freed on the partition of pathlist to get disk usage below auto_trigger_usage'''
+    for path in pathlist:
+        try:
+            totalSpace, availSpace, _, blocksize = disk_attributes(path)
+        except OSError:
+            continue
+        if not totalSpace > 0:
+            return 0
+        excess = (1.0 - float(availSpace) / float(totalSpace)) - float(auto_trigger_usage) / 100
+        return max(excess, 0) * totalSpace * blocksize / (1024 * 1024)
+    return None
+
+
+def _launch_action(applock, dmfileset, actiondmfilestat, user_comment, concurrent_actions=1):
+    '''Starts auto-action on actiondmfilestat holding applock, which the action releases when done.
+    An archive shares the fileset bandwidth limit with the concurrent_actions auto-actions running.
+    Returns False if the error raised means no other action on this partition can succeed either.'''
+    lock_id = applock.lock_id
+    logid = {'logid': "%s" % (lock_id)}
+    try:
+        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra=logid)
+        applock.update(actiondmfilestat.result.resultsName)
+        if dmfileset['auto_action'] == 'ARC':
+            archive_action('dm_agent', user_comment, actiondmfilestat, lock_id, concurrent_actions=concurrent_actions)
+        else:
+            delete_action('dm_agent', user_comment, actiondmfilestat, lock_id,
+                          confirmed=getattr(actiondmfilestat, 'allow_delete', False))
+
+    except (DMExceptions.FilePermission,
+            DMExceptions.InsufficientDiskSpace,
+            DMExceptions.MediaNotSet,
+            DMExceptions.MediaNotAvailable,
+            DMExceptions.FilesInUse) as e:
+        applock.unlock()
+        message = Message.objects.filter(tags__contains=e.tag)
+        if not message:
+            Message.error(e.message, tags=e.tag)
+            # TODO: TS-6525: This logentry will repeat for an Archive action every 30 seconds until the cause of the exception is fixed.
+            # at least, while the message banner is raised, suppress additional Log Entries.
+            EventLog.objects.add_entry(actiondmfilestat.result, "%s - %s" %
+                                       (dmfileset['type'], e.message), username='dm_agent')
+        return isinstance(e, DMExceptions.FilesInUse)
+    except DMExceptions.SrcDirDoesNotExist as e:
+        applock.unlock()
+        msg = "Src Dir not found: %s. Setting action_state to Deleted" % e.message
+        EventLog.objects.add_entry(actiondmfilestat.result, msg, username='dm_agent')
+        actiondmfilestat.setactionstate('DD')
+        logger.info(msg, extra=logid)
+    except Exception as inst:
+        applock.unlock()
+        msg = "Auto-action error on %s " % actiondmfilestat.result.resultsName
+        msg += " Error: %s" % str(inst)
+        logger.error("%s - %s" % (dmfileset['type'], msg), extra=logid)
+        logger.error(traceback.format_exc(), extra=logid)
+        EventLog.objects.add_entry(actiondmfilestat.result, "%s - %s" %
+                                   (dmfileset['type'], msg), username='dm_agent')
+    return True
+
+
 @task(queue="dmmanage", expires=30, ignore_result=True)
 def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_action_enabled):
     logid = {'logid': "%s" % ('manage_data')}
     logger.debug("manage_data: %s %s" % (dmfileset['auto_action'], dmfileset['type']), extra=logid)
 
-    def getfirstnotpreserved(dmfilestats, action, threshdate):
-        '''QuerySet of DMFileStat objects.  Returns first instance of an object
-        with preserve_data set to False and passes the action_validation test'''
+    def getnotpreserved(dmfilestats, action, threshdate, limit, space_mb=None, exclude=()):
+        '''QuerySet of DMFileStat objects.  Returns list of up to limit objects, oldest first,
+        with preserve_data set to False and passing the action_validation test.  Selection stops
+        once the stored diskspace of the objects adds up to space_mb.'''
         logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra=logid)
-        logger.debug("Looking at %d dmfilestat objects" % dmfilestats.count(), extra=logid)
-        for archiveme in dmfilestats:
-            if not archiveme.getpreserved():
-                try:
-                    dmactions.action_validation(archiveme, action)
-                    return archiveme
-                except(DMExceptions.FilesInUse, DMExceptions.FilesMarkedKeep):
+        selected = []
+        experiments = set()
+        predicted_mb = 0
+        for archiveme in dmfilestats.select_related('result__experiment', 'dmfileset'):
+            if len(selected) >= limit or (space_mb is not None and selected and predicted_mb >= space_mb):
+                break
+            if archiveme.pk in exclude:
+                continue
+            # Signal Processing Input files are shared by all results of an experiment
+            if archiveme.dmfileset.type == dmactions_types.SIG and archiveme.result.experiment_id in experiments:
+                continue
+            if archiveme.getpreserved():
+                logger.debug("Skipped a preserved fileset: %s" % archiveme.result.resultsName, extra=logid)
+                continue
+            try:
+                dmactions.action_validation(archiveme, action)
+            except(DMExceptions.FilesInUse, DMExceptions.FilesMarkedKeep):
+                logger.debug("%s Failed action_validation.  Try next fileset" %
+                             archiveme.result.resultsName, extra=logid)
+                continue
+            except DMExceptions.BaseInputLinked:
+                # want to allow Basecalling Input delete if all results are expired
+                related_objs = DMFileStat.objects.filter(
+                    result__experiment=archiveme.result.experiment, dmfileset__type=dmactions_types.BASE)
+                if related_objs.count() == related_objs.filter(created__lt=threshdate).count():
+                    archiveme.allow_delete = True
+                else:
                     logger.debug("%s Failed action_validation.  Try next fileset" %
                                  archiveme.result.resultsName, extra=logid)
-                except DMExceptions.BaseInputLinked:
-                    # want to allow Basecalling Input delete if all results are expired
-                    related_objs = DMFileStat.objects.filter(
-                        result__experiment=archiveme.result.experiment, dmfileset__type=dmactions_types.BASE)
-                    if related_objs.count() == related_objs.filter(created__lt=threshdate).count():
-                        archiveme.allow_delete = True
-                        return archiveme
-                    else:
-                        logger.debug("%s Failed action_validation.  Try next fileset" %
-                                     archiveme.result.resultsName, extra=logid)
-                except:
-                    logger.error(traceback.format_exc(), extra=logid)
-            else:
-                logger.debug("Skipped a preserved fileset: %s" % archiveme.result.resultsName, extra=logid)
+                    continue
+            except:
+                logger.error(traceback.format_exc(), extra=logid)
+                continue
+            selected.append(archiveme)
+            experiments.add(archiveme.result.experiment_id)
+            predicted_mb += archiveme.diskspace or 0
 
-        logger.info("%d filestat objects are preserved." % dmfilestats.count(), extra=logid)
-        raise DMExceptions.NoDMFileStat("NONE FOUND")
+        if not selected:
+            raise DMExceptions.NoDMFileStat("NONE FOUND")
+        return selected
 
     try:
-        # logger.debug("manage_data lock for %s (%d)" % (dmfileset['type'], os.getpid()), extra = logid)
-        # Create lock file to prevent more than one celery task for each process_type and partition
+        # Create lock files to limit the number of concurrent celery tasks for each process_type and partition
         lock_id = "%s_%s" % (hex(deviceid), slugify(dmfileset['type']))
         logid = {'logid': "%s" % (lock_id)}
-        applock = TaskLock(lock_id)
+        slots = _acquire_slots(lock_id)
 
-        if not applock.lock():
-            logger.info("Currently processing: %s(%s)" % (lock_id, applock.get()), extra=logid)
+        if not slots:
+            logger.info("Currently processing: %s(%s)" % (lock_id, TaskLock(lock_id).get()), extra=logid)
             return
 
-        logger.debug("lock file created: %s(%s)" % (lock_id, applock.get()), extra=logid)
+        logger.debug("lock files created: %s" % ', '.join(applock.lock_id for applock in slots), extra=logid)
 
     except Exception as e:
         logger.error(traceback.format_exc(), extra=logid)
+        return
 
+    actiondmfilestats = []
     try:
         #---------------------------------------------------------------------------
         # Database object filtering
         #---------------------------------------------------------------------------
-        actiondmfilestat = None
         user_comment = "Auto Action"
         # Order by incrementing pk.  This puts them in chronological order.
         # Select DMFileStat objects of category DMFileSet.type (1/4th of all objects)
         dmfilestats = DMFileStat.objects.filter(dmfileset__type=dmfileset['type']).order_by('created')
-        tot_obj = dmfilestats.count()
-
-        # Select objects not yet processed
-        dmfilestats = dmfilestats.filter(action_state__in=['L', 'S', 'N', 'A'])
-        tot_act = dmfilestats.count()
-
-        # Select objects that are old enough
-        threshdate = datetime.now(pytz.UTC) - timedelta(days=dmfileset['auto_trigger_age'])
-        dmfilestats = dmfilestats.filter(created__lt=threshdate)
-        tot_exp = dmfilestats.count()
 
         # Select objects stored on the deviceid
         query = Q()
@@ -248,19 +327,16 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
             else:
                 query |= Q(result__reportstorage__dirPath__startswith=path)
 
-        dmfilestats = dmfilestats.filter(query)
-        tot_onpath = dmfilestats.count()
+        # Select objects not yet processed, old enough and stored on the deviceid
+        threshdate = datetime.now(pytz.UTC) - timedelta(days=dmfileset['auto_trigger_age'])
+        dmfilestats = dmfilestats.filter(action_state__in=['L', 'S', 'N', 'A'], created__lt=threshdate).filter(query)
 
         # Exclude objects marked 'Keep' upfront to optimize db access
         if dmfileset['type'] == dmactions_types.SIG:
             dmfilestats = dmfilestats.exclude(result__experiment__storage_options="KI")
         else:
             dmfilestats = dmfilestats.exclude(preserve_data=True)
-        tot_notpreserved = dmfilestats.count()
-
-        # Compress to single log entry
-        logger.info("Total: %d Active: %d Expired: %d On Path: %d Not Preserved: %d" %
-                    (tot_obj, tot_act, tot_exp, tot_onpath, tot_notpreserved), extra=logid)
+        tot_eligible = dmfilestats.count()
 
         #---------------------------------------------------------------------------
         # Archive
@@ -275,30 +351,16 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
             5) Do not include filesets marked 'E' in auto-action - can get stuck on that fileset forever
             '''
             logger.info("Exceed %d days. Eligible to archive: %d" %
-                        (dmfileset['auto_trigger_age'], dmfilestats.count()), extra=logid)
-            actiondmfilestat = None
+                        (dmfileset['auto_trigger_age'], tot_eligible), extra=logid)
             # Bail out if disabled
             if auto_action_enabled != True:
                 logger.info("Data management auto-action is disabled.", extra=logid)
-                applock.unlock()
-                logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), lock_id), extra=logid)
-                return
-
-            # Select first object stored on the deviceid
-            try:
-                actiondmfilestat = getfirstnotpreserved(dmfilestats, dmactions.ARCHIVE, threshdate)
-                logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra=logid)
-            except DMExceptions.NoDMFileStat:
-                logger.debug("No filesets to archive on this device", extra=logid)
-                applock.unlock()
-                logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), lock_id), extra=logid)
-            except:
-                logger.error(traceback.format_exc(), extra=logid)
-                applock.unlock()
-                logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), lock_id), extra=logid)
             else:
-                applock.update(actiondmfilestat.result.resultsName)
-                archive_action('dm_agent', user_comment, actiondmfilestat, lock_id)
+                # Select oldest objects stored on the deviceid, one per free slot
+                try:
+                    actiondmfilestats = getnotpreserved(dmfilestats, dmactions.ARCHIVE, threshdate, len(slots))
+                except DMExceptions.NoDMFileStat:
+                    logger.debug("No filesets to archive on this device", extra=logid)
 
         #---------------------------------------------------------------------------
         # Delete
@@ -313,50 +375,50 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                 Else:
                     promote to 'A'
                 delete an 'A' fileset
+            Filesets are selected until their stored diskspace covers the space needed to get
+            below the disk threshold, less the space about to be freed by deletes in progress.
             '''
             logger.info("Exceed %d days. Eligible to delete: %d" %
-                        (dmfileset['auto_trigger_age'], dmfilestats.count()), extra=logid)
+                        (dmfileset['auto_trigger_age'], tot_eligible), extra=logid)
+            nslots = len(slots)
+            space_mb = _space_to_free(pathlist, dmfileset['auto_trigger_usage'])
+            if space_mb is not None:
+                in_progress_mb = DMFileStat.objects.filter(dmfileset__type=dmfileset['type'], action_state='DG') \
+                    .filter(query).aggregate(Sum('diskspace'))['diskspace__sum'] or 0
+                if in_progress_mb > 0 and space_mb <= in_progress_mb:
+                    # deletes in progress will bring disk usage below threshold
+                    nslots = 0
+                space_mb = max(space_mb - in_progress_mb, 0)
+                logger.info("Space to free: %0.1f MB (%0.1f MB being deleted)" %
+                            (space_mb, in_progress_mb), extra=logid)
+
             if auto_acknowledge_enabled:
                 if dmfileset['type'] == dmactions_types.SIG:
                     logger.debug("Sig Proc Input Files auto acknowledge enabled", extra=logid)
                 '''
                 Do not require 'S' -> 'N' -> 'A' progression before action; mark 'A' and process
                 '''
-                a_list = dmfilestats.filter(action_state='A')
-                if a_list.count() > 0:
-                    # there are filesets acknowledged and ready to be deleted.  Covers situation where user has
-                    # already acknowledged but recently enabled auto-acknowledge as well.
-                    # deleteme = a_list[0]
-                    try:
-                        actiondmfilestat = getfirstnotpreserved(a_list, dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra=logid)
-                    except DMExceptions.NoDMFileStat:
-                        logger.info("No filesets to delete on this device", extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
-                    except:
-                        logger.error(traceback.format_exc(), extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
+                # Filesets acknowledged and ready to be deleted go first.  Covers situation where user has
+                # already acknowledged but recently enabled auto-acknowledge as well.
+                try:
+                    actiondmfilestats = getnotpreserved(
+                        dmfilestats.filter(action_state='A'), dmactions.DELETE, threshdate, nslots, space_mb)
+                except DMExceptions.NoDMFileStat:
+                    pass
 
-                if actiondmfilestat == None:
-                    # Select oldest fileset regardless if its 'L','S','N','A'.  This covers situation where user
+                predicted_mb = sum(item.diskspace or 0 for item in actiondmfilestats)
+                if len(actiondmfilestats) < nslots and (
+                        space_mb is None or not actiondmfilestats or predicted_mb < space_mb):
+                    # Select oldest filesets regardless if its 'L','S','N','A'.  This covers situation where user
                     # recently enabled auto-acknowledge
                     try:
-                        actiondmfilestat = getfirstnotpreserved(dmfilestats, dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra=logid)
+                        actiondmfilestats += getnotpreserved(
+                            dmfilestats, dmactions.DELETE, threshdate, nslots - len(actiondmfilestats),
+                            None if space_mb is None else space_mb - predicted_mb,
+                            exclude=set(item.pk for item in actiondmfilestats))
                     except DMExceptions.NoDMFileStat:
-                        logger.info("No filesets to delete on this device", extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
-                    except:
-                        logger.error(traceback.format_exc(), extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
+                        if not actiondmfilestats:
+                            logger.info("No filesets to delete on this device", extra=logid)
             else:
                 if dmfileset['type'] == dmactions_types.SIG:
                     logger.debug("Sig Proc Input Files auto acknowledge disabled", extra=logid)
@@ -412,82 +474,47 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                                     dmfilestat.result, "Notification for Deletion Sent", username='dm_agent')
 
                     try:
-                        actiondmfilestat = getfirstnotpreserved(
-                            dmfilestats.filter(action_state='A'), dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra=logid)
+                        actiondmfilestats = getnotpreserved(
+                            dmfilestats.filter(action_state='A'), dmactions.DELETE, threshdate, nslots, space_mb)
                     except DMExceptions.NoDMFileStat:
                         logger.info("No filesets to delete on this device", extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
-                    except:
-                        logger.error(traceback.format_exc(), extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
 
                 else:
                     try:
-                        actiondmfilestat = getfirstnotpreserved(dmfilestats, dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra=logid)
+                        actiondmfilestats = getnotpreserved(
+                            dmfilestats, dmactions.DELETE, threshdate, nslots, space_mb)
                     except DMExceptions.NoDMFileStat:
                         logger.info("No filesets to delete on this device", extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
-                    except:
-                        logger.error(traceback.format_exc(), extra=logid)
-                        applock.unlock()
-                        logger.debug("Worker PID %d lock_id destroyed %s" %
-                                     (os.getpid(), lock_id), extra=logid)
 
             # Bail out if disabled
             if auto_action_enabled != True:
                 logger.info("Data management auto-action is disabled.", extra=logid)
-                applock.unlock()
-                logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), lock_id), extra=logid)
-                return
+                actiondmfilestats = []
 
-            if actiondmfilestat is not None:
-                applock.update(actiondmfilestat.result.resultsName)
-                delete_action('dm_agent', user_comment, actiondmfilestat, lock_id,
-                              confirmed=getattr(actiondmfilestat, 'allow_delete', False))
+            if actiondmfilestats:
+                logger.info("Predicted to free: %0.1f MB" %
+                            sum(item.diskspace or 0 for item in actiondmfilestats), extra=logid)
 
         else:
             logger.error("Unknown or unhandled action: %s" % dmfileset['auto_action'], extra=logid)
-            applock.unlock()
 
-    except (DMExceptions.FilePermission,
-            DMExceptions.InsufficientDiskSpace,
-            DMExceptions.MediaNotSet,
-            DMExceptions.MediaNotAvailable,
-            DMExceptions.FilesInUse) as e:
-        applock.unlock()
-        message = Message.objects.filter(tags__contains=e.tag)
-        if not message:
-            Message.error(e.message, tags=e.tag)
-            # TODO: TS-6525: This logentry will repeat for an Archive action every 30 seconds until the cause of the exception is fixed.
-            # at least, while the message banner is raised, suppress additional Log Entries.
-            EventLog.objects.add_entry(actiondmfilestat.result, "%s - %s" %
-                                       (dmfileset['type'], e.message), username='dm_agent')
-    except DMExceptions.SrcDirDoesNotExist as e:
-        applock.unlock()
-        msg = "Src Dir not found: %s. Setting action_state to Deleted" % e.message
-        EventLog.objects.add_entry(actiondmfilestat.result, msg, username='dm_agent')
-        actiondmfilestat.setactionstate('DD')
-        logger.info(msg, extra=logid)
     except Exception as inst:
-        applock.unlock()
-        msg = ''
-        if actiondmfilestat:
-            msg = "Auto-action error on %s " % actiondmfilestat.result.resultsName
-        msg += " Error: %s" % str(inst)
-        logger.error("%s - %s" % (dmfileset['type'], msg), extra=logid)
+        actiondmfilestats = []
+        logger.error("%s - Auto-action error: %s" % (dmfileset['type'], str(inst)), extra=logid)
         logger.error(traceback.format_exc(), extra=logid)
 
-        if actiondmfilestat:
-            EventLog.objects.add_entry(actiondmfilestat.result, "%s - %s" %
-                                       (dmfileset['type'], msg), username='dm_agent')
+    # Release the slots not needed, then launch one action per remaining slot
+    for applock in slots[len(actiondmfilestats):]:
+        applock.unlock()
+        logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), applock.lock_id), extra=logid)
+
+    # actions launched now, and still running in the slots held by earlier passes
+    concurrent_actions = settings.DM_MAX_CONCURRENT_ACTIONS - len(slots) + len(actiondmfilestats)
+    for index, (applock, actiondmfilestat) in enumerate(zip(slots, actiondmfilestats)):
+        if not _launch_action(applock, dmfileset, actiondmfilestat, user_comment, concurrent_actions):
+            for unused in slots[index + 1:len(actiondmfilestats)]:
+                unused.unlock()
+            break
 
     return
 
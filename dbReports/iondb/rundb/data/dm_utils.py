@@ -4,10 +4,10 @@ from __future__ import absolute_import
 import re
 import os
 import sys
-import pickle
+import cPickle as pickle
 import stat
 import time
-import errno
+import tempfile
 import traceback
 import iondb.settings as settings
 from iondb.utils.files import percent_full, getdeviceid
@@ -19,131 +19,257 @@ logger = get_task_logger('data_management')
 logid = {'logid': "%s" % ('dm_utils')}
 
 
-def get_walk_filelist(input_dirs, list_dir=None, save_list=False):
+class FileManifest(object):
     '''
-    Purpose of the function is to generate a list of all files rooted in the given directories,
-    much like os.walk().
-    Since the os.walk is an expensive operation on large filesystems, we can store the file list
-    in a text file in the report directory.  Once a report is analyzed, the only potential changes
-    to the file list will be in the plugin_out directory.  Thus, we always update the contents of
-    the file list for that directory.
+    Listing of all files rooted in the given directories, with the size, mtime and inode of
+    each file.  Entries are kept per directory together with the directory mtime, so that a
+    refresh re-reads only directories whose contents changed (typically plugin_out) and costs
+    a single stat for every other directory.  The manifest is stored in the report directory
+    and is not listed itself.
+    Sizes are those seen when a directory was read, a file growing in place does not change
+    the mtime of its directory.
     '''
-    logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra=logid)
+    FILENAME = "cached.filelist"
+    VERSION = 2
+    # Directories modified within this many seconds of a scan are re-read on the next refresh,
+    # because mtime granularity on NFS can hide changes made in the same second.
+    MTIME_SLACK = 2
+
+    def __init__(self, list_dir=None):
+        self.cachefile = os.path.join(list_dir, self.FILENAME) if list_dir else ""
+        # dirpath: (mtime, ((name, size, mtime, inode), ...), (subdirname, ...))
+        self.dirs = {}
+        self.changed = False
+
+    def load(self):
+        '''Read manifest file, if it exists'''
+        if not self.cachefile or not os.path.isfile(self.cachefile):
+            return
+        try:
+            with open(self.cachefile, "rb") as fileh:
+                data = pickle.load(fileh)
+            # Older cached.filelist files hold a plain list of filenames; ignore those
+            if isinstance(data, dict) and data.get('version') == self.VERSION:
+                self.dirs = data['dirs']
+        except:
+            logger.warn("Unable to read %s" % self.cachefile, extra=logid)
+            logger.warn(traceback.format_exc(), extra=logid)
 
-    def dump_the_list(filepath, thelist):
+    def save(self):
         '''
-        Write a file to report directory containing cached file list.
+        Write manifest file to report directory.
         Needs to have same uid/gid as directory with 0x666 permissions
         '''
-        if filepath == "":
+        if not self.cachefile:
             return
 
-        uid = os.stat(os.path.dirname(filepath)).st_uid
-        gid = os.stat(os.path.dirname(filepath)).st_gid
+        tmpfile = None
+        try:
+            dirpath = os.path.dirname(self.cachefile)
+            dirstat = os.stat(dirpath)
+            # unique name, several data management tasks can save the manifest of a report at once
+            fd, tmpfile = tempfile.mkstemp(prefix=self.FILENAME + '.', suffix='.tmp', dir=dirpath)
+            with os.fdopen(fd, 'wb') as fileh:
+                pickle.dump({'version': self.VERSION, 'dirs': self.dirs}, fileh, pickle.HIGHEST_PROTOCOL)
+            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH  # 0o666
+            os.chmod(tmpfile, mode)
+            try:
+                os.chown(tmpfile, dirstat.st_uid, dirstat.st_gid)
+            except OSError:
+                pass
+            os.rename(tmpfile, self.cachefile)
+            self.changed = False
+        except:
+            # Remove possible partial file
+            try:
+                if tmpfile:
+                    os.unlink(tmpfile)
+            except OSError:
+                pass
+            logger.error(traceback.format_exc(), extra=logid)
 
-        mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH  # 0o666
-        umask_original = os.umask(0)
+    def refresh(self, input_dirs):
+        '''Bring the manifest up to date, re-reading only directories whose mtime changed'''
+        now = time.time()
+        dirs = {}
+        rescanned = 0
+        for item in input_dirs:
+            if not os.path.isdir(item):
+                logger.warn("No such directory: %s" % item, extra=logid)
+                continue
+            stack = [item]
+            while stack:
+                dirpath = stack.pop()
+                try:
+                    mtime = os.stat(dirpath).st_mtime
+                except OSError:
+                    continue
+                entry = self.dirs.get(dirpath)
+                if entry is None or entry[0] != mtime:
+                    old_entry = entry
+                    entry = self._read_dir(dirpath, mtime if mtime < now - self.MTIME_SLACK else None)
+                    rescanned += 1
+                    # saving the manifest changes the mtime of its own directory, and directories
+                    # within MTIME_SLACK are read again, the manifest is only rewritten if files changed
+                    if old_entry is None or old_entry[1:] != entry[1:]:
+                        self.changed = True
+                dirs[dirpath] = entry
+                stack.extend(os.path.join(dirpath, name) for name in entry[2])
+
+        if len(dirs) != len(self.dirs):
+            self.changed = True
+        self.dirs = dirs
+        logger.debug("Manifest: %d of %d directories read" % (rescanned, len(dirs)), extra=logid)
+
+    def _read_dir(self, dirpath, mtime):
+        '''Returns manifest entry for a single directory'''
+        files = []
+        subdirs = []
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            logger.error("Unhandled error in get_walk_filelist on: %s" % dirpath, extra=logid)
+            logger.error(traceback.format_exc(), extra=logid)
+            return (None, (), ())
+
+        own_dir = self.cachefile and dirpath == os.path.dirname(self.cachefile)
+        for name in names:
+            if own_dir and (name == self.FILENAME or (name.startswith(self.FILENAME + '.') and name.endswith('.tmp'))):
+                # the manifest itself and its temporary files
+                continue
+            # This code address specific issue caused by bad plugin code: TS-9917
+            try:
+                name.decode('utf-8')
+            except:
+                logger.warn("Bad file in directory: %s" % dirpath, extra=logid)
+                logger.warn("File is '%s'" % name, extra=logid)
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                filestat = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(filestat.st_mode):
+                subdirs.append(name)
+            elif stat.S_ISLNK(filestat.st_mode):
+                if os.path.isdir(path):
+                    # add files from linked sigproc_results folder, except proton onboard_results files
+                    if name == 'sigproc_results' and 'onboard_results' not in os.path.realpath(path):
+                        subdirs.append(name)
+                else:
+                    # links take no disk space of their own
+                    files.append((name, 0, filestat.st_mtime, filestat.st_ino))
+            else:
+                files.append((name, filestat.st_size, filestat.st_mtime, filestat.st_ino))
 
-        with os.fdopen(os.open(filepath, os.O_WRONLY | os.O_CREAT, mode), 'w') as fileh:
-            pickle.dump(thelist, fileh)
-        os.chown(filepath, uid, gid)
-        os.umask(umask_original)
+        return (mtime, tuple(files), tuple(subdirs))
 
-    use_file_cache = False
-    # Disable writing the cache file if use_file_cache is False
-    if not use_file_cache:
-        save_list = False
+    def filelist(self):
+        '''Returns list of all files'''
+        return [os.path.join(dirpath, entry[0]) for dirpath, (_, files, _) in self.dirs.iteritems() for entry in files]
 
-    thelist = []
-    if list_dir:
-        cachefile = os.path.join(list_dir, "cached.filelist")
-    else:
-        cachefile = ""
 
+def get_file_manifest(input_dirs, list_dir=None, save_list=False):
+    '''
+    Returns FileManifest of all files rooted in the given directories.
+    If list_dir is given the manifest stored there is refreshed instead of walking the whole
+    tree, and written back when save_list is set and anything changed.
+    '''
+    logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra=logid)
     starttime = time.time()
-    if use_file_cache and os.path.isfile(cachefile):
-        # if file of cached list exists, read it
-        with open(cachefile, "r") as fileh:
-            thelist = pickle.load(fileh)
 
-        # Remove all plugin_out contents from the list
-        thelist = [item for item in thelist if 'plugin_out' not in item]
+    manifest = FileManifest(list_dir)
+    manifest.load()
+    manifest.refresh(input_dirs)
+    if save_list and manifest.changed:
+        manifest.save()
 
-        # Update the plugins directory contents now.  We test all entries in input_dirs, not knowing
-        # which one contains the plugin_out subdirectory.
-        for item in input_dirs:
-            try:
-                os.chdir(item)
-            except OSError as e:
-                if e.errno == errno.ENOENT:  # No such file or directory
-                    logger.warn("No such directory: %s" % item, extra=logid)
-                    continue
-                else:
-                    logger.error("Unhandled error in get_walk_filelist on: %s" % item, extra=logid)
-                    logger.error(traceback.format_exc(), extra=logid)
-                    continue
+    endtime = time.time()
+    logger.info("%s: %f seconds" % (sys._getframe().f_code.co_name, (endtime - starttime)), extra=logid)
+    return manifest
 
-            this_dir = os.path.join(item, 'plugin_out')
-            if os.path.isdir(this_dir):
-                os.chdir(this_dir)
-                for root, dirs, files in os.walk('./', topdown=True):
-                    for j in dirs + files:
-                        # This code address specific issue caused by bad plugin code: TS-9917
-                        try:
-                            j.decode('utf-8')
-                        except:
-                            logger.warn("Bad file in directory: %s" % os.path.join(item, root), extra=logid)
-                            logger.warn("File is '%s'" % j, extra=logid)
-                            continue
-                        this_file = os.path.join(this_dir, root.replace('./', ''), j)
-                        if not os.path.isdir(this_file):  # exclude directories
-                            thelist.append(this_file)
-    else:
-        for item in input_dirs:
-            try:
-                os.chdir(item)
-            except OSError as e:
-                if e.errno == errno.ENOENT:  # No such file or directory
-                    logger.warn("No such directory: %s" % item, extra=logid)
-                    continue
-                else:
-                    logger.error("Unhandled error in get_walk_filelist on: %s" % item, extra=logid)
-                    logger.error(traceback.format_exc(), extra=logid)
-                    continue
 
-            for root, dirs, files in os.walk('./', topdown=True):
-                for j in dirs + files:
-                    # This code address specific issue caused by bad plugin code: TS-9917
-                    try:
-                        j.decode('utf-8')
-                    except:
-                        logger.warn("Bad file in directory: %s" % os.path.join(item, root), extra=logid)
-                        logger.warn("File is '%s'" % j, extra=logid)
-                        continue
-                    this_file = os.path.join(item, root.replace('./', ''), j)
-                    if not os.path.isdir(this_file):  # exclude directories
-                        thelist.append(this_file)
-                    elif j == 'sigproc_results':
-                        # add files from linked sigproc_results folder, except proton onboard_results files
-                        if os.path.islink(this_file) and 'onboard_results' not in os.path.realpath(this_file):
-                            for root2, _, files2 in os.walk(this_file):
-                                thelist += [os.path.join(root2, filename) for filename in files2]
+def get_walk_filelist(input_dirs, list_dir=None, save_list=False):
+    '''
+    Purpose of the function is to generate a list of all files rooted in the given directories,
+    much like os.walk().
+    Since the os.walk is an expensive operation on large filesystems, we can store a FileManifest
+    in the report directory.  Once a report is analyzed, the only potential changes to the file
+    list will be in the plugin_out directory, and only directories that changed are read again.
+    '''
+    return get_file_manifest(input_dirs, list_dir, save_list).filelist()
 
-    endtime = time.time()
-    logger.info("%s: %f seconds" % (sys._getframe().f_code.co_name, (endtime - starttime)), extra=logid)
 
-    if save_list and thelist:
-        try:
-            dump_the_list(cachefile, thelist)
-        except:
-            # Remove possible partial file
-            try:
-                os.unlink(cachefile)
-            except OSError:
-                pass
-            logger.error(traceback.format_exc(), extra=logid)
+# Compiled FileSelector objects, keyed by the (include, exclude, keep) pattern lists.
+# DMFileSet patterns only change with the DMFileSet version, so this stays small.
+_selector_cache = {}
 
-    return thelist
+
+def _compile_patterns(patterns):
+    '''Returns a match function for a single regex combining all patterns, or None
+    if there are no patterns'''
+    if not patterns:
+        return None
+    try:
+        return re.compile('|'.join('(?:%s)' % pattern for pattern in patterns)).match
+    except (re.error, AssertionError, OverflowError):
+        # too many groups to combine into one regex
+        compiled = [re.compile(pattern) for pattern in patterns]
+        return lambda filepath: any(regex.match(filepath) for regex in compiled)
+
+
+class FileSelector(object):
+    '''Include, exclude and keep patterns of a DMFileSet compiled once into
+    combined matchers.  Patterns are matched against file paths relative to
+    the start directory.
+    '''
+
+    def __init__(self, ipatterns, epatterns, kpatterns):
+        self.include = _compile_patterns(ipatterns)
+        self.exclude = _compile_patterns(epatterns)
+        self.keep = _compile_patterns(kpatterns)
+
+    def select(self, start_dir, cached, is_thumbnail=False, exclude_sigproc_folder=False):
+        '''Classifies every path in cached in a single pass.
+        Returns list of files to process and list of files to keep.
+        '''
+        selected = []
+        to_keep = []
+        include, exclude, keep = self.include, self.exclude, self.keep
+        if include is None and keep is None:
+            return selected, to_keep
+
+        prefix = '%s/' % start_dir
+        offset = len(prefix)
+        seen = set()
+        for filepath in cached:
+            if not filepath.startswith(prefix):
+                continue
+            if is_thumbnail and 'onboard_results' in filepath:
+                continue
+            if exclude_sigproc_folder and 'sigproc_results' in filepath:
+                continue
+            if filepath in seen:
+                continue
+            seen.add(filepath)
+
+            relpath = filepath[offset:]
+            if include and include(relpath) and not (exclude and exclude(relpath)):
+                selected.append(filepath)
+            if keep and keep(relpath):
+                to_keep.append(filepath)
+
+        return selected, to_keep
+
+
+def get_file_selector(ipatterns, epatterns, kpatterns):
+    '''Returns cached FileSelector for the given pattern lists'''
+    key = (tuple(ipatterns or []), tuple(epatterns or []), tuple(kpatterns or []))
+    selector = _selector_cache.get(key)
+    if selector is None:
+        selector = FileSelector(*key)
+        _selector_cache[key] = selector
+    return selector
 
 
 def _file_selector(start_dir, ipatterns, epatterns, kpatterns, is_thumbnail=False, add_linked_sigproc=False, cached=None):
@@ -154,49 +280,14 @@ def _file_selector(start_dir, ipatterns, epatterns, kpatterns, is_thumbnail=Fals
     '''
     logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra=logid)
     starttime = time.time()  # debugging time of execution
-    to_include = []
-    to_exclude = []
-    to_keep = []
-
-    if not ipatterns: ipatterns = []
-    if not epatterns: epatterns = []
-    if not kpatterns: kpatterns = []
 
     exclude_sigproc_folder = False
     if not add_linked_sigproc and os.path.islink(os.path.join(start_dir, 'sigproc_results')):
         exclude_sigproc_folder = True
 
-    # find files matching include filters from start_dir
-    # for root, dirs, files in os.walk(start_dir,topdown=True):
-    for filepath in cached:
-        if is_thumbnail and 'onboard_results' in filepath:
-            continue
-        if exclude_sigproc_folder and 'sigproc_results' in filepath:
-            continue
-
-        for pattern in ipatterns:
-            file_filter = re.compile(
-                r'(%s/)(%s)' % (start_dir, pattern))  # NOTE: use of start_dir, not root here
-            match = file_filter.match(filepath)
-            if match:
-                to_include.append(filepath)
-
-        # find files matching keep filters from start_dir
-        for pattern in kpatterns:
-            file_filter = re.compile(r'(%s/)(%s)' % (start_dir, pattern))
-            match = file_filter.match(filepath)
-            if match:
-                to_keep.append(filepath)
-
-    # find files matching exclude filters from include list
-    for pattern in epatterns:
-        file_filter = re.compile(r'(%s/)(%s)' % (start_dir, pattern))
-        for filename in to_include:
-            match = file_filter.match(filename)
-            if match:
-                to_exclude.append(filename)
+    selector = get_file_selector(ipatterns, epatterns, kpatterns)
+    selected, to_keep = selector.select(start_dir, cached, is_thumbnail, exclude_sigproc_folder)
 
-    selected = list(set(to_include) - set(to_exclude))
     endtime = time.time()
     logger.info("%s(): %f seconds" % (sys._getframe().f_code.co_name, (endtime - starttime)), extra=logid)
     return selected, to_keep
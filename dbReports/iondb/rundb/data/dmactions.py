@@ -5,7 +5,9 @@ from __future__ import absolute_import
 import os
 import sys
 import time
+import stat
 import shutil
+import tempfile
 import errno
 import traceback
 import subprocess
@@ -32,6 +34,12 @@ EXPORT = 'export'
 DELETE = 'delete'
 TEST = 'test'
 
+# Files are processed in batches; each batch of an export or archive is copied by one rsync
+BATCH_MAX_FILES = 1000
+BATCH_MAX_BYTES = 1024 * 1024 * 1024
+# Seconds of work done by one _process_task before it re-launches itself
+TASK_TIME_SLICE = 60
+
 
 def delete(user, user_comment, dmfilestat, lockfile, msg_banner, confirmed=False):
     '''DM Action which deletes files'''
@@ -77,8 +85,10 @@ def export(user, user_comment, dmfilestat, lockfile, msg_banner, backup_director
         raise
 
 
-def archive(user, user_comment, dmfilestat, lockfile, msg_banner, backup_directory=None, confirmed=False):
-    '''DM Action which copies files then deletes them'''
+def archive(user, user_comment, dmfilestat, lockfile, msg_banner, backup_directory=None, confirmed=False,
+            concurrent_actions=1):
+    '''DM Action which copies files then deletes them.
+    concurrent_actions is the number of auto-actions sharing the fileset bandwidth limit.'''
     logid = {'logid': "%s" % (lockfile)}
     logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra=logid)
     msg = "Archiving %s - %s Using v.%s" % (
@@ -95,7 +105,7 @@ def archive(user, user_comment, dmfilestat, lockfile, msg_banner, backup_directo
     try:
         if dmfilestat.dmfileset.type == dmactions_types.OUT:
             _create_archival_files(dmfilestat)
-        _process_fileset_task(dmfilestat, ARCHIVE, user, user_comment, lockfile, msg_banner)
+        _process_fileset_task(dmfilestat, ARCHIVE, user, user_comment, lockfile, msg_banner, concurrent_actions)
         prepare_for_data_import(dmfilestat)
     except:
         set_action_state(dmfilestat, 'E', ARCHIVE)
@@ -466,11 +476,7 @@ def _copy_to_dir(filepath, _start_dir, _destination):
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         _, stderr = proc.communicate()
         if proc.returncode != 0:
-            errordump = stderr.splitlines()[0].split(":")[2]
-            errordetail = stderr.splitlines()[0].split(":")[1]
-            errstr = errordump.split('(')[0].strip()
-            errnum = int(errordump.split('(')[1].strip(')'))
-            raise DMExceptions.RsyncError(errstr + " " + errordetail, errnum)
+            raise _rsync_error(stderr, proc.returncode)
 
         return True
     except:
@@ -479,6 +485,130 @@ def _copy_to_dir(filepath, _start_dir, _destination):
         os.chdir(orig_dir)
 
 
+def _rsync_error(stderr, returncode):
+    '''Returns RsyncError built from the first line of rsync error output'''
+    try:
+        errordump = stderr.splitlines()[0].split(":")[2]
+        errordetail = stderr.splitlines()[0].split(":")[1]
+        errstr = errordump.split('(')[0].strip()
+        errnum = int(errordump.split('(')[1].strip(')'))
+        return DMExceptions.RsyncError(errstr + " " + errordetail, errnum)
+    except (IndexError, ValueError):
+        return DMExceptions.RsyncError(stderr.strip() or "rsync exit code %d" % returncode, returncode)
+
+
+def _copy_batch(batch, _start_dir, _destination, bwlimit=None):
+    '''
+    Copies a batch of files, each rooted in _start_dir, to the _destination dir.
+    Destination subdirectories are created once per batch, symbolic links within the tree
+    are re-created and all other files are copied by a single rsync run, limited to
+    bwlimit KB/s if set.
+    Returns list of files which were copied.
+    '''
+    logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra=logid)
+
+    # Check that remote mount is still mounted
+    if not os.path.isdir(_destination):
+        raise DMExceptions.MediaNotAvailable(
+            "%s is no longer available. Check your remote mounts" % _destination)
+
+    copied = []
+    to_rsync = []
+    new_dirs = set()
+    for filepath in batch:
+        relpath = filepath.replace(_start_dir, '')
+        relpath = relpath[1:] if relpath.startswith('/') else relpath
+        dst = os.path.join(_destination, relpath)
+
+        # Create subdirectories if needed, with ownership of the source directory
+        dst_dir = os.path.dirname(dst)
+        if dst_dir not in new_dirs:
+            new_dirs.add(dst_dir)
+            try:
+                os.makedirs(dst_dir)
+                src_dir_stat = os.stat(os.path.dirname(filepath))
+                subdir = dst_dir
+                while subdir.startswith(_destination) and subdir != _destination:
+                    os.chown(subdir, src_dir_stat.st_uid, src_dir_stat.st_gid)
+                    subdir = os.path.dirname(subdir)
+            except OSError as exception:
+                if exception.errno not in [errno.EEXIST, errno.EPERM, errno.EACCES]:
+                    # Unknown error, bail out
+                    raise
+
+        # Trying to preserve symbolic link within local directory tree
+        if os.path.islink(filepath) and (os.path.basename(_start_dir) in filepath):
+            try:
+                os.symlink(os.readlink(filepath), dst)
+                copied.append(filepath)
+                continue
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    # Target exists so leave it alone
+                    copied.append(filepath)
+                    continue
+                elif e.errno in [errno.EOPNOTSUPP, errno.EACCES]:
+                    # Cannot create a link so copy instead below
+                    pass
+                else:
+                    # Unknown error, bail out
+                    raise
+
+            # Catch broken links and do not copy them
+            if not os.path.exists(filepath):
+                logger.info("Broken link not copied: %s" % filepath, extra=logid)
+                copied.append(filepath)
+                continue
+
+        to_rsync.append((filepath, relpath, dst))
+
+    if not to_rsync:
+        return copied
+
+    # Calling rsync command once for the whole batch
+    with tempfile.NamedTemporaryFile(prefix='dm_files_from_') as fileh:
+        fileh.write('\0'.join(relpath for _, relpath, _ in to_rsync))
+        fileh.flush()
+        cmd = ["rsync", "--times", "--copy-links", "--owner", "--group",
+               "--from0", "--files-from=%s" % fileh.name,
+               os.path.join(_start_dir, ''), os.path.join(_destination, '')]
+        if bwlimit:
+            cmd.insert(1, "--bwlimit=%d" % bwlimit)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate()
+
+    if proc.returncode == 0:
+        return copied + [filepath for filepath, _, _ in to_rsync]
+    elif proc.returncode in [23, 24]:
+        # Partial transfer: files which vanished from the source are not an error, files at
+        # the destination only count as copied if they match the source
+        failed = []
+        for filepath, _, dst in to_rsync:
+            if not os.path.lexists(filepath):
+                logger.warn("No longer exists %s" % filepath, extra=logid)
+            elif _same_file(filepath, dst):
+                copied.append(filepath)
+            else:
+                logger.error("Not copied %s" % filepath, extra=logid)
+                failed.append(filepath)
+        if failed:
+            # the source files of the batch are kept
+            raise _rsync_error(stderr, proc.returncode)
+        return copied
+    else:
+        raise _rsync_error(stderr, proc.returncode)
+
+
+def _same_file(src, dst):
+    '''Returns True if dst has the size and modification time of src, as copied by rsync --times'''
+    try:
+        src_stat = os.stat(src)
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
 def _process(filepath, action, destination, _start_dir, to_keep):
     '''
     Two basic operations: copy file, delete file.
@@ -514,7 +644,7 @@ def _process(filepath, action, destination, _start_dir, to_keep):
             raise
 
 
-def _process_fileset_task(dmfilestat, action, user, user_comment, lockfile, msg_banner):
+def _process_fileset_task(dmfilestat, action, user, user_comment, lockfile, msg_banner, concurrent_actions=1):
     '''
     This function generates a list of files to process, then hands the list to a recursive
     celery task function.  The recursion continues until the list is empty.  The calling
@@ -563,7 +693,8 @@ def _process_fileset_task(dmfilestat, action, user, user_comment, lockfile, msg_
         set_action_state(dmfilestat, 'EG', EXPORT)
 
     # List of all files associated with the report
-    cached_file_list = dm_utils.get_walk_filelist(search_dirs, list_dir=dmfilestat.result.get_report_dir())
+    cached_file_list = dm_utils.get_walk_filelist(
+        search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
 
     # Determine if this file type is eligible to use a keep list
     kpatterns = _get_keeper_list(dmfilestat, action)
@@ -602,6 +733,7 @@ def _process_fileset_task(dmfilestat, action, user, user_comment, lockfile, msg_
                 'user_comment': user_comment,
                 'lockfile': lockfile,
                 'msg_banner': msg_banner,
+                'bwlimit': _get_bwlimit(dmfilestat.dmfileset, concurrent_actions),
             }
         )
 
@@ -621,10 +753,130 @@ def _process_fileset_task(dmfilestat, action, user, user_comment, lockfile, msg_
     return
 
 
+def _get_bwlimit(dmfileset, concurrent_actions=1):
+    '''
+    Returns rsync bandwidth limit in KB/s for one action.  The DMFileSet bandwidth_limit is shared
+    by the concurrent_actions auto-actions which data management runs at once on a partition,
+    a manual action gets all of it.
+    '''
+    if not dmfileset.bandwidth_limit:
+        return None
+    return max(dmfileset.bandwidth_limit // max(concurrent_actions, 1), 1)
+
+
+def _next_batch(to_process, offset):
+    '''
+    Returns next batch of (filepath, size) tuples from the to_process list starting at offset,
+    and the offset following the batch.  Files which no longer exist are skipped.
+    '''
+    batch = []
+    batch_size = 0
+    while offset < len(to_process) and len(batch) < BATCH_MAX_FILES and batch_size < BATCH_MAX_BYTES:
+        path = to_process[offset]
+        offset += 1
+        try:
+            filestat = os.lstat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT or e.errno == errno.ESTALE:
+                logger.warn("No longer exists %s" % path, extra=logid)
+                continue
+            raise
+        this_file_size = 0 if stat.S_ISLNK(filestat.st_mode) else filestat.st_size
+        batch.append((path, this_file_size))
+        batch_size += this_file_size
+    return batch, offset
+
+
+def _process_batch(batch, action, destination, _start_dir, to_keep, bwlimit=None):
+    '''
+    Processes a batch of (filepath, size) tuples.  For EXPORT and ARCHIVE actions the whole
+    batch is copied at once.  Returns list of (filepath, size) tuples processed.
+    '''
+    if action in [EXPORT, ARCHIVE]:
+        copied = set(_copy_batch([path for path, _ in batch], _start_dir, destination, bwlimit))
+        batch = [item for item in batch if item[0] in copied]
+        if action == EXPORT:
+            return batch
+
+    processed = []
+    for path, this_file_size in batch:
+        try:
+            if action == ARCHIVE:
+                # It is possible to copy the file, but fail to remove the file.
+                done = _file_removal(path, to_keep)
+            else:
+                done = _process(path, action, destination, _start_dir, to_keep)
+            if done:
+                processed.append((path, this_file_size))
+
+        except (OSError, IOError) as e:
+            # IOError: [Errno 28] No space left on device:
+            if e.errno == errno.ENOSPC:
+                raise
+            elif e.errno == errno.ENOENT or e.errno == errno.ESTALE:
+                logger.warn("No longer exists %s" % path, extra=logid)
+                continue
+            else:
+                raise
+        except (DMExceptions.RsyncError, DMExceptions.MediaNotAvailable):
+            raise
+        except:
+            logger.error("%s %s" % (action, path), extra=logid)
+            logger.error(traceback.format_exc(), extra=logid)
+    return processed
+
+
+def _delete_empty_parents(paths):
+    '''Removes directories left empty after processing the given files'''
+    for dir in set(os.path.dirname(path) for path in paths):
+        try:
+            if len(os.listdir(dir)) == 0:
+                if not "plugin_out" in dir:
+                    try:
+                        os.rmdir(dir)
+                        logger.debug("Removed empty directory: %s" % dir, extra=logid)
+                    except Exception as e:
+                        logger.warn("rmdir [%d] %s: %s" % (
+                            e.errno, e.strerror, dir), extra=logid)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                logger.warn("del_empty_dir Does not exist %s" % (dir), extra=logid)
+            else:
+                raise e
+
+
+def _read_journal(pfilename):
+    '''
+    Returns progress recorded in the journal of a DM action data file, as a
+    dictionary of {list index: (offset, processed_cnt, total_size)}
+    '''
+    progress = {}
+    try:
+        with open(pfilename + '.journal', 'r') as fileh:
+            for line in fileh:
+                fields = line.split()
+                # a partially written last line is ignored
+                if len(fields) == 4:
+                    progress[int(fields[0])] = tuple(int(field) for field in fields[1:])
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return progress
+
+
+def _write_journal(pfilename, d_cnt, offset, processed_cnt, total_size):
+    '''Appends a progress checkpoint to the journal of a DM action data file'''
+    with open(pfilename + '.journal', 'a') as fileh:
+        fileh.write("%d %d %d %d\n" % (d_cnt, offset, processed_cnt, total_size))
+
+
 @task(queue='dmprocess', ignore_result=True)
 def _process_task(pfilename):
     '''
     Recursive celery task.
+    The data file holding the list of files is written once.  Progress is checkpointed
+    after every batch of files in <filename>.journal, and a relaunched task resumes from
+    the last completed batch.
 
     To trigger an orphaned task:
     python -c "from iondb.bin import djangoinit; from iondb.rundb.data import dmactions; dmactions._process_task.(<filename>)"
@@ -640,6 +892,7 @@ def _process_task(pfilename):
     try:
         try:
             list_of_file_dict = get_action_param_var(pfilename)
+            journal = _read_journal(pfilename)
         except Exception as e:
             logger.error("Error accessing file: %s.  Cannot continue the DM action!" %
                          (pfilename), extra=logid)
@@ -654,75 +907,44 @@ def _process_task(pfilename):
         fstatus = "Success"
 
         start_time = datetime.now()
-        max_time_delta = timedelta(seconds=10)
+        max_time_delta = timedelta(seconds=TASK_TIME_SLICE)
 
         # list_of_file_dict contains zero, one, or two dictionary variables to iterate over.
         for d_cnt, dict in enumerate(list_of_file_dict):
             logid = {'logid': "%s" % (dict.get('lockfile', '_process_task'))}
 
             # The dictionary contains an element named 'to_process' which is a list variable to iterate over
+            to_process = dict['to_process']
+            to_keep = set(dict['to_keep'])
+            offset, dict['processed_cnt'], dict['total_size'] = journal.get(
+                d_cnt, (0, dict['processed_cnt'], dict['total_size']))
             logger.debug("%d, start_dir: %s" % (d_cnt, dict['start_dir']), extra=logid)
             logger.info("%6d %s %s" %
-                        (len(dict['to_process']), dmfilestat.dmfileset.type, dmfilestat.result.resultsName), extra=logid)
+                        (len(to_process) - offset, dmfilestat.dmfileset.type, dmfilestat.result.resultsName), extra=logid)
 
-            while (datetime.now() - start_time) < max_time_delta:
-                # If there are no files left to process, (all to_process lists are empty), the recursion ends
-                if len(dict['to_process']) > 0:
+            while offset < len(to_process):
+                # If there are files left to process when time is up, the recursion continues
+                if (datetime.now() - start_time) >= max_time_delta:
                     terminate = False
-
-                    try:
-                        # process one file and remove entry from the list
-                        path = dict['to_process'].pop(0)
-
-                        j = dict['processed_cnt'] + 1
-
-                        this_file_size = 0
-                        if not os.path.islink(path):
-                            this_file_size = os.lstat(path)[6]
-
-                        if _process(path, dict['action'], dict['archivepath'], dict['start_dir'], dict['to_keep']):
-                            dict['processed_cnt'] = j
-                            dict['total_size'] += this_file_size
-                            logger.debug("%04d/%04d %s %10d %s" % (
-                                j, dict['total_cnt'], dict['action'], dict['total_size'], path), extra=logid)
-
-                    except (OSError, IOError) as e:
-                        # IOError: [Errno 28] No space left on device:
-                        if e.errno == errno.ENOSPC:
-                            raise
-                        elif e.errno == errno.ENOENT or e.errno == errno.ESTALE:
-                            logger.warn("%04d No longer exists %s" % (j, path), extra=logid)
-                            continue
-                        else:
-                            raise
-                    except (DMExceptions.RsyncError, DMExceptions.MediaNotAvailable):
-                        raise
-                    except:
-                        errmsg = "%04d/%04d %s %10d %s" % (
-                            j, dict['total_cnt'], dict['action'], dict['total_size'], path)
-                        logger.error(errmsg, extra=logid)
-                        logger.error(traceback.format_exc(), extra=logid)
-
-                    if not dict['action'] in [EXPORT, TEST] and dmfilestat.dmfileset.del_empty_dir:
-                        dir = os.path.dirname(path)
-                        try:
-                            if len(os.listdir(dir)) == 0:
-                                if not "plugin_out" in dir:
-                                    try:
-                                        os.rmdir(dir)
-                                        logger.debug("Removed empty directory: %s" % dir, extra=logid)
-                                    except Exception as e:
-                                        logger.warn("rmdir [%d] %s: %s" % (
-                                            e.errno, e.strerror, dir), extra=logid)
-                        except OSError as e:
-                            if e.errno == errno.ENOENT:
-                                logger.warn("del_empty_dir Does not exist %s" % (path), extra=logid)
-                                continue
-                            else:
-                                raise e
-                else:
                     break
 
+                batch, offset = _next_batch(to_process, offset)
+                processed = _process_batch(
+                    batch, dict['action'], dict['archivepath'], dict['start_dir'], to_keep, dict.get('bwlimit'))
+                for path, this_file_size in processed:
+                    dict['processed_cnt'] += 1
+                    dict['total_size'] += this_file_size
+                    logger.debug("%04d/%04d %s %10d %s" % (
+                        dict['processed_cnt'], dict['total_cnt'], dict['action'], dict['total_size'], path), extra=logid)
+
+                if not dict['action'] in [EXPORT, TEST] and dmfilestat.dmfileset.del_empty_dir:
+                    _delete_empty_parents([path for path, _ in batch])
+
+                _write_journal(pfilename, d_cnt, offset, dict['processed_cnt'], dict['total_size'])
+
+            if not terminate:
+                break
+
             # only expect to execute this line when no files to process
             total_processed += dict['total_size']
 
@@ -762,25 +984,24 @@ def _process_task(pfilename):
         # ====================================================================
         return
 
-    # Remove the data file here, no earlier.  In case the task is clobbered, celery
-    # will relaunch the task, access the data file and continue the action.
-    try:
-        os.unlink(pfilename)
-    except:
-        pass
-
     if not terminate:
         # ====================================================================
-        # Launch next task
+        # Launch next task, which resumes from the journal
         # ====================================================================
         try:
-            dict.get('action', 'unk')
-            pfilename = set_action_param_var(list_of_file_dict)
             _process_task.delay(pfilename)
         except:
             logger.error(traceback.format_exc(), extra=logid)
 
     else:
+        # Remove the data file here, no earlier.  In case the task is clobbered, celery
+        # will relaunch the task, access the data file and continue the action.
+        for filename in [pfilename, pfilename + '.journal']:
+            try:
+                os.unlink(filename)
+            except:
+                pass
+
         # ====================================================================
         # No more files to process.  Clean up and exit.
         # ====================================================================
@@ -1082,7 +1303,6 @@ def set_action_param_var(list_of_dict_files):
     Argument is dictionary to be pickled.  Return value is name of file.
     '''
     from cPickle import Pickler
-    import tempfile
     # Format name to include pk of dmfilestat object - in case we lose the data file itself
     # /var/spool/ion/<action>_<pk>_<randomstring>
     store_dir = '/var/spool/ion'
@@ -1182,7 +1402,7 @@ def get_file_list(dmfilestat):
         search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
 
         cached_file_list = dm_utils.get_walk_filelist(
-            search_dirs, list_dir=dmfilestat.result.get_report_dir())
+            search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
     except:
         # If this function has an error, this file set should be marked 'E'
         dmfilestat.setactionstate('E')
@@ -3,10 +3,17 @@
 from __future__ import absolute_import
 import os
 import errno
+import operator
+import traceback
+import threading
+from contextlib import contextmanager
 
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Sum, F, Q
+from django.utils import timezone
+from celery.signals import task_prerun, task_postrun
 
-from iondb.rundb.models import DMFileStat, FileServer, Chip
+from iondb.rundb.models import DMFileStat, DMDiskUsage, FileServer, Chip, Results
 from iondb.rundb.data import dmactions_types
 from iondb.rundb.data import dm_utils
 from celery.utils.log import get_task_logger
@@ -15,112 +22,338 @@ logger = get_task_logger('data_management')
 logid = {'logid': "%s" % ('tasks')}
 
 
+# action states of the sets counted as using disk space
+DISKUSAGE_STATES = ['L', 'S', 'N', 'A']
+
+
 def _unique_experiment(values):
     uvalues = []
-    pks = []
+    pks = set()
     for v in values:
         if v['result__experiment__pk'] not in pks:
-            pks.append(v['result__experiment__pk'])
+            pks.add(v['result__experiment__pk'])
             uvalues.append(v)
     return uvalues
 
 
-def calculate_diskspace_by_path(dmfilestats, fs_path):
+def _diskusage_rows(dmfilestats):
+    '''Returns values of dmfilestats needed to find the disk space they use, and the pks of Proton fullchip sets'''
+    proton_chips = Chip.objects.filter(instrumentType__in=['proton', 'S5']).values_list('name', flat=True)
+    proton_pks = set(dmfilestats.filter(result__experiment__chipType__in=proton_chips).exclude(
+        result__metaData__contains='thumb').values_list('pk', flat=True))
+    rows = dmfilestats.values_list(
+        'pk', 'diskspace', 'preserve_data', 'dmfileset__type', 'result__parentResult', 'result__experiment',
+        'result__experiment__expDir', 'result__experiment__storage_options', 'result__reportstorage__dirPath')
+    return rows, proton_pks
+
+
+def _calculate_diskusage(rows, proton_pks, fileservers):
     '''
-    Calculates dmfilestats diskspace on given path.
+    Calculates diskspace of dmfilestat rows on each of fileservers, a list of (key, filesPrefix).
+    Returns {(key, dmtype): [diskspace, keep diskspace]} in megabytes.
     Assumptions:
         BaseCalling Input: Proton fullchip onboard results are located in expDir
         BaseCalling Input: Proton fullchip shared for single Experiment, count only once for multiple Results
         Intermediate Files: PGM and thumbnail almost all Intermediate files are in report dir
         Intermediate Files: Proton fullchip about 2% in expDir, the rest in report
+    Sets counted once per Experiment use the diskspace of the newest set.
     '''
-    ret = {}
+    usage = dict(((key, dmtype), [0.0, 0.0]) for key, path in fileservers for dmtype in dmactions_types.FILESET_TYPES)
+    newest = {}
+    for pk, diskspace, preserve_data, dmtype, parent, exp_pk, expDir, storage_options, dirPath in rows:
+        keep = preserve_data or (dmtype == dmactions_types.SIG and storage_options == "KI")
+        proton = pk in proton_pks
+        diskspace = diskspace or 0
+        for key, path in fileservers:
+            if (key, dmtype) not in usage:
+                continue
+            in_expDir = bool(expDir and expDir.startswith(path))
+            in_reportDir = bool(dirPath and dirPath.startswith(path))
+
+            if dmtype == dmactions_types.SIG or (dmtype == dmactions_types.BASE and proton):
+                if in_expDir:
+                    for index in ((0, 1) if keep else (0,)):
+                        once = (key, dmtype, exp_pk, index)
+                        if once not in newest or newest[once][0] < pk:
+                            newest[once] = (pk, diskspace)
+                continue
+
+            if dmtype == dmactions_types.INTR and proton:
+                size = 0.02 * diskspace * in_expDir + 0.98 * diskspace * in_reportDir
+            elif dmtype == dmactions_types.BASE:
+                # exclude results that were re-analyzed from-basecalling (have parentResult)
+                size = diskspace if in_reportDir and parent is None else 0
+            else:
+                size = diskspace if in_reportDir else 0
+
+            if size:
+                usage[(key, dmtype)][0] += size
+                if keep:
+                    usage[(key, dmtype)][1] += size
+
+    for (key, dmtype, exp_pk, index), (pk, diskspace) in newest.iteritems():
+        usage[(key, dmtype)][index] += diskspace
+    return usage
 
-    expDir_objs = dmfilestats.filter(result__experiment__expDir__startswith=fs_path).order_by('-pk')
-    reportDir_objs = dmfilestats.filter(result__reportstorage__dirPath__startswith=fs_path).order_by('-pk')
 
-    for dmtype in dmactions_types.FILESET_TYPES:
+def calculate_diskspace_by_path(dmfilestats, fs_path):
+    '''
+    Calculates dmfilestats diskspace on given path, see _calculate_diskusage.
+    '''
+    rows, proton_pks = _diskusage_rows(dmfilestats)
+    usage = _calculate_diskusage(rows, proton_pks, [(fs_path, fs_path)])
+    return dict((dmtype, usage[(fs_path, dmtype)][0]) for dmtype in dmactions_types.FILESET_TYPES)
+
+
+# --------------------------------------------------#
+# DMDiskUsage summary table
+# Totals per FileServer and category are changed by the difference of the usage of the affected
+# Experiments before and after a DMFileStat is saved or deleted. Inside a batch (every celery task
+# runs in one) the difference is applied once per Experiment when the batch ends. Changes the
+# signals do not see, like queryset updates or Experiment storage_options edits, are corrected by
+# reconcile_diskusage.
+# --------------------------------------------------#
+
+def _fileservers():
+    return list(FileServer.objects.values_list('pk', 'filesPrefix'))
+
+
+def experiments_diskusage(experiment_pks):
+    '''Returns {(fileserver pk, dmtype): [diskspace, keep diskspace]} used by the sets of experiments'''
+    if not experiment_pks:
+        return {}
+    dmfilestats = DMFileStat.objects.filter(action_state__in=DISKUSAGE_STATES,
+                                            result__experiment__in=list(experiment_pks))
+    rows, proton_pks = _diskusage_rows(dmfilestats)
+    return _calculate_diskusage(rows, proton_pks, _fileservers())
+
+
+def diskusage_delta(before, after):
+    '''Returns {key: (diskspace, keep diskspace)} changed between two experiments_diskusage results'''
+    delta = {}
+    for key in set(before) | set(after):
+        old = before.get(key, (0, 0))
+        new = after.get(key, (0, 0))
+        if new[0] != old[0] or new[1] != old[1]:
+            delta[key] = (new[0] - old[0], new[1] - old[1])
+    return delta
+
+
+def apply_diskusage_change(before, after):
+    '''Adds the difference of two experiments_diskusage results to the DMDiskUsage table'''
+    for (fileserver, dmtype), delta in diskusage_delta(before, after).iteritems():
+        updated = DMDiskUsage.objects.filter(fileserver_id=fileserver, dmfileset_type=dmtype).update(
+            diskspace=F('diskspace') + delta[0], keep_diskspace=F('keep_diskspace') + delta[1],
+            updated=timezone.now())
+        if not updated:
+            # no totals for this file server yet, compute them all, the change is included
+            reconcile_diskusage()
+            return
+
+
+# per thread experiments: {experiment pk: [changes in progress, usage before the next change is applied]}
+# and batch: {experiment pk: usage before the first change of the batch} while a batch is open
+_pending = threading.local()
+
+
+def _pending_changes():
+    if not hasattr(_pending, 'experiments'):
+        _pending.experiments = {}
+    return _pending.experiments
+
+
+def _sum_diskusage(usages):
+    total = {}
+    for usage in usages:
+        for key, (diskspace, keep_diskspace) in usage.iteritems():
+            value = total.setdefault(key, [0.0, 0.0])
+            value[0] += diskspace
+            value[1] += keep_diskspace
+    return total
+
+
+def _begin_change(experiment_pks):
+    batch = getattr(_pending, 'batch', None)
+    if batch is not None:
+        # usage before the first change of the batch, the batch applies all changes at its end,
+        # experiments tracked since before the batch began are applied when that tracking ends
+        pending = _pending_changes()
+        for experiment_pk in experiment_pks:
+            if experiment_pk not in batch and experiment_pk not in pending:
+                batch[experiment_pk] = experiments_diskusage([experiment_pk])
+        return
+    pending = _pending_changes()
+    for experiment_pk in experiment_pks:
+        if experiment_pk in pending:
+            pending[experiment_pk][0] += 1
+        else:
+            pending[experiment_pk] = [1, experiments_diskusage([experiment_pk])]
 
-        # find proton fullchip data
-        proton_chips = Chip.objects.filter(instrumentType__in=['proton', 'S5']).values_list('name', flat=True)
-        proton_filestats = dmfilestats.filter(
-            result__experiment__chipType__in=proton_chips).exclude(result__metaData__contains='thumb')
 
-        if dmtype == dmactions_types.SIG:
-            values = expDir_objs.filter(dmfileset__type=dmtype).values(
-                'result__experiment__pk', 'diskspace').distinct()
-            ret[dmtype] = sum(v['diskspace'] for v in _unique_experiment(values) if v['diskspace'])
+def _end_change(experiment_pks):
+    '''
+    Applies the change of the usage of experiments since the last applied change.
+    Changes in progress can end in any order, e.g. the post_delete signals of a cascade
+    come after all rows are deleted, each change is only applied once.
+    '''
+    if getattr(_pending, 'batch', None) is not None:
+        return
+    pending = _pending_changes()
+    for experiment_pk in experiment_pks:
+        if experiment_pk not in pending:
+            continue
+        entry = pending[experiment_pk]
+        after = experiments_diskusage([experiment_pk])
+        apply_diskusage_change(entry[1], after)
+        entry[0] -= 1
+        entry[1] = after
+        if entry[0] <= 0:
+            del pending[experiment_pk]
+
+
+@contextmanager
+def diskusage_tracking(experiment_pks):
+    '''Updates the DMDiskUsage table for changes made in the block to the sets of experiments'''
+    _begin_change(experiment_pks)
+    try:
+        yield
+    finally:
+        _end_change(experiment_pks)
 
-        if dmtype == dmactions_types.OUT:
-            ret[dmtype] = reportDir_objs.filter(
-                dmfileset__type=dmtype).aggregate(sum=Sum('diskspace'))['sum'] or 0
 
-        if dmtype == dmactions_types.BASE:
-            # Proton fullchip sets are in exp folder
-            values = expDir_objs.filter(dmfileset__type=dmtype, pk__in=proton_filestats).values(
-                'result__experiment__pk', 'diskspace').distinct()
-            proton_diskspace = sum(v['diskspace'] for v in _unique_experiment(values) if v['diskspace'])
+def begin_diskusage_batch():
+    '''Collects the DMDiskUsage changes of this thread until the matching end_diskusage_batch'''
+    _pending.batch_depth = getattr(_pending, 'batch_depth', 0) + 1
+    if _pending.batch_depth == 1:
+        _pending.batch = {}
 
-            # PGM and thumbnail Basecalling Input are in report folder
-            objs = reportDir_objs.filter(
-                dmfileset__type=dmtype, result__parentResult__isnull=True).exclude(pk__in=proton_filestats)
-            diskspace = objs.aggregate(sum=Sum('diskspace'))['sum'] or 0
 
-            ret[dmtype] = proton_diskspace + diskspace
+def end_diskusage_batch():
+    '''Applies the changes collected since begin_diskusage_batch, once for all changed experiments'''
+    depth = getattr(_pending, 'batch_depth', 0) - 1
+    if depth > 0:
+        _pending.batch_depth = depth
+        return
+    _pending.batch_depth = 0
+    before = getattr(_pending, 'batch', None)
+    _pending.batch = None
+    if before:
+        apply_diskusage_change(_sum_diskusage(before.values()), experiments_diskusage(before.keys()))
 
-        if dmtype == dmactions_types.INTR:
-            # Proton fullchip sets about 2% in expDir, the rest in report folder
-            values = expDir_objs.filter(dmfileset__type=dmtype, pk__in=proton_filestats).values(
-                'result__experiment__pk', 'diskspace').distinct()
-            proton_diskspace = sum(0.02 * v['diskspace'] for v in values if v['diskspace'])
 
-            values = reportDir_objs.filter(dmfileset__type=dmtype, pk__in=proton_filestats).values(
-                'result__experiment__pk', 'diskspace').distinct()
-            proton_diskspace += sum(0.98 * v['diskspace'] for v in values if v['diskspace'])
+@contextmanager
+def diskusage_batch():
+    '''Updates the DMDiskUsage table once for all DMFileStat changes made in the block'''
+    begin_diskusage_batch()
+    try:
+        yield
+    finally:
+        end_diskusage_batch()
 
-            # PGM and thumbnail Intermediate Files are in report folder
-            objs = reportDir_objs.filter(dmfileset__type=dmtype).exclude(pk__in=proton_filestats)
-            diskspace = objs.aggregate(sum=Sum('diskspace'))['sum'] or 0
 
-            ret[dmtype] = proton_diskspace + diskspace
+@task_prerun.connect(dispatch_uid="diskusage_task_prerun")
+def _task_diskusage_batch_begin(**kwargs):
+    begin_diskusage_batch()
+
 
-    return ret
+@task_postrun.connect(dispatch_uid="diskusage_task_postrun")
+def _task_diskusage_batch_end(**kwargs):
+    try:
+        end_diskusage_batch()
+    except:
+        logger.error(traceback.format_exc(), extra=logid)
 
 
-def get_usefull_stats():
+def _dmfilestat_experiments(dmfilestat):
+    '''Experiments of the saved and the new result of dmfilestat'''
+    lookups = []
+    if dmfilestat.result_id:
+        lookups.append(Q(pk=dmfilestat.result_id))
+    if dmfilestat.pk:
+        lookups.append(Q(dmfilestat__pk=dmfilestat.pk))
+    if not lookups:
+        return set()
+    experiment_pks = set(Results.objects.filter(reduce(operator.or_, lookups)).values_list('experiment', flat=True))
+    experiment_pks.discard(None)
+    return experiment_pks
+
+
+def diskusage_before_change(dmfilestat):
+    '''DMFileStat pre_save and pre_delete: keeps the disk usage of the affected experiments'''
+    try:
+        experiment_pks = _dmfilestat_experiments(dmfilestat)
+        _begin_change(experiment_pks)
+        dmfilestat._diskusage_experiments = experiment_pks
+    except:
+        logger.error(traceback.format_exc(), extra=logid)
+
+
+def diskusage_after_change(dmfilestat):
+    '''DMFileStat post_save and post_delete: updates the DMDiskUsage table'''
+    try:
+        _end_change(dmfilestat.__dict__.pop('_diskusage_experiments', ()))
+    except:
+        logger.error(traceback.format_exc(), extra=logid)
 
-    dmfilestats = DMFileStat.objects.filter(action_state__in=['L', 'S', 'N', 'A'])
-    stats = {}
-    for fs in FileServer.objects.all():
-        if os.path.exists(fs.filesPrefix):
-            stats[fs.filesPrefix] = {}
-            stats[fs.filesPrefix]['Total'] = calculate_diskspace_by_path(dmfilestats, fs.filesPrefix)
 
-            # get sets marked Keep
-            keepers = dmfilestats.filter(preserve_data=True) | dmfilestats.filter(
-                dmfileset__type=dmactions_types.SIG, result__experiment__storage_options="KI")
-            stats[fs.filesPrefix]['Keep'] = calculate_diskspace_by_path(keepers, fs.filesPrefix)
+def reconcile_diskusage():
+    '''Recomputes the DMDiskUsage table from all DMFileStats, returns usage as experiments_diskusage'''
+    dmfilestats = DMFileStat.objects.filter(action_state__in=DISKUSAGE_STATES)
+    rows, proton_pks = _diskusage_rows(dmfilestats)
+    usage = _calculate_diskusage(rows.iterator(), proton_pks, _fileservers())
+    with transaction.atomic():
+        for (fileserver, dmtype), (diskspace, keep_diskspace) in usage.iteritems():
+            obj, created = DMDiskUsage.objects.get_or_create(fileserver_id=fileserver, dmfileset_type=dmtype)
+            obj.diskspace = diskspace
+            obj.keep_diskspace = keep_diskspace
+            obj.save()
+    return usage
 
+
+def get_diskusage_summary():
+    '''
+    Returns {filesPrefix: {dmtype: {'Total': megabytes, 'Keep': megabytes}}} from the DMDiskUsage table
+    '''
+    if not DMDiskUsage.objects.exists():
+        reconcile_diskusage()
+    summary = {}
+    for path, dmtype, diskspace, keep_diskspace in DMDiskUsage.objects.values_list(
+            'fileserver__filesPrefix', 'dmfileset_type', 'diskspace', 'keep_diskspace'):
+        summary.setdefault(path, {})[dmtype] = {'Total': diskspace, 'Keep': keep_diskspace}
+    return summary
+
+
+def get_usefull_stats():
+
+    stats = {}
+    for path, usage in get_diskusage_summary().iteritems():
+        if os.path.exists(path):
+            stats[path] = {
+                'Total': dict((dmtype, value['Total']) for dmtype, value in usage.iteritems()),
+                'Keep': dict((dmtype, value['Keep']) for dmtype, value in usage.iteritems()),
+            }
     return stats
 
 
 def get_keepers_diskspace(fs_path):
     ''' Returns how much space on fs_path is taken up by data marked Keep '''
-    dmfilestats = DMFileStat.objects.filter(action_state__in=['L', 'S', 'N', 'A'])
-    keepers = dmfilestats.filter(preserve_data=True) | dmfilestats.filter(
-        dmfileset__type=dmactions_types.SIG, result__experiment__storage_options="KI")
-    keepers_diskspace = calculate_diskspace_by_path(keepers, fs_path)
-    return keepers_diskspace
+    usage = get_diskusage_summary().get(fs_path, {})
+    return dict((dmtype, usage[dmtype]['Keep'] if dmtype in usage else 0) for dmtype in dmactions_types.FILESET_TYPES)
 
 
-def update_diskspace(dmfilestat, cached=None):
-    '''Update diskspace field in dmfilestat object'''
+def update_diskspace(dmfilestat, cached=None, manifest=None):
+    '''Update diskspace field in dmfilestat object.
+    The FileManifest lists the files, their sizes are read from the filesystem since files
+    can grow in place without changing their directory'''
     try:
         # search both results directory and raw data directory
         search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
 
-        if not cached:
-            cached = dm_utils.get_walk_filelist(search_dirs, list_dir=dmfilestat.result.get_report_dir())
+        if not cached and manifest is None:
+            manifest = dm_utils.get_file_manifest(
+                search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
+        if manifest is not None:
+            cached = manifest.filelist()
 
         total_size = 0
 
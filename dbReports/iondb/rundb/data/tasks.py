@@ -85,11 +85,12 @@ def delete_action(user, user_comment, dmfilestat, lockfile=None, msg_banner=Fals
         raise
 
 
-def archive_action(user, user_comment, dmfilestat, lockfile=None, msg_banner=False):
+def archive_action(user, user_comment, dmfilestat, lockfile=None, msg_banner=False, concurrent_actions=1):
     ''' Archive Action by wrapping invocation with celery task for sync / async execution'''
     try:
         backup_directory = dmfilestat.archivepath if dmfilestat.action_state == 'SA' else None
-        dmactions.archive(user, user_comment, dmfilestat, lockfile, msg_banner, backup_directory)
+        dmactions.archive(user, user_comment, dmfilestat, lockfile, msg_banner, backup_directory,
+                          concurrent_actions=concurrent_actions)
     except:
         raise
 
@@ -117,9 +118,9 @@ def update_dmfilestats_diskspace(dmfilestat):
     ''' Task to update DMFileStat.diskspace '''
     search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
     try:
-        cached_file_list = dm_utils.get_walk_filelist(
-            search_dirs, list_dir=dmfilestat.result.get_report_dir())
-        dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_list)
+        manifest = dm_utils.get_file_manifest(
+            search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
+        dmfilestat_utils.update_diskspace(dmfilestat, manifest=manifest)
     except:
         logger.error(traceback.format_exc(), extra=logid)
         raise
@@ -136,11 +137,11 @@ def update_dmfilestat_diskusage(resultpk):
     try:
         result = Results.objects.get(pk=resultpk)
         search_dirs = [result.get_report_dir(), result.experiment.expDir]
-        cached_file_list = dm_utils.get_walk_filelist(
+        manifest = dm_utils.get_file_manifest(
             search_dirs, list_dir=result.get_report_dir(), save_list=True)
         for dmtype in FILESET_TYPES:
             dmfilestat = result.get_filestat(dmtype)
-            dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_list)
+            dmfilestat_utils.update_diskspace(dmfilestat, manifest=manifest)
     except SoftTimeLimitExceeded:
         logger.warn("Time exceeded update_diskusage for (%d) %s" %
                     (resultpk, result.resultsName), extra=logid)
@@ -175,14 +176,26 @@ def backfill_dmfilestats_diskspace():
         dmfilestat = dmfilestats[0]
         search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
         try:
-            cached_file_list = dm_utils.get_walk_filelist(
+            manifest = dm_utils.get_file_manifest(
                 search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
-            dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_list)
+            dmfilestat_utils.update_diskspace(dmfilestat, manifest=manifest)
         except:
             logger.error(traceback.format_exc(), extra=logid)
             raise
 
 
+@periodic_task(run_every=timedelta(hours=1), expires=600, queue="periodic")
+def reconcile_dm_diskusage():
+    ''' Recomputes the per FileServer disk usage summary from all DMFileStats.
+        Corrects changes the DMFileStat signals do not see, like queryset updates
+    '''
+    try:
+        dmfilestat_utils.reconcile_diskusage()
+    except:
+        logger.error(traceback.format_exc(), extra=logid)
+        raise
+
+
 @app.task
 def save_serialized_json(resultpk):
     ''' Quick task to serialize and save in a json file all result-related dbase objects '''
@@ -0,0 +1 @@
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
@@ -0,0 +1,101 @@
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+import csv
+import cStringIO
+from django.test import SimpleTestCase
+
+from iondb.rundb.models import Results
+from iondb.rundb.data import views
+
+
+class Related(object):
+
+    def __init__(self, objs):
+        self.objs = objs
+
+    def all(self):
+        return list(self.objs)
+
+
+class Fake(object):
+    '''Model instance stand-in, fields not set are returned as "<field>_<pk>"'''
+
+    def __init__(self, pk, **kwargs):
+        self.pk = pk
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return '%s_%s' % (name, self.pk)
+
+    def get_sample(self):
+        return 'sample_%s' % self.pk
+
+
+class FakeQuerySet(object):
+    '''The part of a Results queryset used by Results.iter_pretty_table'''
+
+    def __init__(self, objs):
+        self.objs = objs
+        self.batches = []
+
+    def __iter__(self):
+        return iter(self.objs)
+
+    def values_list(self, field, flat=False):
+        return FakeQuerySet([obj.pk for obj in self.objs])
+
+    def iterator(self):
+        return iter(self.objs)
+
+    def filter(self, pk__in):
+        self.batches.append(len(pk__in))
+        # a database returns the batch in its own order
+        return sorted((obj for obj in self.objs if obj.pk in pk__in), key=lambda obj: -obj.pk)
+
+
+def fake_result(pk, tfs=1):
+    plugin = Fake(pk, plugin=Fake(pk, name='plugin_%d' % pk), store={'value': pk, 'name': u'r\xe9sult'})
+    return Fake(
+        pk,
+        resultsName='Auto_%d, "quoted"' % pk,
+        experiment=Fake(pk, notes='line 1\nline 2'),
+        tfmetrics_set=Related([Fake(pk * 10 + i) for i in range(tfs)]),
+        libmetrics_set=Related([Fake(pk)] if pk % 3 else []),
+        analysismetrics_set=Related([Fake(pk)] if pk % 2 else []),
+        pluginresult_set=Related([plugin] if pk % 4 else []))
+
+
+def current_export(objs):
+    '''csv as written by the export before it was streamed'''
+    out = cStringIO.StringIO()
+    csv.writer(out).writerows(Results.to_pretty_table(objs))
+    return out.getvalue()
+
+
+class StreamingCSVExportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.results = [fake_result(pk, tfs=pk % 3) for pk in range(1, 1200)]
+
+    def test_stream_matches_current_export(self):
+        qset = FakeQuerySet(self.results)
+        streamed = ''.join(views._streamCSV(qset, chunk_size=4096))
+        self.assertEqual(streamed, current_export(self.results))
+        # results are loaded in batches
+        self.assertEqual(qset.batches, [Results.PRETTY_TABLE_BATCH] * 2 + [1199 - 2 * Results.PRETTY_TABLE_BATCH])
+
+    def test_stream_keeps_queryset_order_and_duplicates(self):
+        objs = self.results[:10] + self.results[:3] + list(reversed(self.results[10:20]))
+        streamed = ''.join(views._streamCSV(FakeQuerySet(objs)))
+        self.assertEqual(streamed, current_export(objs))
+
+    def test_chunk_size(self):
+        chunks = list(views._iterCSV(Results.to_pretty_table(self.results), chunk_size=4096))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assertTrue(4096 <= len(chunk) < 2 * 4096)
+        self.assertEqual(''.join(chunks), current_export(self.results))
+
+    def test_empty(self):
+        self.assertEqual(''.join(views._streamCSV(FakeQuerySet([]))), current_export([]))
@@ -0,0 +1,259 @@
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+import random
+from celery.signals import task_prerun, task_postrun
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from iondb.rundb.data import dmactions_types
+from iondb.rundb.data import dmfilestat_utils
+from iondb.rundb.models import (Experiment, Results, ReportStorage, Location, FileServer, Chip, DMFileSet,
+                                DMFileStat, DMDiskUsage, on_result_delete)
+
+FILESERVERS = [(1, '/results/'), (2, '/rawdata/'), (3, '/results2/')]
+PATHS = ['/results/', '/rawdata/', '/results2/', '/other/', None]
+
+
+class DiskUsageTest(SimpleTestCase):
+
+    '''The DMDiskUsage totals changed per experiment add up to the totals computed from all sets'''
+
+    def setUp(self):
+        self.rng = random.Random(5)
+        self.next_pk = 1
+        self.proton_experiments = set(range(0, 40, 3))
+        self.rows = {}
+        for exp_pk in range(40):
+            for i in range(self.rng.randint(0, 8)):
+                self.add_row(exp_pk)
+
+    def add_row(self, exp_pk):
+        pk = self.next_pk
+        self.next_pk += 1
+        expDir = self.rng.choice(PATHS[:3]) + 'exp_%d' % exp_pk
+        reportDir = self.rng.choice(PATHS)
+        self.rows[pk] = [
+            pk,
+            self.rng.choice([None, 0, self.rng.uniform(1, 5000)]),  # diskspace
+            self.rng.random() < 0.3,                                # preserve_data
+            self.rng.choice(dmactions_types.FILESET_TYPES),
+            self.rng.choice([None, None, 7]),                      # parentResult
+            exp_pk,
+            expDir,
+            self.rng.choice(['KI', 'D', 'A']),                      # storage_options
+            reportDir and reportDir + 'report_%d' % pk,
+        ]
+
+    def usage(self, exp_pk=None):
+        rows = [row for row in self.rows.values() if exp_pk is None or row[5] == exp_pk]
+        proton_pks = set(row[0] for row in rows if row[5] in self.proton_experiments)
+        return dmfilestat_utils._calculate_diskusage(rows, proton_pks, FILESERVERS)
+
+    def change(self, exp_pk):
+        rows = [pk for pk, row in self.rows.items() if row[5] == exp_pk]
+        action = self.rng.choice(['add', 'delete', 'diskspace', 'keep', 'storage'] if rows else ['add'])
+        if action == 'add':
+            self.add_row(exp_pk)
+        elif action == 'delete':
+            del self.rows[self.rng.choice(rows)]
+        elif action == 'diskspace':
+            self.rows[self.rng.choice(rows)][1] = self.rng.uniform(0, 5000)
+        elif action == 'keep':
+            row = self.rows[self.rng.choice(rows)]
+            row[2] = not row[2]
+        elif action == 'storage':
+            for pk in rows:
+                self.rows[pk][7] = 'KI' if self.rows[pk][7] != 'KI' else 'D'
+
+    def assertUsageEqual(self, usage, expected):
+        self.assertEqual(sorted(usage), sorted(expected))
+        for key in expected:
+            self.assertAlmostEqual(usage[key][0], expected[key][0], places=6)
+            self.assertAlmostEqual(usage[key][1], expected[key][1], places=6)
+
+    def test_incremental_matches_full_recompute(self):
+        totals = dict((key, list(value)) for key, value in self.usage().items())
+        for i in range(500):
+            exp_pk = self.rng.randrange(45)
+            before = self.usage(exp_pk)
+            self.change(exp_pk)
+            for key, delta in dmfilestat_utils.diskusage_delta(before, self.usage(exp_pk)).items():
+                totals[key][0] += delta[0]
+                totals[key][1] += delta[1]
+        self.assertUsageEqual(totals, self.usage())
+
+    def test_usage_is_sum_of_experiments(self):
+        totals = dict((key, [0.0, 0.0]) for key in self.usage())
+        for exp_pk in range(40):
+            for key, value in self.usage(exp_pk).items():
+                totals[key][0] += value[0]
+                totals[key][1] += value[1]
+        self.assertUsageEqual(totals, self.usage())
+
+    def test_signal_processing_counted_once_per_experiment(self):
+        self.rows = {}
+        sig = dmactions_types.SIG
+        self.rows[1] = [1, 100.0, False, sig, None, 1, '/rawdata/exp_1', 'KI', '/results/report_1']
+        self.rows[2] = [2, 300.0, False, sig, None, 1, '/rawdata/exp_1', 'KI', '/results/report_2']
+        self.rows[3] = [3, 50.0, False, sig, None, 2, '/rawdata/exp_2', 'D', '/results/report_3']
+        usage = self.usage()
+        # newest set of each experiment, Keep is the experiment storage option for signal processing
+        self.assertEqual(usage[(2, sig)], [350.0, 300.0])
+        self.rows[3][2] = True
+        self.assertEqual(self.usage()[(2, sig)], [350.0, 350.0])
+        self.assertEqual(usage[(1, sig)], [0.0, 0.0])
+
+    def test_no_change(self):
+        self.assertEqual(dmfilestat_utils.diskusage_delta(self.usage(3), self.usage(3)), {})
+
+
+class DiskUsageTableTest(TestCase):
+
+    '''The DMDiskUsage table kept by the DMFileStat signals equals the table recomputed by reconcile_diskusage'''
+
+    def setUp(self):
+        location = Location.objects.create(name='Home', defaultlocation=True)
+        FileServer.objects.create(name='results', filesPrefix='/results/', location=location)
+        FileServer.objects.create(name='rawdata', filesPrefix='/rawdata/', location=location)
+        storage = ReportStorage.objects.create(name='Home', webServerPath='/output', dirPath='/results/analysis/output')
+        Chip.objects.create(name='P1.1.17', slots=1, instrumentType='proton')
+        Chip.objects.create(name='318', slots=1, instrumentType='pgm')
+
+        Experiment.objects.bulk_create([
+            Experiment(expDir='%s/exp_%d' % (['/rawdata', '/results'][i % 2], i), expName='exp_%d' % i,
+                       pgmName='PGM', unique='exp_%d' % i, date=timezone.now(), chipType=['P1.1.17', '318'][i % 3 == 0],
+                       cycles=50, flows=200, storage_options=['KI', 'D'][i % 2])
+            for i in range(6)])
+        Results.objects.bulk_create([
+            Results(experiment=experiment, resultsName='Auto_%d_%d' % (experiment.pk, i), reportLink='/output/Home/',
+                    status='Completed', analysisVersion='', processedCycles=50, processedflows=200,
+                    framesProcessed=0, timeToComplete='0', reportstorage=storage)
+            for experiment in Experiment.objects.all() for i in range(2)])
+
+        self.dmfilesets = dict((typeStr, DMFileSet.objects.create(type=typeStr, version='test'))
+                               for typeStr in dmactions_types.FILESET_TYPES)
+        DMFileStat.objects.bulk_create([
+            DMFileStat(result=result, dmfileset=dmfileset, action_state='L', diskspace=100.0 * result.pk + len(typeStr),
+                       preserve_data=result.pk % 3 == 0)
+            for result in Results.objects.all() for typeStr, dmfileset in self.dmfilesets.items()])
+        dmfilestat_utils.reconcile_diskusage()
+        # deleting a result removes its report directory
+        post_delete.disconnect(sender=Results, dispatch_uid="delete_result")
+
+    def tearDown(self):
+        post_delete.connect(on_result_delete, sender=Results, dispatch_uid="delete_result")
+
+    def table(self):
+        return dict(((fileserver, dmtype), (diskspace, keep_diskspace)) for fileserver, dmtype, diskspace, keep_diskspace
+                    in DMDiskUsage.objects.values_list('fileserver', 'dmfileset_type', 'diskspace', 'keep_diskspace'))
+
+    def assertTableCurrent(self):
+        table = self.table()
+        expected = dmfilestat_utils.reconcile_diskusage()
+        self.assertEqual(sorted(table), sorted(expected))
+        for key in expected:
+            self.assertAlmostEqual(table[key][0], expected[key][0], places=6)
+            self.assertAlmostEqual(table[key][1], expected[key][1], places=6)
+
+    def usage(self):
+        usage = dmfilestat_utils.experiments_diskusage(Experiment.objects.values_list('pk', flat=True))
+        return dict((key, tuple(value)) for key, value in usage.items())
+
+    def dmfilestats(self, dmtype, **kwargs):
+        return DMFileStat.objects.filter(dmfileset__type=dmtype, **kwargs).order_by('pk')
+
+    def test_save(self):
+        dmfilestat = self.dmfilestats(dmactions_types.OUT)[0]
+        dmfilestat.diskspace = 12345.0
+        dmfilestat.save()
+        self.assertTableCurrent()
+
+        dmfilestat = self.dmfilestats(dmactions_types.SIG)[0]
+        dmfilestat.preserve_data = not dmfilestat.preserve_data
+        dmfilestat.diskspace = 50000.0
+        dmfilestat.save()
+        self.assertTableCurrent()
+
+        dmfilestat = self.dmfilestats(dmactions_types.BASE)[3]
+        dmfilestat.action_state = 'DD'
+        dmfilestat.save()
+        self.assertTableCurrent()
+
+        # moved to a result of another experiment, both experiments change
+        dmfilestat = self.dmfilestats(dmactions_types.INTR)[0]
+        dmfilestat.result = Results.objects.exclude(experiment=dmfilestat.result.experiment)[0]
+        dmfilestat.save()
+        self.assertTableCurrent()
+
+        DMFileStat.objects.create(result=Results.objects.all()[2], dmfileset=self.dmfilesets[dmactions_types.SIG],
+                                  action_state='L', diskspace=777.0)
+        self.assertTableCurrent()
+
+    def test_delete(self):
+        self.dmfilestats(dmactions_types.OUT)[1].delete()
+        self.assertTableCurrent()
+        self.dmfilestats(dmactions_types.SIG).filter(result__experiment__expDir__startswith='/rawdata')[0].delete()
+        self.assertTableCurrent()
+
+    def test_cascade_delete(self):
+        Results.objects.all()[0].delete()
+        self.assertTableCurrent()
+        Experiment.objects.filter(expDir__startswith='/rawdata')[0].delete()
+        self.assertTableCurrent()
+        Experiment.objects.all().delete()
+        self.assertTableCurrent()
+
+    def test_queryset_update(self):
+        dmfilestat = self.dmfilestats(dmactions_types.SIG)[0]
+        dmfilestat.setactionstate('AD')
+        self.assertTableCurrent()
+
+        experiment_pks = list(Experiment.objects.values_list('pk', flat=True)[:3])
+        with dmfilestat_utils.diskusage_tracking(experiment_pks):
+            DMFileStat.objects.filter(result__experiment__in=experiment_pks).update(diskspace=1.0)
+        self.assertTableCurrent()
+
+        # not seen by the signals, corrected by the periodic reconcile
+        DMFileStat.objects.update(preserve_data=True)
+        self.assertNotEqual(self.table(), self.usage())
+        dmfilestat_utils.reconcile_diskusage()
+        self.assertEqual(self.table(), self.usage())
+
+    def save_all(self, diskspace):
+        for dmfilestat in self.dmfilestats(dmactions_types.OUT):
+            dmfilestat.diskspace = diskspace
+            dmfilestat.save()
+
+    def test_batch(self):
+        with CaptureQueriesContext(connection) as single:
+            self.save_all(10.0)
+        self.assertTableCurrent()
+
+        saves = self.dmfilestats(dmactions_types.OUT).count()
+        experiments = Experiment.objects.count()
+        table = self.table()
+        with dmfilestat_utils.diskusage_batch():
+            with CaptureQueriesContext(connection) as batched:
+                self.save_all(20.0)
+            with dmfilestat_utils.diskusage_batch():
+                Results.objects.all()[0].delete()
+            # applied when the outermost batch ends
+            self.assertEqual(self.table(), table)
+        self.assertTableCurrent()
+
+        # the sets, the experiment lookup and the update of each save, the usage of each experiment once
+        self.assertEqual(len(batched), 1 + 2 * saves + 3 * experiments)
+        self.assertTrue(len(batched) < len(single) / 2)
+
+    def test_task_batch(self):
+        table = self.table()
+        task_prerun.send(sender=None, task_id='1', task=None)
+        try:
+            self.save_all(30.0)
+            self.assertEqual(self.table(), table)
+            self.assertNotEqual(self.usage(), table)
+        finally:
+            task_postrun.send(sender=None, task_id='1', task=None)
+        self.assertTableCurrent()
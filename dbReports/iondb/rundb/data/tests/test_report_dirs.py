@@ -0,0 +1,74 @@
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+import shutil
+import tempfile
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from iondb.rundb.data import dmactions_types
+from iondb.rundb.models import Experiment, Results, ReportStorage, Location, Rig, DMFileSet, DMFileStat
+
+RESULTS = 500
+
+
+class ResultsReportDirsTest(TestCase):
+
+    '''Results.objects.with_report_dirs() resolves the report directories of a page of results in bulk'''
+
+    def setUp(self):
+        Location.objects.create(name='Home', defaultlocation=True)
+        Rig.objects.create(name='PGM_1', location=Location.objects.create(name='Lab'))
+        storage = ReportStorage.objects.create(name='Home', webServerPath='/output', dirPath='/results/analysis/output')
+        self.archive_dir = tempfile.mkdtemp()
+
+        # instruments PGM_0 and PGM_2 have no Rig, their experiments are in the default location
+        Experiment.objects.bulk_create([
+            Experiment(expDir='/results/exp_%d' % i, expName='exp_%d' % i, pgmName='PGM_%d' % (i % 3),
+                       unique='/results/exp_%d' % i, date=timezone.now(), chipType='318', cycles=50, flows=200)
+            for i in range(RESULTS)])
+        Results.objects.bulk_create([
+            Results(experiment=experiment, resultsName='Auto_%d' % experiment.pk, reportLink='/output/Home/Auto_%d/' %
+                    experiment.pk, status='Completed', analysisVersion='', processedCycles=50, processedflows=200,
+                    framesProcessed=0, timeToComplete='0', reportstorage=storage)
+            for experiment in Experiment.objects.all()])
+
+        dmfilesets = [DMFileSet.objects.create(type=typeStr, version='test') for typeStr in dmactions_types.FILESET_TYPES]
+        DMFileStat.objects.bulk_create([
+            DMFileStat(result=result, dmfileset=dmfileset, action_state='IG' if result.pk % 7 == 0 else 'L',
+                       archivepath=self.archive_dir if result.pk % 2 else None)
+            for result in Results.objects.all() for dmfileset in dmfilesets])
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def report_dirs(self, results):
+        with CaptureQueriesContext(connection) as queries:
+            report_dirs = [(result.pk, result.get_report_dir(), result.get_filestat(dmactions_types.OUT).pk)
+                           for result in results]
+        return report_dirs, len(queries)
+
+    def test_constant_queries(self):
+        counts = []
+        for n in (10, RESULTS):
+            report_dirs, count = self.report_dirs(Results.objects.with_report_dirs().order_by('pk')[:n])
+            self.assertEqual(len(report_dirs), n)
+            counts.append(count)
+        self.assertEqual(counts[0], counts[1])
+        # results, DMFileStats, Rigs and the default location
+        self.assertEqual(counts[1], 4)
+
+    def test_same_as_per_result(self):
+        expected, count = self.report_dirs(Results.objects.order_by('pk'))
+        self.assertTrue(count > RESULTS)
+        report_dirs, count = self.report_dirs(Results.objects.with_report_dirs().order_by('pk'))
+        self.assertEqual(report_dirs, expected)
+        self.assertTrue(any(report_dir == self.archive_dir for pk, report_dir, filestat in report_dirs))
+        self.assertEqual(set(report_dir.split('/')[-2] for pk, report_dir, filestat in report_dirs
+                             if report_dir != self.archive_dir), set(['Home', 'Lab']))
+
+    def test_filtered_queryset(self):
+        results = Results.objects.with_report_dirs().filter(experiment__pgmName='PGM_1')
+        report_dirs, count = self.report_dirs(results)
+        self.assertTrue(len(report_dirs) > 10)
+        self.assertEqual(count, 3)
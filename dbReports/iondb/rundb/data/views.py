@@ -47,7 +47,7 @@ from iondb.rundb.data.data_management import update_files_in_use
 from iondb.rundb.data import exceptions as DMExceptions
 from iondb.rundb.data.data_import import find_data_to_import, data_import
 from iondb.utils.files import get_disk_attributes_gb, is_mounted
-from iondb.rundb.data.dmfilestat_utils import dm_category_stats, get_keepers_diskspace
+from iondb.rundb.data.dmfilestat_utils import dm_category_stats, get_diskusage_summary
 
 from django.http import HttpResponse, HttpResponseServerError, HttpResponseNotFound
 from datetime import datetime
@@ -204,18 +204,42 @@ def data_table(request):
                               context_instance=RequestContext(request))
 
 
-def _makeCSVstr(object_list):
-    table = Results.to_pretty_table(object_list)
+# bytes of csv sent per chunk of the streamed exports
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def _iterCSV(rows, chunk_size=CSV_CHUNK_SIZE):
+    """Generator over the csv of rows, in chunks of about chunk_size bytes"""
     CSVstr = cStringIO.StringIO()
     writer = csv.writer(CSVstr)
-    writer.writerows(table)
-    CSVstr.seek(0)
-    return CSVstr
+    for row in rows:
+        writer.writerow(row)
+        if CSVstr.tell() >= chunk_size:
+            yield CSVstr.getvalue()
+            CSVstr.seek(0)
+            CSVstr.truncate()
+    if CSVstr.tell():
+        yield CSVstr.getvalue()
 
 
-def getCSV(request):
-    CSVstr = ""
+def _streamCSV(object_list, chunk_size=CSV_CHUNK_SIZE):
+    """Generator over the csv of Results.to_pretty_table(object_list), results are loaded in batches"""
+    try:
+        for chunk in _iterCSV(Results.iter_pretty_table(object_list), chunk_size):
+            yield chunk
+    except Exception as err:
+        # the response has started, the download ends short
+        logger.exception("During result CSV generation: %s" % err)
+        raise
 
+
+def _CSVresponse(object_list, filename):
+    ret = http.StreamingHttpResponse(_streamCSV(object_list), content_type='text/csv')
+    ret['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return ret
+
+
+def getCSV(request):
     if request.method == "GET":
         qDict = request.GET
     elif request.method == "POST":
@@ -295,15 +319,12 @@ def getCSV(request):
                 ))
             base_object_list = base_object_list.filter(qset)
         base_object_list.distinct()
-        CSVstr = _makeCSVstr(base_object_list)
 
     except Exception as err:
         logger.error("During result CSV generation: %s" % err)
         raise
-    ret = http.HttpResponse(CSVstr, mimetype='text/csv')
     now = str(datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
-    ret['Content-Disposition'] = 'attachment; filename=metrics_%s.csv' % now
-    return ret
+    return _CSVresponse(base_object_list, 'metrics_%s.csv' % now)
 
 
 def get_project_CSV(request, project_pk, result_pks):
@@ -312,11 +333,8 @@ def get_project_CSV(request, project_pk, result_pks):
     base_object_list = Results.objects.select_related('experiment').prefetch_related(
         'libmetrics_set', 'tfmetrics_set', 'analysismetrics_set', 'pluginresult_set__plugin')
     base_object_list = base_object_list.filter(id__in=result_ids).order_by('-timeStamp')
-    CSVstr = _makeCSVstr(base_object_list)
-    ret = http.HttpResponse(CSVstr, mimetype='text/csv')
-    ret['Content-Disposition'] = 'attachment; filename=%s_metrics_%s.csv' % (
-        projectName, str(datetime.now().strftime("%Y_%m_%d_%H_%M_%S")))
-    return ret
+    return _CSVresponse(base_object_list, '%s_metrics_%s.csv' % (
+        projectName, str(datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))))
 
 
 def projects(request):
@@ -1029,13 +1047,14 @@ def datamanagement(request):
 
     # Disk Usage section
     fs_stats = {}
+    # space used by data marked Keep, precomputed per file server
+    diskusage = get_diskusage_summary()
     for path in FileServer.objects.all().order_by('pk').values_list('filesPrefix', flat=True):
         try:
             if os.path.exists(path):
                 fs_stats[path] = get_disk_attributes_gb(path)
-                # get space used by data marked Keep
-                keeper_used = get_keepers_diskspace(path)
-                keeper_used = float(sum(keeper_used.values())) / 1024  # gbytes
+                keeper_used = diskusage.get(path, {})
+                keeper_used = float(sum(v['Keep'] for v in keeper_used.values())) / 1024  # gbytes
                 total_gb = fs_stats[path]['disksize']
                 fs_stats[path]['percentkeep'] = 100 * (keeper_used / total_gb) if total_gb > 0 else 0
         except:
@@ -70,7 +70,7 @@ from django.utils import timezone
 from django.core import urlresolvers
 from django.core.cache import cache
 from django.db import transaction
-from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from distutils.version import LooseVersion
 from iondb.celery import app as celery
@@ -1871,17 +1871,37 @@ class Experiment(models.Model):
         try:
             loc = Rig.objects.get(name=self.pgmName).location
         except Rig.DoesNotExist:
-            loc = Location.objects.filter(defaultlocation=True)
-            if not loc:
-                #if there is not a default, just take the first one
-                loc = Location.objects.all().order_by('pk')
-            if loc:
-                loc = loc[0]
-            else:
-                logger.critical("No Location objects exist!")
-                return False
+            loc = Experiment._fallback_location()
+        return loc
+
+    @staticmethod
+    def _fallback_location():
+        """Location of experiments whose instrument has no Rig"""
+        loc = Location.objects.filter(defaultlocation=True)
+        if not loc:
+            #if there is not a default, just take the first one
+            loc = Location.objects.all().order_by('pk')
+        if loc:
+            loc = loc[0]
+        else:
+            logger.critical("No Location objects exist!")
+            return False
         return loc
 
+    @staticmethod
+    def resolve_locations(experiments):
+        """Sets the location of experiments with one Rig query instead of one per experiment"""
+        experiments = [exp for exp in experiments if '_location' not in exp.__dict__]
+        if not experiments:
+            return
+        rigs = Rig.objects.filter(name__in=set(exp.pgmName for exp in experiments)).select_related('location')
+        locations = dict((rig.name, rig.location) for rig in rigs)
+        fallback = None
+        if any(exp.pgmName not in locations for exp in experiments):
+            fallback = Experiment._fallback_location()
+        for exp in experiments:
+            exp.__dict__['_location'] = locations.get(exp.pgmName, fallback)
+
     def save(self):
         """on save we need to sync up the log JSON and the other values that might have been set
         this was put in place primarily for the runtype field"""
@@ -2534,6 +2554,41 @@ class Lookup(object):
         return rows
 
 
+class ResultsQuerySet(models.query.QuerySet):
+
+    _with_report_dirs = False
+
+    def with_report_dirs(self):
+        '''
+        Results are resolved with Results.resolve_report_dirs when the queryset is evaluated,
+        get_report_dir() and get_filestat() then take no queries for a whole page of results.
+        Results read with iterator() are not resolved.
+        '''
+        clone = self._clone(_with_report_dirs=True)
+        if clone.query.select_related is not True:
+            clone = clone.select_related('experiment', 'reportstorage')
+        return clone
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_with_report_dirs', self._with_report_dirs)
+        return super(ResultsQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def _fetch_all(self):
+        resolve = self._with_report_dirs and self._result_cache is None
+        super(ResultsQuerySet, self)._fetch_all()
+        if resolve:
+            Results.resolve_report_dirs(self._result_cache)
+
+
+class ResultsManager(models.Manager):
+
+    def get_queryset(self):
+        return ResultsQuerySet(self.model, using=self._db)
+
+    def with_report_dirs(self):
+        return self.get_queryset().with_report_dirs()
+
+
 class Results(models.Model, Lookup):
 
     # FOREIGN KEY DEFINITIONS
@@ -2543,6 +2598,9 @@ class Results(models.Model, Lookup):
     # ForeignKey 'qualitymetrics_set' from QualityMetrics
     # ForeignKey 'pluginresult_set' from PluginResult
 
+    # results loaded at a time by iter_pretty_table
+    PRETTY_TABLE_BATCH = 500
+
     _CSV_METRICS = (("Report", "resultsName"),
                     ("Status", 'status'),
                     ("Flows", 'processedflows'),
@@ -2608,6 +2666,8 @@ class Results(models.Model, Lookup):
     # link for re-Analysis starting from a parent report
     parentResult = models.ForeignKey('self', null=True, blank=True, related_name='childResults_set', on_delete=models.SET_NULL)
 
+    objects = ResultsManager()
+
     def save(self, *args, **kwargs):
 
         super(Results, self).save(*args, **kwargs)
@@ -2647,8 +2707,34 @@ class Results(models.Model, Lookup):
                         pass
 
     def get_filestat(self, typeStr):
+        if '_filestats' in self.__dict__:
+            # set by resolve_report_dirs
+            return self._filestats.get(typeStr)
         return self.dmfilestat_set.filter(dmfileset__type=typeStr).first()
 
+    @classmethod
+    def resolve_report_dirs(cls, results):
+        '''
+        Loads the DMFileStats and the experiment locations of results with one query each,
+        instead of one per result in get_report_dir().
+        Results should have experiment and reportstorage selected, as by Results.objects.with_report_dirs()
+        '''
+        results = [result for result in results if '_filestats' not in result.__dict__]
+        if not results:
+            return
+        by_pk = {}
+        for result in results:
+            result._filestats = {}
+            by_pk.setdefault(result.pk, []).append(result)
+
+        # the first DMFileStat of each type, as returned by get_filestat()
+        dmfilestats = DMFileStat.objects.filter(result__in=by_pk.keys()).select_related('dmfileset').order_by('pk')
+        for dmfilestat in dmfilestats:
+            for result in by_pk[dmfilestat.result_id]:
+                result._filestats.setdefault(dmfilestat.dmfileset.type, dmfilestat)
+
+        Experiment.resolve_locations([result.experiment for result in results])
+
     @cached_property
     def isProton(self):
         if self.experiment:
@@ -3044,25 +3130,60 @@ class Results(models.Model, Lookup):
             keys.append(ele[0])
         return tuple(keys)
 
+    @classmethod
+    def pretty_table_headings(cls):
+        return (cls.get_keys(cls._CSV_METRICS)
+                + cls.get_keys(TFMetrics._CSV_METRICS)
+                + cls.get_keys(LibMetrics._CSV_METRICS)
+                + cls.get_keys(Experiment._CSV_METRICS)
+                + cls.get_keys(AnalysisMetrics._CSV_METRICS)
+                + cls.get_keys(PluginResult._CSV_METRICS))
+
+    @classmethod
+    def pretty_table_rows(cls, obj):
+        """table rows of one result, one row per test fragment"""
+        new = cls.get_tf_metrics(obj, cls.get_values(TFMetrics._CSV_METRICS))
+        if len(new) > 0:
+            new[0].extend(cls.get_lib_metrics(obj, cls.get_values(LibMetrics._CSV_METRICS)))
+            new[0].extend(cls.get_exp_metrics(obj, cls.get_values(Experiment._CSV_METRICS)))
+            new[0].extend(cls.get_analysis_metrics(obj, cls.get_values(AnalysisMetrics._CSV_METRICS)))
+            new[0].extend(cls.get_plugin_metrics(obj, cls.get_values(PluginResult._CSV_METRICS)))
+        return new
+
     @classmethod
     def to_pretty_table(cls, qset):
-        ret = [cls.get_keys(cls._CSV_METRICS)
-               + cls.get_keys(TFMetrics._CSV_METRICS)
-               + cls.get_keys(LibMetrics._CSV_METRICS)
-               + cls.get_keys(Experiment._CSV_METRICS)
-               + cls.get_keys(AnalysisMetrics._CSV_METRICS)
-               + cls.get_keys(PluginResult._CSV_METRICS)
-               ]
+        ret = [cls.pretty_table_headings()]
         for obj in qset:
-            new = cls.get_tf_metrics(obj, cls.get_values(TFMetrics._CSV_METRICS))
-            if len(new) > 0:
-                new[0].extend(cls.get_lib_metrics(obj, cls.get_values(LibMetrics._CSV_METRICS)))
-                new[0].extend(cls.get_exp_metrics(obj, cls.get_values(Experiment._CSV_METRICS)))
-                new[0].extend(cls.get_analysis_metrics(obj, cls.get_values(AnalysisMetrics._CSV_METRICS)))
-                new[0].extend(cls.get_plugin_metrics(obj, cls.get_values(PluginResult._CSV_METRICS)))
-            ret.extend(new)
+            ret.extend(cls.pretty_table_rows(obj))
         return ret
 
+    @classmethod
+    def iter_pretty_table(cls, qset, batch_size=PRETTY_TABLE_BATCH):
+        """
+        Generator over the rows of to_pretty_table(qset), in the order of qset.
+        Only batch_size results and their metrics are loaded at a time: the primary keys of qset are
+        read first, then each batch is fetched with the select_related and prefetch_related of qset.
+        """
+        yield cls.pretty_table_headings()
+        pks = []
+        for pk in qset.values_list('pk', flat=True).iterator():
+            pks.append(pk)
+            if len(pks) >= batch_size:
+                for row in cls._iter_pretty_table_batch(qset, pks):
+                    yield row
+                pks = []
+        for row in cls._iter_pretty_table_batch(qset, pks):
+            yield row
+
+    @classmethod
+    def _iter_pretty_table_batch(cls, qset, pks):
+        if not pks:
+            return
+        objs = dict((obj.pk, obj) for obj in qset.filter(pk__in=set(pks)))
+        for pk in pks:
+            for row in cls.pretty_table_rows(objs[pk]):
+                yield row
+
     class Meta:
         verbose_name_plural = "Results"
 
@@ -5255,8 +5376,10 @@ class DMFileStat (models.Model):
 
     def setpreserved(self, keep_flag):
         if self.dmfileset.type == dmactions_types.SIG:
-            self.result.experiment.storage_options = 'KI' if keep_flag else 'D'
-            self.result.experiment.save()
+            from iondb.rundb.data import dmfilestat_utils
+            with dmfilestat_utils.diskusage_tracking([self.result.experiment_id]):
+                self.result.experiment.storage_options = 'KI' if keep_flag else 'D'
+                self.result.experiment.save()
         else:
             self.preserve_data = keep_flag
             self.save()
@@ -5267,8 +5390,10 @@ class DMFileStat (models.Model):
             self.save()
             # update related dmfilestats
             if self.dmfileset.type == dmactions_types.SIG:
+                from iondb.rundb.data import dmfilestat_utils
                 exp_id = self.result.experiment_id
-                DMFileStat.objects.filter(dmfileset__type=dmactions_types.SIG, result__experiment__id=exp_id).update(action_state=state)
+                with dmfilestat_utils.diskusage_tracking([exp_id]):
+                    DMFileStat.objects.filter(dmfileset__type=dmactions_types.SIG, result__experiment__id=exp_id).update(action_state=state)
         else:
             raise Exception("Failed to set action_state. Invalid state: '%s'" % state)
 
@@ -5285,6 +5410,43 @@ class DMFileStat (models.Model):
         return bool(self.action_state in ['AG', 'DG', 'EG', 'SA', 'SE', 'SD', 'IG'])
 
 
+@receiver(pre_save, sender=DMFileStat, dispatch_uid="pre_save_dmfilestat")
+@receiver(pre_delete, sender=DMFileStat, dispatch_uid="pre_delete_dmfilestat")
+def on_dmfilestat_pre_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        from iondb.rundb.data import dmfilestat_utils
+        dmfilestat_utils.diskusage_before_change(instance)
+
+
+@receiver(post_save, sender=DMFileStat, dispatch_uid="post_save_dmfilestat")
+@receiver(post_delete, sender=DMFileStat, dispatch_uid="post_delete_dmfilestat")
+def on_dmfilestat_post_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        from iondb.rundb.data import dmfilestat_utils
+        dmfilestat_utils.diskusage_after_change(instance)
+
+
+class DMDiskUsage(models.Model):
+
+    """Megabytes used by the data management file sets of one category on a FileServer.
+    Updated from DMFileStat saves and deletes and recomputed periodically, see dmfilestat_utils.
+    """
+
+    fileserver = models.ForeignKey(FileServer, related_name='dmdiskusage_set')
+    dmfileset_type = models.CharField(max_length=48)
+    # sets in action states L, S, N, A
+    diskspace = models.FloatField(default=0.0)
+    # the part of diskspace marked Keep
+    keep_diskspace = models.FloatField(default=0.0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('fileserver', 'dmfileset_type'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.fileserver, self.dmfileset_type)
+
+
 class FileMonitor(models.Model):
 
     """Record the details of a file download from a remote server to the TS
@@ -29,6 +29,7 @@ def createReport_and_launch(exp, eas, resultsName, **kwargs):
     doThumbnail = kwargs.get('do_thumbnail', False)
     username = kwargs.get('username', '')
     plugins_list = kwargs.get('plugins', [])
+    reanalysis = kwargs.get('re_analysis', False)
 
     if blockArgs == 'fromWells':
         previousReport = kwargs.get('previousThumbReport', '') if doThumbnail else kwargs.get('previousReport', '')
@@ -47,7 +48,8 @@ def createReport_and_launch(exp, eas, resultsName, **kwargs):
         models.EventLog.objects.add_entry(result, msg, username)
 
         # create params
-        params = makeParams(exp, eas, result, blockArgs, doThumbnail, pathToData, previousReport, plugins_list, username)
+        params = makeParams(exp, eas, result, blockArgs, doThumbnail, pathToData, previousReport, plugins_list, username,
+                            reanalysis)
         params = json.dumps(params, cls=DjangoJSONEncoder, indent=1)
 
         logger.debug("Start Analysis on %s" % exp.expDir)
@@ -303,7 +305,8 @@ def launch_analysis_job(result, params, doThumbnail):
         raise Exception("Failed to contact job server.")
 
 
-def makeParams(exp, eas, result, blockArgs, doThumbnail, pathToData, previousReport='', plugins_list=[], username=''):
+def makeParams(exp, eas, result, blockArgs, doThumbnail, pathToData, previousReport='', plugins_list=[], username='',
+               reanalysis=False):
     """Build a dictionary of analysis parameters, to be passed to the job
     server when instructing it to run a report.  Any information that a job
     will need to be run must be constructed here and included inside the return.
@@ -451,6 +454,7 @@ def makeParams(exp, eas, result, blockArgs, doThumbnail, pathToData, previousRep
         'tmap_version': settings.TMAP_VERSION,
         'sam_parsed': True if os.path.isfile('/opt/ion/.ion-internal-server') else False,
         'username': username,
+        'reanalysis': reanalysis,
     }
 
     return ret
@@ -0,0 +1,82 @@
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+'''
+Process level cache of the report page sections read from the report directory.
+A section is stored with the (path, mtime, size) fingerprints of the files and directories it
+was built from, missing files included, and is only rebuilt when one of them changed.
+The other sections of the report stay cached.
+Sections are returned as copies, the report view adds values to the parsed data.
+'''
+import os
+import cPickle
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# sections kept per process, least recently used sections are dropped first
+MAX_SECTIONS = 5000
+
+
+def fingerprint(path):
+    '''Returns (path, mtime, size) of a file or directory, (path, None, None) if it does not exist'''
+    try:
+        st = os.stat(path)
+        return (path, st.st_mtime, st.st_size)
+    except OSError:
+        return (path, None, None)
+
+
+class SectionCache(object):
+
+    def __init__(self, max_sections=MAX_SECTIONS):
+        self.max_sections = max_sections
+        self._sections = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, paths, build):
+        '''
+        Returns a copy of the section cached for key, build() is called to make the section if
+        there is none or if one of paths changed since it was built.
+        '''
+        fingerprints = tuple(fingerprint(path) for path in paths)
+        with self._lock:
+            entry = self._sections.pop(key, None)
+            if entry and entry[0] == fingerprints:
+                self._sections[key] = entry
+                self.hits += 1
+                return cPickle.loads(entry[1])
+            self.misses += 1
+
+        value = build()
+        try:
+            data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.exception("Report section %s is not cached" % (key,))
+            return value
+
+        with self._lock:
+            self._sections[key] = (fingerprints, data)
+            while len(self._sections) > self.max_sections:
+                self._sections.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._sections.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'sections': len(self._sections),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / requests if requests else 0.0,
+        }
+
+
+sections = SectionCache()
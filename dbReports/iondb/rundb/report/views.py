@@ -36,6 +36,7 @@ from datetime import datetime, date
 from collections import OrderedDict
 
 from iondb.rundb.report.analyze import createReport_and_launch, get_project_names
+from iondb.rundb.report import report_cache
 from iondb.rundb.data import dmactions_types
 
 logger = logging.getLogger(__name__)
@@ -723,6 +724,122 @@ def ionstats_read_stats(report):
     return ionstats_compute_stats(full)
 
 
+def ionstats_alignment_read(report):
+    ionstats_alignment = load_json(report, "ionstats_alignment.json")
+
+    # Special alignment backward compatibility code
+    if not ionstats_alignment:
+        ionstats_alignment = {}
+        alignStats = load_json(report, "alignStats_err.json")
+        alignment_ini = load_ini(report, ".", "alignment.summary")
+        if alignStats and alignment_ini:
+            ionstats_alignment['aligned'] = {'num_bases': alignStats["total_mapped_target_bases"]}
+            ionstats_alignment['error_by_position'] = [alignStats["accuracy_total_errors"], ]
+            ionstats_alignment['AQ17'] = {'num_bases': alignment_ini["Filtered Mapped Bases in Q17 Alignments"],
+                                          'mean_read_length': alignment_ini["Filtered Q17 Mean Alignment Length"],
+                                          'max_read_length': alignment_ini["Filtered Q17 Longest Alignment"]}
+            ionstats_alignment['AQ20'] = {'num_bases': alignment_ini["Filtered Mapped Bases in Q20 Alignments"],
+                                          'mean_read_length': alignment_ini["Filtered Q20 Mean Alignment Length"],
+                                          'max_read_length': alignment_ini["Filtered Q20 Longest Alignment"]}
+            ionstats_alignment['AQ47'] = {'num_bases': alignment_ini["Filtered Mapped Bases in Q47 Alignments"],
+                                          'mean_read_length': alignment_ini["Filtered Q47 Mean Alignment Length"],
+                                          'max_read_length': alignment_ini["Filtered Q47 Longest Alignment"]}
+    return ionstats_alignment
+
+
+def CA_barcodes_read(report):
+    CA_barcodes = []
+    try:
+        CA_barcodes_json_path = os.path.join(report.get_report_dir(), 'CA_barcode_summary.json')
+        if os.path.exists(CA_barcodes_json_path):
+            CA_barcodes = json.load(open(CA_barcodes_json_path))
+        else:
+            # compatibility <TS3.6
+            for CA_barcode in csv_barcodes_read(report):
+                CA_barcodes.append({
+                    "barcode_name": CA_barcode["ID"],
+                    "AQ7_num_bases": CA_barcode["Filtered_Mapped_Bases_in_Q7_Alignments"],
+                    "full_num_reads": CA_barcode["Total_number_of_Reads"],
+                    "AQ7_mean_read_length": CA_barcode["Filtered_Q7_Mean_Alignment_Length"]
+                })
+    except:
+        pass
+    return CA_barcodes
+
+
+def major_plugin_read(report, plugin_path, plugin_name):
+    """first _block.html of a major plugin and its pdf slice images, (False, False) if there is no block"""
+    # list all of the _blocks for the major plugins, just use the first one
+    try:
+        majorPluginFiles = glob.glob(os.path.join(plugin_path, "*_block.html"))[0]
+        majorPluginImages = glob.glob(os.path.join(report.get_report_dir(), "pdf", "slice_" + plugin_name + "*"))
+    except IndexError:
+        return False, False
+    return majorPluginFiles, sorted(majorPluginImages)
+
+
+def cached_section(report, key, files, build):
+    """
+    Returns build(report) from the report section cache. The section is rebuilt when one of files,
+    paths relative to the report directory, was modified, created or removed.
+    Files added to or removed from a directory change the fingerprint of the directory.
+    """
+    report_dir = report.get_report_dir()
+    paths = [os.path.join(report_dir, f) for f in files]
+    return report_cache.sections.get((report_dir, key), paths, lambda: build(report))
+
+
+def major_plugins_read(report, pluginList):
+    """Returns major_plugins, major_plugins_images, has_major_plugins of the report page"""
+    major_plugins = {}
+    major_plugins_images = {}
+    has_major_plugins = False
+    for major_plugin in pluginList:
+        if major_plugin.plugin.majorBlock:
+            name = major_plugin.plugin.name
+            plugin_path = major_plugin.path()
+            majorPluginFiles, majorPluginImages = cached_section(
+                report, ("major_plugin", name, plugin_path), [plugin_path, "pdf"],
+                lambda report: major_plugin_read(report, plugin_path, name))
+            if majorPluginFiles:
+                has_major_plugins = True
+            major_plugins[name] = majorPluginFiles
+            major_plugins_images[name] = majorPluginImages
+    return major_plugins, major_plugins_images, has_major_plugins
+
+
+def report_sections_read(report):
+    """Returns the sections of the report page parsed from the files in the report directory"""
+    platform = report.experiment.getPlatform
+    sections = {
+        # basecaller_results/BaseCaller.json
+        "basecaller": cached_section(report, "basecaller", ["basecaller_results/BaseCaller.json"], basecaller_read),
+        # basecaller_results/ionstats_basecaller.json
+        "read_stats": cached_section(report, "read_stats", ["basecaller_results/ionstats_basecaller.json"],
+                                     ionstats_read_stats),
+        "datasets": cached_section(report, "datasets", ["basecaller_results/datasets_basecaller.json"],
+                                   lambda report: load_json(report, "basecaller_results", "datasets_basecaller.json")),
+        # basecaller_results/TFStats.json, TF_C is removed for S5
+        "testfragments": cached_section(report, ("testfragments", platform), ["basecaller_results/TFStats.json"],
+                                        testfragments_read),
+        "beadfind": cached_section(report, "beadfind",
+                                   ["sigproc_results/analysis.bfmask.stats", "analysis.bfmask.stats"],
+                                   lambda report: load_ini(report, "sigproc_results", "analysis.bfmask.stats")),
+        "ionstats_alignment": cached_section(report, "ionstats_alignment",
+                                             ["ionstats_alignment.json", "alignStats_err.json", "alignment.summary"],
+                                             ionstats_alignment_read),
+    }
+    if platform.upper() == "S5":
+        sections["S5_InitLog_read"] = cached_section(report, "InitLog", ["InitLog.txt"], InitLog_read)
+    if report.resultsType and report.resultsType == 'CombinedAlignments':
+        sections["CA_barcodes"] = cached_section(report, "CA_barcodes",
+                                                 ["CA_barcode_summary.json", "alignment_barcode_summary.csv"],
+                                                 CA_barcodes_read)
+        sections["paramsJson"] = cached_section(report, "paramsJson", ["ion_params_00.json"],
+                                                lambda report: load_json(report, "ion_params_00.json"))
+    return sections
+
+
 def _report_context(request, report_pk):
     """Show the main report for an data analysis result.
     """
@@ -770,35 +887,18 @@ def _report_context(request, report_pk):
     plan = report_plan(report)
 
     # find the major blocks from the important plugins
-    major_plugins = {}
-    major_plugins_images = {}
-    has_major_plugins = False
     pluginList = report.pluginresult_set.all().select_related('result', 'result__reportstorage', 'plugin')
-    for major_plugin in pluginList:
-        if major_plugin.plugin.majorBlock:
-            # list all of the _blocks for the major plugins, just use the first one
-            try:
-                majorPluginFiles = glob.glob(os.path.join(major_plugin.path(), "*_block.html"))[0]
-                majorPluginImages = glob.glob(os.path.join(report.get_report_dir(), "pdf",
-                                                           "slice_" + major_plugin.plugin.name + "*"))
-                has_major_plugins = True
-            except IndexError:
-                majorPluginFiles = False
-                majorPluginImages = False
-
-            major_plugins[major_plugin.plugin.name] = majorPluginFiles
-            if majorPluginImages:
-                major_plugins_images[major_plugin.plugin.name] = sorted(majorPluginImages)
-            else:
-                major_plugins_images[major_plugin.plugin.name] = majorPluginImages
+    major_plugins, major_plugins_images, has_major_plugins = major_plugins_read(report, pluginList)
 
     # TODO: encapuslate all vars into their parent block to make it easy to build the API maybe put
     # all of this in the model?
-    basecaller = basecaller_read(report)        # basecaller_results/BaseCaller.json
-    read_stats = ionstats_read_stats(report)    # basecaller_results/ionstats_basecaller.json
-    datasets = load_json(report, "basecaller_results", "datasets_basecaller.json")
-    testfragments = testfragments_read(report)  # basecaller_results/TFStats.json
-    beadfind = load_ini(report, "sigproc_results", "analysis.bfmask.stats")
+    # file sections are cached until the files they are read from change
+    sections = report_sections_read(report)
+    basecaller = sections["basecaller"]
+    read_stats = sections["read_stats"]
+    datasets = sections["datasets"]
+    testfragments = sections["testfragments"]
+    beadfind = sections["beadfind"]
     software_versions = report_version_display(report)  # version.txt
     chef_info = report_chef_display(report)     # chef info
     chefLibPrep_info = report_chef_libPrep_display(report)  # chef Library Prep info
@@ -806,33 +906,18 @@ def _report_context(request, report_pk):
     checkDevice = report.experiment.getPlatform
     if checkDevice.upper() == "S5":
         chip_efuseDict = report_S5_consumable_display(report)
-        S5_InitLog_read = InitLog_read(report)
+        S5_InitLog_read = sections["S5_InitLog_read"]
 
 
     # special case: combinedAlignments output doesn't have any basecaller results
     if report.resultsType and report.resultsType == 'CombinedAlignments':
         report.experiment.expName = "CombineAlignments"
 
-        CA_barcodes = []
-        try:
-            CA_barcodes_json_path = os.path.join(report.get_report_dir(), 'CA_barcode_summary.json')
-            if os.path.exists(CA_barcodes_json_path):
-                CA_barcodes = json.load(open(CA_barcodes_json_path))
-            else:
-                # compatibility <TS3.6
-                for CA_barcode in csv_barcodes_read(report):
-                    CA_barcodes.append({
-                        "barcode_name": CA_barcode["ID"],
-                        "AQ7_num_bases": CA_barcode["Filtered_Mapped_Bases_in_Q7_Alignments"],
-                        "full_num_reads": CA_barcode["Total_number_of_Reads"],
-                        "AQ7_mean_read_length": CA_barcode["Filtered_Q7_Mean_Alignment_Length"]
-                    })
-        except:
-            pass
+        CA_barcodes = sections["CA_barcodes"]
         CA_barcodes_json = json.dumps(CA_barcodes)
 
         try:
-            paramsJson = load_json(report, "ion_params_00.json")
+            paramsJson = sections["paramsJson"]
             parents = [(pk, name) for pk, name in zip(paramsJson["parentIDs"], paramsJson["parentNames"])]
             CA_warnings = paramsJson.get("warnings", "")
         except:
@@ -884,27 +969,8 @@ def _report_context(request, report_pk):
     except:
         logger.warn("Failed to build Basecaller report content for %s." % report.resultsName)
 
-    # Special alignment backward compatibility code
-    ionstats_alignment = load_json(report, "ionstats_alignment.json")
-
-    if not ionstats_alignment:
-        ionstats_alignment = {}
-        alignStats = load_json(report, "alignStats_err.json")
-        alignment_ini = load_ini(report, ".", "alignment.summary")
-        if alignStats and alignment_ini:
-            ionstats_alignment['aligned'] = {'num_bases': alignStats["total_mapped_target_bases"]}
-            ionstats_alignment['error_by_position'] = [alignStats["accuracy_total_errors"], ]
-            ionstats_alignment['AQ17'] = {'num_bases': alignment_ini["Filtered Mapped Bases in Q17 Alignments"],
-                                          'mean_read_length': alignment_ini["Filtered Q17 Mean Alignment Length"],
-                                          'max_read_length': alignment_ini["Filtered Q17 Longest Alignment"]}
-            ionstats_alignment['AQ20'] = {'num_bases': alignment_ini["Filtered Mapped Bases in Q20 Alignments"],
-                                          'mean_read_length': alignment_ini["Filtered Q20 Mean Alignment Length"],
-                                          'max_read_length': alignment_ini["Filtered Q20 Longest Alignment"]}
-            ionstats_alignment['AQ47'] = {'num_bases': alignment_ini["Filtered Mapped Bases in Q47 Alignments"],
-                                          'mean_read_length': alignment_ini["Filtered Q47 Mean Alignment Length"],
-                                          'max_read_length': alignment_ini["Filtered Q47 Longest Alignment"]}
-        del alignStats
-        del alignment_ini
+    ionstats_alignment = sections["ionstats_alignment"]
+    del sections
 
     eas_reference = report.eas.reference
     barcodedSamples_reference_name_count = 0
@@ -1251,6 +1317,9 @@ def analyze(request, exp_pk, report_pk):
     if request.method == 'GET' or re_analysis:
         # this is a reanalysis web page request
         ctxd, eas, post_dict = reanalyze(request, exp, eas, plugins_list, report_pk)
+        if post_dict:
+            # lets the job server start automatic analyses first
+            post_dict['re_analysis'] = True
     else:
         # this is new analysis POST request (e.g. from crawler)
         post_dict = {}
@@ -271,10 +271,16 @@ EXTERNAL_IP_URL = "http://icanhazip.com"
 CRAWLER_PORT = 10001
 CRAWLER_PERIOD = 60
 
+# Data management auto-actions run concurrently on each partition and fileset category,
+# sharing the DMFileSet bandwidth_limit (KB/s) when copying files
+DM_MAX_CONCURRENT_ACTIONS = 3
+
 ANALYSIS_ROOT = "/opt/ion/iondb/anaserve"
 
 JOBSERVER_HOST = HOSTNAME
 JOBSERVER_PORT = 10000
+# maximum number of analyses the job server runs at once, 0 for no limit
+JOBSERVER_MAX_RUNNING = 8
 
 # the settings for the xmlrpc server connection to the plugins daemon
 IPLUGIN_HOST = HOSTNAME
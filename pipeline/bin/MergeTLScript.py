@@ -20,6 +20,7 @@ from ion.utils import basecaller
 from ion.utils import alignment
 from ion.utils import ionstats_plots
 from ion.utils import ionstats
+from ion.utils import compositemerge
 
 from ion.utils.blockprocessing import printtime
 
@@ -205,15 +206,23 @@ if __name__ == "__main__":
         except:
             traceback.print_exc()
 
+        # blocks folded by TLScript while running only need to be finalized
+        merge_state = None
         try:
-            sigproc.mergeAvgNukeTraces(dirs, env['SIGPROC_RESULTS'], env['libraryKey'], 'Library Beads')
+            merge_state = compositemerge.finalize(dirs, env)
         except:
-            printtime("Warning: mergeAvgNukeTraces '%s' 'Library Beads' failed" % env['libraryKey'])
+            traceback.print_exc()
+            printtime("Warning: incremental composite merge failed, merging all blocks")
 
         try:
-            sigproc.mergeAvgNukeTraces(dirs, env['SIGPROC_RESULTS'], env['tfKey'], 'Test Fragment Beads')
+            if merge_state:
+                compositemerge.write_avg_nuke_traces(merge_state, env)
+            else:
+                sigproc.mergeBlockAvgNukeTraces(dirs, env['SIGPROC_RESULTS'],
+                                                [(env['libraryKey'], 'Library Beads'),
+                                                 (env['tfKey'], 'Test Fragment Beads')])
         except:
-            printtime("Warning: mergeAvgNukeTraces '%s' 'Test Fragment Beads' failed" % env['tfKey'])
+            printtime("Warning: mergeAvgNukeTraces '%s' '%s' failed" % (env['libraryKey'], env['tfKey']))
 
         try:
             sigproc.generate_raw_data_traces(
@@ -226,9 +235,10 @@ if __name__ == "__main__":
 
         try:
             # Only merge standard json files
-            basecaller.merge_datasets_basecaller_json(
-                dirs,
-                env['BASECALLER_RESULTS'])
+            if not (merge_state and compositemerge.write_datasets_json(merge_state, env['BASECALLER_RESULTS'])):
+                basecaller.merge_datasets_basecaller_json(
+                    dirs,
+                    env['BASECALLER_RESULTS'])
 
             basecaller.merge_basecaller_json(
                 dirs,
@@ -258,9 +268,11 @@ if __name__ == "__main__":
             try:
                 os.mkdir(os.path.join(env['BASECALLER_RESULTS'], 'unfiltered.untrimmed'))
 
-                basecaller.merge_datasets_basecaller_json(
-                    dirs,
-                    os.path.join(env['BASECALLER_RESULTS'], "unfiltered.untrimmed"))
+                unfiltered_dir = os.path.join(env['BASECALLER_RESULTS'], "unfiltered.untrimmed")
+                if not (merge_state and compositemerge.write_datasets_json(merge_state, unfiltered_dir)):
+                    basecaller.merge_datasets_basecaller_json(
+                        dirs,
+                        unfiltered_dir)
 
                 blockprocessing.merge_bams(
                     dirs,
@@ -273,9 +285,11 @@ if __name__ == "__main__":
             try:
                 os.mkdir(os.path.join(env['BASECALLER_RESULTS'], 'unfiltered.trimmed'))
 
-                basecaller.merge_datasets_basecaller_json(
-                    dirs,
-                    os.path.join(env['BASECALLER_RESULTS'], "unfiltered.trimmed"))
+                unfiltered_dir = os.path.join(env['BASECALLER_RESULTS'], "unfiltered.trimmed")
+                if not (merge_state and compositemerge.write_datasets_json(merge_state, unfiltered_dir)):
+                    basecaller.merge_datasets_basecaller_json(
+                        dirs,
+                        unfiltered_dir)
 
                 blockprocessing.merge_bams(
                     dirs,
@@ -27,7 +27,11 @@ import scipy.stats as stats
 # Add path for deinterlace.so on instrument
 sys.path.append('/software/testing')
 
-import deinterlace as di
+try:
+    import deinterlace as di
+except ImportError:
+    # only needed to read dat files, see ReadDat
+    di = None
 
 
 # --------------------------------------------------#
@@ -86,10 +90,7 @@ def BeadFind(BF):
                     nnimg = roi - GenerateBackgroundImage(roi, ~goodpx, 10, bfg['bfgain'])
                     nnimg[np.isnan(nnimg)] = 0
                     # blank pinned or inactive pixels
-                    for frm in range(nnimg.shape[2]):
-                        frame = nnimg[:,:, frm]
-                        frame[~goodpx] = 0
-                        nnimg[:,:, frm] = frame
+                    nnimg[~goodpx] = 0
 
                     # blank anything with an excessive standard deviation
                     s3 = np.std(nnimg, axis=2, ddof=1)
@@ -97,10 +98,7 @@ def BeadFind(BF):
                     if (oddpixelthresh > 2 * np.mean(s3)):
                         oddpixels = s3 >= oddpixelthresh;
                         goodpx = goodpx & ~oddpixels
-                        for frm in range(nnimg.shape[2]):
-                            fn = nnimg[:,:, frm]
-                            fn[oddpixels] = 0
-                            nnimg[:,:, frm] = fn
+                        nnimg[oddpixels] = 0
                     # Note to self -- eventually need to add a new if goodpx.sum() < 500 here
                     try:
                         vspread = np.std(nnimg.reshape(-1, nnimg.shape[2]), axis=0, ddof=1)
@@ -259,58 +257,38 @@ def GenerateBackgroundImage(image, mask, dist, nn_gain):
     """
     Adapted from Todd Rearick's GenerateBackgroundImage Matlab function for nn-subtraction
     Note that mask is pinned pixels and will be ignored for the calculations.
+
+    The integral images of all frames are built at once with cumulative sums down rows and across columns.
     """
     [r, c, f] = image.shape
     # Redefine mask as a boolean array
     mask = np.array(mask, dtype=bool)
     active = ~mask
 
-    background = np.zeros((r, c, f))
-
     # take zeros out of gain correction
     nn_gain[nn_gain == 0] = 1
 
-    # Go through all the frames.  First frame (-1) is actually the mask.
-    for nframe in np.arange(f+1)-1:
-
-        fbg = np.zeros((r, c))
-
-        # first time through we do the exact same calculation on the active pixel matrix in order to build the normalization matrix
-        if nframe == -1:
-            frame = active
-        else:
-            frame = image[:,:, nframe] * active
-
-        # Integrate down rows
-        imat = np.zeros((r+2*dist+1, c+2*dist+1))
-
-        for rw in (np.arange(r) + dist):
-            imat[rw+1, dist+1:dist+c+1] = frame[rw-dist,:] + imat[rw, dist+1:dist+c+1]
-
-        for rw in (np.arange(dist) + r + dist):
-            imat[rw+1,:] = imat[rw,:]
+    # Zero padded stack of all the frames.  First frame (0) is the active pixel matrix, used to build the normalization matrix
+    imat = np.zeros((r+2*dist+1, c+2*dist+1, f+1))
+    imat[dist+1:dist+r+1, dist+1:dist+c+1, 0] = active
+    imat[dist+1:dist+r+1, dist+1:dist+c+1, 1:] = image * active[:,:, np.newaxis]
 
-        # Integrate across columns
-        for cl in (np.arange(c + dist - 1) + dist + 1):
-            imat[:, cl+1] = imat[:, cl+1] + imat[:, cl]
+    # Integrate down rows, then across columns
+    np.cumsum(imat, axis=0, out=imat)
+    np.cumsum(imat, axis=1, out=imat)
 
-        # Each output point can be calculated from the four corners of the box around the point, "trust me" - Todd
-        fbg = (imat[(2*dist+1):,  (2*dist+1):]
-              - imat[:-(2*dist+1),  (2*dist+1):]
-              - imat[(2*dist+1):, :-(2*dist+1)]
-              + imat[:-(2*dist+1), :-(2*dist+1)])
+    # Each output point can be calculated from the four corners of the box around the point, "trust me" - Todd
+    fbg = (imat[(2*dist+1):,  (2*dist+1):]
+          - imat[:-(2*dist+1),  (2*dist+1):]
+          - imat[(2*dist+1):, :-(2*dist+1)]
+          + imat[:-(2*dist+1), :-(2*dist+1)])
 
-        # for rw in np.arange(r):
-        #    for cl in np.arange(c):
-        #	fbg[rw,cl] = imat[rw+2*dist+1,cl+2*dist+1] - imat[rw,cl+2*dist+1] - imat[rw+2*dist+1,cl] + imat[rw,cl]
-
-        # First time through, capture the normalization matrix.  After that, capture background matrix and scale it
-        if nframe == -1:
-            norm = fbg / nn_gain
-            # modify norm to get rid of zeros
-            norm[norm == 0] = 1
-        else:
-            background[:,:, nframe] = fbg / norm
+    # Capture the normalization matrix from the first frame, scale the background of the other frames with it
+    norm = fbg[:,:, 0] / nn_gain
+    # modify norm to get rid of zeros
+    norm[norm == 0] = 1
+    background = fbg[:,:, 1:]
+    background /= norm[:,:, np.newaxis]
 
     return background
 
@@ -323,6 +301,15 @@ def GetMaskAverage(image, pinned):
     avgtrace = np.mean(image[~pinned], axis=0)
     return avgtrace
 
+def NormalizeDat(img):
+    '''
+    Normalizes all pixels of the int16 (R,C,frame) image in place to start their signals at 0 before the flow begins.
+    '''
+    bkg = np.mean(img[:,:, 1:5], axis=2)
+    bkg = np.array(bkg, dtype='i2')
+    img -= bkg[:,:, np.newaxis]
+    return img
+
 def ReadDat(datFile, norm=True):
     '''
     Generic function that will load an arbitrarily sized acquisition file.
@@ -338,13 +325,15 @@ def ReadDat(datFile, norm=True):
     .timestamps (in milliseconds)
     .data
     '''
-    if os.path.exists(datFile):
+    if di is None:
+        acq = np.zeros(0)
+        print('Error, deinterlace module not found, cannot read %s.' % datFile)
+    elif os.path.exists(datFile):
         # Read in .dat file
         acq = di.deinterlace_c(datFile)
 
-        # Reshape data array from (frame,R,C) to (R,C,frame)
-        img = np.rollaxis(acq.data, 0, 3)
-        img = np.array(img, dtype='i2')
+        # Reshape data array from (frame,R,C) to (R,C,frame), only copied if the data is not int16 already
+        img = np.asarray(np.rollaxis(acq.data, 0, 3), dtype='i2')
 
         acq.miniR = 0
         acq.miniC = 0
@@ -388,13 +377,7 @@ def ReadDat(datFile, norm=True):
         acq.pinned = np.any(img > 16370, axis=2) | np.any(img < 10, axis=2)
 
         if norm == True:
-            # Normalize all pixels to start their signals at 0 before the flow begins.
-            bkg = np.mean(img[:,:, 1:5], axis=2)
-            bkg = np.array(bkg, dtype='i2')
-            # img = img - np.tile ( bkg.reshape( acq.rows , acq.cols , 1 ) , ( 1 , 1 , acq.frames ))
-            for i in range(acq.frames):
-                img[:,:, i] = np.array((img[:,:, i] - bkg), dtype='i2')
-            acq.data = img
+            acq.data = NormalizeDat(img)
             acq.norm = True
         else:
             acq.data = img
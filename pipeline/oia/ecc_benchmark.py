@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+#
+# Benchmark of the vectorized ECC dat normalization and background image against the previous
+# frame by frame implementation.  Results of both implementations are compared, the exit code is 1
+# if they differ.
+#
+# Usage: ecc_benchmark.py [-i acq_0000.dat] [-n repeats]
+
+import argparse
+import numpy as np
+import sys, os, time
+
+import ecc
+
+DEFAULT_DAT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'torrentPy', 'tests', 'acq_0000.dat')
+
+
+# --------------------------------------------------#
+# Previous implementation
+# --------------------------------------------------#
+
+def LegacyNormalizeDat(img):
+    bkg = np.mean(img[:,:, 1:5], axis=2)
+    bkg = np.array(bkg, dtype='i2')
+    for i in range(img.shape[2]):
+        img[:,:, i] = np.array((img[:,:, i] - bkg), dtype='i2')
+    return img
+
+def LegacyGenerateBackgroundImage(image, mask, dist, nn_gain):
+    [r, c, f] = image.shape
+    mask = np.array(mask, dtype=bool)
+    active = ~mask
+
+    background = np.zeros((r, c, f))
+    nn_gain[nn_gain == 0] = 1
+
+    for nframe in np.arange(f+1)-1:
+        if nframe == -1:
+            frame = active
+        else:
+            frame = image[:,:, nframe] * active
+
+        imat = np.zeros((r+2*dist+1, c+2*dist+1))
+        for rw in (np.arange(r) + dist):
+            imat[rw+1, dist+1:dist+c+1] = frame[rw-dist,:] + imat[rw, dist+1:dist+c+1]
+        for rw in (np.arange(dist) + r + dist):
+            imat[rw+1,:] = imat[rw,:]
+        for cl in (np.arange(c + dist - 1) + dist + 1):
+            imat[:, cl+1] = imat[:, cl+1] + imat[:, cl]
+
+        fbg = (imat[(2*dist+1):,  (2*dist+1):]
+              - imat[:-(2*dist+1),  (2*dist+1):]
+              - imat[(2*dist+1):, :-(2*dist+1)]
+              + imat[:-(2*dist+1), :-(2*dist+1)])
+
+        if nframe == -1:
+            norm = fbg / nn_gain
+            norm[norm == 0] = 1
+        else:
+            background[:,:, nframe] = fbg / norm
+
+    return background
+
+# --------------------------------------------------#
+# Benchmark
+# --------------------------------------------------#
+
+def LoadRawDat(datFile):
+    '''Returns the not normalized (R,C,frame) int16 image of a dat file'''
+    if ecc.di is not None:
+        acq = ecc.di.deinterlace_c(datFile)
+        return np.array(np.rollaxis(acq.data, 0, 3), dtype='i2')
+    else:
+        # no deinterlace module off the instrument, use torrentPy
+        import torrentPy
+        dat = torrentPy.RawDatReader(datFile, normalize=False)
+        return np.array(dat.LoadSlice(0, 0, 60000, 60000), dtype='i2')
+
+def timed(func, repeats, *args):
+    start_time = time.time()
+    for i in range(repeats):
+        result = func(*args)
+    return result, (time.time() - start_time) / repeats
+
+def main(datFile, repeats, tile):
+    raw = LoadRawDat(datFile)
+    print('%s: %d rows, %d cols, %d frames' % (datFile, raw.shape[0], raw.shape[1], raw.shape[2]))
+    failed = False
+
+    # dat normalization
+    legacy, legacy_time = timed(lambda: LegacyNormalizeDat(raw.copy()), repeats)
+    img, new_time = timed(lambda: ecc.NormalizeDat(raw.copy()), repeats)
+    same = np.array_equal(legacy, img)
+    failed |= not same
+    print('NormalizeDat             %8.3f s   legacy %8.3f s   %s' % (new_time, legacy_time, 'same' if same else 'DIFFERENT'))
+
+    # background image of each tile, as in BeadFind
+    pinned = np.any(raw > 16370, axis=2) | np.any(raw < 10, axis=2)
+    actpix = (np.std(img, axis=2, ddof=1) > 500) & ~pinned
+    legacy_time = 0
+    new_time = 0
+    tiles = 0
+    for r in range(0, img.shape[0], tile):
+        for c in range(0, img.shape[1], tile):
+            roi = img[r:r + tile, c:c + tile,:]
+            goodpx = actpix[r:r + tile, c:c + tile]
+            if not goodpx.any():
+                goodpx = ~pinned[r:r + tile, c:c + tile]
+            gain = ecc.BeadfindGainNorm(roi, ~goodpx)['bfgain']
+            legacy, elapsed = timed(LegacyGenerateBackgroundImage, repeats, roi, ~goodpx, 10, gain.copy())
+            legacy_time += elapsed
+            background, elapsed = timed(ecc.GenerateBackgroundImage, repeats, roi, ~goodpx, 10, gain.copy())
+            new_time += elapsed
+            tiles += 1
+            if not np.array_equal(legacy, background):
+                print('GenerateBackgroundImage: tile (%d, %d) DIFFERENT, max difference %g' % (
+                    r, c, np.nanmax(np.abs(legacy - background))))
+                failed = True
+    print('GenerateBackgroundImage  %8.3f s   legacy %8.3f s   %d tiles' % (new_time, legacy_time, tiles))
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', dest='datfile', default=DEFAULT_DAT, help='dat file, default is the torrentPy test data acq_0000.dat')
+    parser.add_argument('-n', dest='repeats', type=int, default=3, help='number of runs per timing')
+    parser.add_argument('-t', dest='tile', type=int, default=100, help='size of the tiles the background image is computed for')
+    args = parser.parse_args()
+
+    sys.exit(main(args.datfile, args.repeats, args.tile))
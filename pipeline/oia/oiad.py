@@ -15,11 +15,13 @@ import random
 import fnmatch
 import re
 import json
+import heapq
+import itertools
 
 from collections import deque
 
 from Queue import Queue
-from threading import Thread
+from threading import Thread, Lock
 import multiprocessing
 
 
@@ -55,11 +57,10 @@ class Worker(Thread):
 
             block = self.tasks.get()
 
-            if 'justBeadFind' in block.command:
-                self.pool.beadfind_counter += 1
+            # job counters and memory are reserved by the scheduler when the block is queued
+            if block.job_type == 'beadfind':
                 block.status = "performJustBeadFind"
-            if 'Analysis' in block.command:
-                self.pool.analysis_counter += 1
+            if block.job_type == 'analysis':
                 block.status = "performAnalysis"
 
             logger.info("%s: T1: %s" % (self.id, block))
@@ -134,14 +135,10 @@ class Worker(Thread):
                 logger.error(traceback.format_exc())
                 pass
 
+            self.pool.release(block)
             block.status = "processed"
             self.tasks.task_done()
 
-            if 'justBeadFind' in block.command:
-                self.pool.beadfind_counter -= 1
-            if 'Analysis' in block.command:
-                self.pool.analysis_counter -= 1
-
             stoptime = time.localtime()
             block.jobtiming.append((starttime, stoptime, block.info, block.ret, self.id))
             logger.info("%s: T2: %s" % (self.id, block))
@@ -151,14 +148,38 @@ class ThreadPool:
     """Pool of threads consuming tasks from a queue"""
     def __init__(self, num_threads, logger):
         self.tasks = Queue(num_threads)  # limit the queue to the number of threads
+        self.lock = Lock()
         self.beadfind_counter = 0
         self.analysis_counter = 0
+        self.host_memory_reserved = 0
+        self.gpu_memory_reserved = 0
 
         for threadid in range(num_threads): Worker(threadid, self.tasks, self, logger)
 
+    def reserve(self, block):
+        """Count the job of the block and reserve its memory"""
+        with self.lock:
+            if block.job_type == 'beadfind':
+                self.beadfind_counter += 1
+            if block.job_type == 'analysis':
+                self.analysis_counter += 1
+            self.host_memory_reserved += block.host_memory
+            self.gpu_memory_reserved += block.gpu_memory
+
+    def release(self, block):
+        """Release the job counter and memory reserved for the block"""
+        with self.lock:
+            if block.job_type == 'beadfind':
+                self.beadfind_counter -= 1
+            if block.job_type == 'analysis':
+                self.analysis_counter -= 1
+            self.host_memory_reserved -= block.host_memory
+            self.gpu_memory_reserved -= block.gpu_memory
+
     def add_task(self, block):
         """Add a task to the queue"""
         # print 'add task', block
+        self.reserve(block)
         self.tasks.put(block)
 
     def wait_completion(self):
@@ -503,6 +524,11 @@ class Block:
         self.jobtiming = []
         self.info = "no info"
 
+        # set by the scheduler for the job the block is queued for
+        self.job_type = None
+        self.host_memory = 0
+        self.gpu_memory = 0
+
     def __str__(self):
         s = "  block:" + self.name
         s += "  status:" + str(self.status)
@@ -529,6 +555,97 @@ class Block:
         return s
 
 
+def get_job_limits(config, chipversion):
+    """Returns maximum number of separator and analysis jobs for the chip version"""
+    try:
+        return (config.getint(chipversion, 'nb_max_beadfind_jobs'),
+                config.getint(chipversion, 'nb_max_analysis_jobs'))
+    except:
+        return (config.getint('DefaultChip', 'nb_max_beadfind_jobs'),
+                config.getint('DefaultChip', 'nb_max_analysis_jobs'))
+
+
+def get_memory_requirements(config, chipversion):
+    """Returns HOST memory of a separator job, HOST and GPU memory of an analysis job in bytes"""
+    for section in [chipversion, 'DefaultChip']:
+        try:
+            return (config.getint(section, 'HOST_memory_requirement_beadfind'),
+                    config.getint(section, 'HOST_memory_requirement_analysis'),
+                    config.getint(section, 'GPU_memory_requirement_analysis'))
+        except:
+            pass
+    return (0, 0, 0)
+
+
+def get_host_memory(config):
+    """Returns HOST memory available to OIA jobs in bytes, from oia.config or the physical memory"""
+    try:
+        return config.getint('global', 'HOST_memory_total')
+    except:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except:
+        logger.error(traceback.format_exc())
+        return 0
+
+
+class ReadyQueue:
+    """
+    Priority queue of the idle blocks of each run.
+    While a run acquires data, the blocks with the fewest processed flows come first,
+    once all flows are acquired, the blocks closest to completion come first.
+    """
+    def __init__(self):
+        self.heaps = {}  # run name: [finishing, heap of (key, sequence number, block)]
+        self.sequence = itertools.count()
+
+    def _finishing(self, run):
+        return run.last_flow == run.exp_flows-1
+
+    def _key(self, block, finishing):
+        return -block.successful_processed if finishing else block.successful_processed
+
+    def push(self, block):
+        entry = self.heaps.setdefault(block.run.name, [self._finishing(block.run), []])
+        heapq.heappush(entry[1], (self._key(block, entry[0]), self.sequence.next(), block))
+
+    def pop_first(self, run, accept):
+        """Removes and returns the first block of the run for which accept(block) is True, or None"""
+        entry = self.heaps.get(run.name)
+        if not entry:
+            return None
+
+        # reorder once the run has acquired all flows
+        finishing = self._finishing(run)
+        if finishing != entry[0]:
+            entry[0] = finishing
+            entry[1] = [(self._key(block, finishing), seq, block) for key, seq, block in entry[1]]
+            heapq.heapify(entry[1])
+
+        heap = entry[1]
+        skipped = []
+        found = None
+        while heap:
+            item = heapq.heappop(heap)
+            if item[2].status != 'idle':
+                # block left the queue, e.g. run aborted or block failed
+                continue
+            if accept(item[2]):
+                found = item[2]
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return found
+
+    def remove_run(self, run):
+        self.heaps.pop(run.name, None)
+
+    def __len__(self):
+        return sum(len(entry[1]) for entry in self.heaps.values())
+
+
 class App():
     def __init__(self):
 
@@ -543,9 +660,19 @@ class App():
 
         self.flowblocks = config.getint('global', 'flowblocks')
 
+        # memory budget for HOST and GPU memory reservations of the jobs
+        self.host_memory_total = get_host_memory(config)
+        try:
+            self.gpu_memory_total = config.getint('global', 'GPU_memory_total')
+        except:
+            self.gpu_memory_total = total_GPU_memory * 1048576
+        logger.info('HOST memory: %s G  GPU memory: %s G' %
+                    (self.host_memory_total/1073741824, self.gpu_memory_total/1073741824))
+
         # 1) Init a Thread pool with the desired number of threads
         self.pool = ThreadPool(self.nb_max_jobs, logger)
 
+        self.ready_blocks = ReadyQueue()
         self.blocks_to_process = []
         self.runs_in_process = []
         self.runs_processed = []
@@ -574,99 +701,46 @@ class App():
 
         return run_dirs
 
-    def get_next_available_job(self, config):
-
-        # logger.debug('get_next_available_job')
-        # what kind of jobs are allowed to run?
-        beadfind_request = True
-        analysis_request = True
-
-        if self.pool.beadfind_counter + self.pool.analysis_counter >= self.nb_max_jobs:
-            logger.debug('max jobs limit reached (total)')
-            beadfind_request = False
-            analysis_request = False
-
-        if self.pool.beadfind_counter >= self.nb_max_beadfind_jobs:
-            logger.debug('max jobs limit reached (beadfind)')
-            beadfind_request = False
-
-        if self.pool.analysis_counter >= self.nb_max_analysis_jobs:
-            logger.debug('max jobs limit reached (analysis)')
-            analysis_request = False
-
-        # 6 analysis jobs are too much for some GPU's # find . -name sigproc.log | xargs grep -i StreamResources
-        # sigproc.log:CUDA 0 StreamManager: No StreamResources could be aquired!
-        # retry pending. jobs will he handled by CPU for now!
-        if self.pool.analysis_counter >= total_GPU_memory/1000:
-            logger.debug('GPU memory reached (analysis)')
-            analysis_request = False
-
-        # check if enough ressources are available
-        # GPU limit
-#       if current_HOST_memory + block.HOST_memory_requirement_beadfind >= 128G
-#            beadfind_request = False
-
-#       if current_HOST_memory + block.HOST_memory_requirement_analysis >= 128G
-#            analysis_request = False
-#        total_GPU_memory = 4000
-
-#       if current_GPU_memory + block.GPU_memory_requirement_analysis >= 6G
-#            analysis_request = False
-
-# nb_beadfind_threads = 4
-# nb_analysis_threads = 6
-# nb_max_jobs = 5
-# nb_max_beadfind_jobs = 5
-# nb_max_analysis_jobs = 4
-# HOST_memory_requirement_beadfind = 7G
-# HOST_memory_requirement_analysis = 20G
-# GPU_memory_requirement_analysis = 1G
-
-        # for development: beadfind first
-        # if self.pool.beadfind_counter > 0:
-        #    analysis_request = False
-
-        anablock = None
-
-        if not beadfind_request and not analysis_request:
-            # full queues
-            return anablock
-
+    def get_available_jobs(self, config):
+        """
+        Returns the blocks to submit next with their job set up.
+        Separator and analysis jobs are packed until the job limits or the HOST and GPU memory
+        reserved by running and selected jobs reach the capacity, analysis jobs are only started
+        if their GPU memory is available.
+        """
+        budget = {
+            'beadfind': self.pool.beadfind_counter,
+            'analysis': self.pool.analysis_counter,
+            'host': self.host_memory_total - self.pool.host_memory_reserved,
+            'gpu': self.gpu_memory_total - self.pool.gpu_memory_reserved,
+        }
+
+        jobs = []
         for run in self.runs_in_process:
 
-            runblocks = [block for block in self.blocks_to_process if block.run.name == run.name]
+            nb_max_beadfind_jobs, nb_max_analysis_jobs = get_job_limits(config, run.exp_chipversion)
+            nb_max_beadfind_jobs = min(nb_max_beadfind_jobs, self.nb_max_beadfind_jobs)
+            nb_max_analysis_jobs = min(nb_max_analysis_jobs, self.nb_max_analysis_jobs)
+            HOST_memory_beadfind, HOST_memory_analysis, GPU_memory_analysis = get_memory_requirements(
+                config, run.exp_chipversion)
 
-            rev = True
-            # run in progress
-            if run.last_flow == run.exp_flows-1:
-                rev = False
+            def fits(host_memory, gpu_memory):
+                # a job always fits on an idle instrument, even if the configured requirement is too large
+                if budget['beadfind'] + budget['analysis'] == 0:
+                    return True
+                return host_memory <= budget['host'] and gpu_memory <= budget['gpu']
 
-            sorted_blocks = sorted(
-                runblocks, key=lambda block: block.run.last_flow-block.successful_processed, reverse=rev)
-
-            try:
-                nb_max_beadfind_jobs = config.getint(run.exp_chipversion, 'nb_max_beadfind_jobs')
-                nb_max_analysis_jobs = config.getint(run.exp_chipversion, 'nb_max_analysis_jobs')
-            except:
-                nb_max_beadfind_jobs = config.getint('DefaultChip', 'nb_max_beadfind_jobs')
-                nb_max_analysis_jobs = config.getint('DefaultChip', 'nb_max_analysis_jobs')
-
-            if self.pool.beadfind_counter >= nb_max_beadfind_jobs:
-                logger.debug('max beadfind jobs limit reached (%s)' % run.exp_chipversion)
-                beadfind_request = False
-
-            if self.pool.analysis_counter >= nb_max_analysis_jobs:
-                logger.debug('max analysis jobs limit reached (%s)' % run.exp_chipversion)
-                analysis_request = False
-
-            for block in sorted_blocks:
-
-                if block.status != 'idle':
-                # logger.debug('idle')
-                    continue
+            def accept(block):
+                if budget['beadfind'] + budget['analysis'] >= self.nb_max_jobs:
+                    return False
 
                 # Analysis
-                if analysis_request and block.beadfind_done:
+                if block.beadfind_done:
+                    if budget['analysis'] >= nb_max_analysis_jobs:
+                        return False
+                    # StreamResources can't be acquired without free GPU memory, the job would fall back to CPU
+                    if not fits(HOST_memory_analysis, GPU_memory_analysis):
+                        return False
 
                     # how far can I go?
 
@@ -679,7 +753,7 @@ class App():
                         if block.flows_total - 1 - new_flow_end < self.flowblocks or new_flow_end <= block.successful_processed-1:
                             logger.debug('new flowend for %s: (%s/%s/%s) filtered out' % (
                                 block.name, block.successful_processed-1, new_flow_end, block.flows_total-1))
-                            continue
+                            return False
 
                     logger.debug('new flowend for %s: (%s/%s/%s)' %
                                  (block.name, block.successful_processed-1, new_flow_end, block.flows_total-1))
@@ -687,14 +761,34 @@ class App():
                     block.flow_start = block.successful_processed
                     block.flow_end = new_flow_end
                     block.command = getAnalysisCommand(config, block)
-                    anablock = block
-                    return anablock
+                    block.job_type = 'analysis'
+                    block.host_memory = HOST_memory_analysis
+                    block.gpu_memory = GPU_memory_analysis
+                    return True
 
                 # Separator
-                if beadfind_request and not block.beadfind_done:
-                    block.command = getSeparatorCommand(config, block)
-                    anablock = block
-                    return anablock
+                if budget['beadfind'] >= nb_max_beadfind_jobs or not fits(HOST_memory_beadfind, 0):
+                    return False
+                block.command = getSeparatorCommand(config, block)
+                block.job_type = 'beadfind'
+                block.host_memory = HOST_memory_beadfind
+                block.gpu_memory = 0
+                return True
+
+            while True:
+                block = self.ready_blocks.pop_first(run, accept)
+                if not block:
+                    break
+                budget[block.job_type] += 1
+                budget['host'] -= block.host_memory
+                budget['gpu'] -= block.gpu_memory
+                jobs.append(block)
+
+            if budget['beadfind'] + budget['analysis'] >= self.nb_max_jobs:
+                logger.debug('max jobs limit reached (total)')
+                break
+
+        return jobs
 
     def getCurrentRunInformation(self):
         CurExp = ""
@@ -759,6 +853,7 @@ class App():
                 if run.aborted():
                     logger.info('run aborted %s' % run.name)
                     run.killAnalysis()
+                    self.ready_blocks.remove_run(run)
                     for block in run.blocks:
                         if block in self.blocks_to_process:
                             self.blocks_to_process.remove(block)
@@ -865,6 +960,8 @@ class App():
                 for block in arun.blocks:
                     if block.status != 'done':
                         self.blocks_to_process.append(block)
+                    if block.status == 'idle':
+                        self.ready_blocks.push(block)
 
             self.printStatus()
 
@@ -878,9 +975,6 @@ class App():
                 logger.info('Status:        Blocks: {0:3d}  Beadfind: {1:2d}/{2:2d}  Analysis: {3:2d}/{4:2d}  Total: {5:2d}/{6:2d}'.format(
                     len(self.blocks_to_process), self.pool.beadfind_counter, self.nb_max_beadfind_jobs, self.pool.analysis_counter, self.nb_max_analysis_jobs, self.pool.beadfind_counter+self.pool.analysis_counter, self.nb_max_jobs))
 
-                predicted_total_HOST_memory = 0
-                predicted_total_GPU_memory = 0
-
                 # get list of all different Runs
                 for run in self.runs_in_process:
                     blocks_per_run = [i for i in self.blocks_to_process if i.run == run]
@@ -888,37 +982,16 @@ class App():
                         [i for i in self.blocks_to_process if i.run == run and i.status == 'performJustBeadFind'])
                     an = len(
                         [i for i in self.blocks_to_process if i.run == run and i.status == 'performAnalysis'])
-                    try:
-                        nb_max_beadfind_jobs = config.getint(run.exp_chipversion, 'nb_max_beadfind_jobs')
-                        nb_max_analysis_jobs = config.getint(run.exp_chipversion, 'nb_max_analysis_jobs')
-                    except:
-                        nb_max_beadfind_jobs = config.getint('DefaultChip', 'nb_max_beadfind_jobs')
-                        nb_max_analysis_jobs = config.getint('DefaultChip', 'nb_max_analysis_jobs')
+                    nb_max_beadfind_jobs, nb_max_analysis_jobs = get_job_limits(config, run.exp_chipversion)
                     if len(blocks_per_run):
                         logger.info('Chip: {0:8} Blocks: {1:3d}  Beadfind: {2:2d}/{3:2d}  Analysis: {4:2d}/{5:2d}  ({6})'.format(
                             run.exp_chipversion, len(blocks_per_run), bf, nb_max_beadfind_jobs, an, nb_max_analysis_jobs, run.name))
-                    try:
-                        HOST_memory_requirement_beadfind = config.getint(
-                            run.exp_chipversion, 'HOST_memory_requirement_beadfind')
-                        HOST_memory_requirement_analysis = config.getint(
-                            run.exp_chipversion, 'HOST_memory_requirement_analysis')
-                        GPU_memory_requirement_analysis = config.getint(
-                            run.exp_chipversion, 'GPU_memory_requirement_analysis')
-                    except:
-                        HOST_memory_requirement_beadfind = config.getint(
-                            'DefaultChip', 'HOST_memory_requirement_beadfind')
-                        HOST_memory_requirement_analysis = config.getint(
-                            'DefaultChip', 'HOST_memory_requirement_analysis')
-                        GPU_memory_requirement_analysis = config.getint(
-                            'DefaultChip', 'GPU_memory_requirement_analysis')
-                    predicted_total_HOST_memory += int(HOST_memory_requirement_beadfind)*bf
-                    predicted_total_HOST_memory += int(HOST_memory_requirement_analysis)*an
-                    predicted_total_GPU_memory += int(GPU_memory_requirement_analysis)*an
 
                 # every 60 sec
                 if time.time()-timestamp > 60:
-                    logger.info('HOST: {0} G   GPU: {1} G'.format(
-                        predicted_total_HOST_memory/1073741824, predicted_total_GPU_memory/1073741824))
+                    logger.info('HOST: {0}/{1} G   GPU: {2}/{3} G'.format(
+                        self.pool.host_memory_reserved/1073741824, self.host_memory_total/1073741824,
+                        self.pool.gpu_memory_reserved/1073741824, self.gpu_memory_total/1073741824))
 
                 # TODO: run.exp_oia_during_run
                 # TODO: check for new runs only if no data acquisition
@@ -951,6 +1024,8 @@ class App():
                             block.flow_start = -1
                             block.flow_end = -1
                             block.status = "idle"
+                        if block.status == 'idle':
+                            self.ready_blocks.push(block)
 
                     # processed blocks
                     if block.status == 'sigproc_done' or block.status == 'sigproc_failed':
@@ -1027,12 +1102,12 @@ class App():
                         self.blocks_to_process.remove(block)
 
                 try:
-                    ablock = self.get_next_available_job(config)
+                    ablocks = self.get_available_jobs(config)
                 except:
-                    ablock = None
+                    ablocks = []
                     logger.error(traceback.format_exc())
 
-                if ablock:
+                for ablock in ablocks:
                     if ablock.nb_attempts >= config.getint('global', 'nb_retries'):
                         ablock.status = 'sigproc_failed'
                     else:
@@ -1107,6 +1182,7 @@ if __name__ == '__main__':
         pass
 
     # retrieve GPU information
+    total_GPU_memory = 4000
     if pynvml_available:
         try:
             nvmlInit()
@@ -4,19 +4,20 @@ import argparse
 import subprocess
 from subprocess import CalledProcessError
 import sys
-import pylab
 import numpy
 import math
 import os
+import multiprocessing
 
 import ConfigParser
 import io
 
+# rows formatted per write when generating the text mask
+TEXT_CHUNK_ROWS = 1000000
 
-def merge(folder, infile, out_list, verbose, offset_str):
-
-    infile = os.path.join(folder, infile)
 
+def get_offset(folder, offset_str):
+    '''Returns x, y offset of the block in folder'''
     config = ConfigParser.RawConfigParser()
     config.read(os.path.join(folder, 'processParameters.txt'))
     if offset_str == "use_blocks":
@@ -28,13 +29,29 @@ def merge(folder, infile, out_list, verbose, offset_str):
         sys.exit(1)
 
     offset = size.split(',')
-    offsetx = int(offset[0])
-    offsety = int(offset[1])
+    return int(offset[0]), int(offset[1])
+
+
+def read_mask(infile):
+    '''Returns mask file as integer array of (y, x) rows, the first row holds the mask size'''
+    with open(infile) as f:
+        data = f.read()
+    if '#' in data:
+        data = '\n'.join(line.split('#', 1)[0] for line in data.splitlines())
+    return numpy.fromstring(data, dtype=numpy.int32, sep=' ').reshape(-1, 2)
+
+
+def read_block(args):
+    '''Returns bead coordinates of one block mask with the block offset added'''
+    folder, infile, verbose, offset_str = args
+
+    infile = os.path.join(folder, infile)
+    offsetx, offsety = get_offset(folder, offset_str)
 
     if verbose:
         print "MaskMerge: Reading "+str(infile)
 
-    beadlist = numpy.loadtxt(infile, dtype='int', comments='#')
+    beadlist = read_mask(infile)
 
     # ignore block length
     WIDTH = int(beadlist[0, 0])
@@ -42,61 +59,100 @@ def merge(folder, infile, out_list, verbose, offset_str):
     if verbose:
         print "MaskMerge: block size:", WIDTH, HEIGHT
 
-    # add offset to current block data, ignore first column which contains the block size
-    beadlist[1:, 0] += offsety
-    beadlist[1:, 1] += offsetx
+    # remove first element which contains the block size, add offset to current block data
+    beadlist = beadlist[1:]
+    beadlist[:, 0] += offsety
+    beadlist[:, 1] += offsetx
 
     if verbose:
         print "MaskMerge: Append block with offsets x: "+str(offsetx)+" y: "+str(offsety)
 
-    # remove first element, extend list
-    l = beadlist.tolist()
-    del l[0]
-    out_list.extend(l)
+    return beadlist
 
 
-def main_merge(inputfile, blockfolder, outputfile, verbose, offset_str):
+def merge(folder, infile, out_list, verbose, offset_str):
+    '''Appends bead coordinates of one block mask to out_list'''
+    out_list.extend(read_block((folder, infile, verbose, offset_str)).tolist())
 
-    print "MaskMerge: started"
 
-    if verbose:
-        print "MaskMerge: in:", inputfile
-        print "MaskMerge: out:", outputfile
+def write_text(outputfile, outdata):
+    '''Writes merged mask in the text format, first line holds the chip size'''
+    with open(outputfile, 'w') as f:
+        for start in xrange(0, len(outdata), TEXT_CHUNK_ROWS):
+            chunk = outdata[start:start + TEXT_CHUNK_ROWS]
+            f.write(('%d %d\n' * len(chunk)) % tuple(chunk.ravel()))
 
-    out_list = list()
 
-    # add block data to outputfile
-    for i, folder in enumerate(blockfolder):
+def load_merged(filename):
+    '''Returns merged mask as integer array of (y, x) rows, the first row holds the chip size.
+    Binary masks are memory mapped.'''
+    if filename.endswith('.npy'):
+        return numpy.load(filename, mmap_mode='r')
+    return read_mask(filename)
 
-        if i == 0:
 
-            config = ConfigParser.RawConfigParser()
-            config.read(os.path.join(folder, 'processParameters.txt'))
-            chip = config.get('global', 'Chip')
-            size = chip.split(',')
-            sizex = size[0]
-            sizey = size[1]
+def main_merge(inputfile, blockfolder, outputfile, verbose, offset_str, output_format='binary', processes=None):
+    '''
+    Merges block masks into a chip mask.
+    output_format 'binary' writes <outputfile>.npy, an int32 numpy array of (y, x) rows with the
+    chip size in the first row, 'text' writes the legacy text file, 'both' writes both files.
+    Block masks are read by a pool of processes.
+    '''
 
-            if verbose:
-                print "MaskMerge: chip size:", sizex, sizey
+    print "MaskMerge: started"
 
-            if verbose:
-                print "MaskMerge: write header"
-            # open to write file size
-            f = open(outputfile, 'w')
-            f.write(sizex+" "+sizey+"\n")
-            f.close()
+    if verbose:
+        print "MaskMerge: in:", inputfile
+        print "MaskMerge: out:", outputfile
 
-        merge(folder, inputfile, out_list, verbose, offset_str)
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.join(blockfolder[0], 'processParameters.txt'))
+    chip = config.get('global', 'Chip')
+    size = chip.split(',')
+    sizex = int(size[0])
+    sizey = int(size[1])
 
     if verbose:
-        print "MaskMerge: write", outputfile
+        print "MaskMerge: chip size:", sizex, sizey
+
+    # read block data
+    processes = processes or min(multiprocessing.cpu_count(), len(blockfolder))
+    tasks = [(folder, inputfile, verbose, offset_str) for folder in blockfolder]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            blocks = pool.map(read_block, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        blocks = map(read_block, tasks)
+
+    # merge into preallocated array, memory mapped to the binary output file if requested
+    shape = (1 + sum(len(block) for block in blocks), 2)
+    if output_format in ['binary', 'both']:
+        npyfile = outputfile if outputfile.endswith('.npy') else outputfile + '.npy'
+        if verbose:
+            print "MaskMerge: write", npyfile
+        outdata = numpy.lib.format.open_memmap(npyfile, mode='w+', dtype=numpy.int32, shape=shape)
+    else:
+        outdata = numpy.empty(shape, dtype=numpy.int32)
+
+    outdata[0] = (sizex, sizey)
+    row = 1
+    while blocks:
+        block = blocks.pop(0)
+        outdata[row:row + len(block)] = block
+        row += len(block)
+
+    if output_format in ['text', 'both']:
+        if verbose:
+            print "MaskMerge: write", outputfile
+        write_text(outputfile, outdata)
 
-    # append data
-    f_handle = file(outputfile, 'a')
-    outdata = numpy.array(out_list)
-    numpy.savetxt(f_handle, outdata, fmt='%1.1i')
-    f_handle.close()
+    if isinstance(outdata, numpy.memmap):
+        outdata.flush()
+    del outdata
 
 if __name__ == "__main__":
 
@@ -105,6 +161,10 @@ if __name__ == "__main__":
     parser.add_argument('-i', dest='inputfile', default='MaskBead.mask', help='mask to be merged')
     parser.add_argument('-o', dest='outputfile', default='MaskBead.mask', help='mask to be merged')
     parser.add_argument('-s', '--offset_str', dest='offset_str', default='use_blocks', help=' offset string')
+    parser.add_argument('-f', '--format', dest='output_format', default='binary', choices=['text', 'binary', 'both'],
+                        help='text mask, binary <output>.npy mask, or both')
+    parser.add_argument('-j', dest='processes', type=int, default=None,
+                        help='number of processes reading block masks, default is one per cpu')
     parser.add_argument('blockfolder', nargs='+')
 
     args = parser.parse_args()
@@ -112,4 +172,5 @@ if __name__ == "__main__":
     if args.verbose:
         print "MaskMerge:", args
 
-    main_merge(args.inputfile, args.blockfolder, args.outputfile, args.verbose, args.offset_str)
+    main_merge(args.inputfile, args.blockfolder, args.outputfile, args.verbose, args.offset_str,
+               args.output_format, args.processes)
@@ -36,6 +36,7 @@ from ion.utils import explogparser
 from ion.utils import sigproc
 from ion.utils import basecaller
 from ion.utils import alignment
+from ion.utils import compositemerge
 from ion.utils.file_exists import file_exists
 from ion.utils.compress import make_zip
 from ion.utils.blockprocessing import printtime
@@ -45,6 +46,11 @@ from ion.plugin.remote import call_launchPluginsXMLRPC
 
 from collections import deque
 from urlparse import urlunsplit
+try:
+    import pyinotify
+    HAVE_INOTIFY = True
+except ImportError:
+    HAVE_INOTIFY = False
 
 from ion.reports.plotters import *
 sys.path.append('/opt/ion/')
@@ -304,7 +310,8 @@ def get_mem_usage():
     return "Memory [MB]  Total: {0:6d}   Used: {1:6d}   Free: {2:6d}   Buffers: {3:6d}   Cached: {4:6d}   TotalFree: {5:6d}".format(mem_total, mem_used, mem_free, mem_buffers, mem_cached, mem_total_free)
 
 
-def spawn_cluster_job(rpath, scriptname, args, holds=None):
+def cluster_job_template(rpath, scriptname, args, holds=None):
+    """Returns the job server job template for a script run in rpath"""
     out_path = "%s/drmaa_stdout_block.txt" % rpath
     err_path = "%s/drmaa_stderr_block.txt" % rpath
     cwd = os.getcwd()
@@ -320,40 +327,126 @@ def spawn_cluster_job(rpath, scriptname, args, holds=None):
     # TORQUE
     # jt_nativeSpecification = ""
 
-    jt_remoteCommand = "python"
-    jt_workingDirectory = os.path.join(cwd, rpath)
-    jt_outputPath = ":" + os.path.join(cwd, out_path)
-    jt_errorPath = ":" + os.path.join(cwd, err_path)
-    jt_args = [os.path.join('/usr/bin', scriptname)] + args
-    jt_joinFiles = False
-
     if holds != None and len(holds) > 0:
         jt_nativeSpecification += " -hold_jid "
         for holdjobid in holds:
             jt_nativeSpecification += "%s," % holdjobid
 
+    template = {
+        'nativeSpecification': jt_nativeSpecification,
+        'remoteCommand': "python",
+        'workingDirectory': os.path.join(cwd, rpath),
+        'outputPath': ":" + os.path.join(cwd, out_path),
+        'errorPath': ":" + os.path.join(cwd, err_path),
+        'args': [os.path.join('/usr/bin', scriptname)] + args,
+        'joinFiles': False,
+    }
+
     # TODO remove debug output
-    print jt_remoteCommand
-    print jt_workingDirectory
-    print jt_outputPath
-    print jt_errorPath
-    print jt_args
-    print jt_nativeSpecification
+    for key in ['remoteCommand', 'workingDirectory', 'outputPath', 'errorPath', 'args', 'nativeSpecification']:
+        print template[key]
+
+    return template
+
 
+def spawn_cluster_job(rpath, scriptname, args, holds=None):
+    return spawn_cluster_jobs([cluster_job_template(rpath, scriptname, args, holds)])[0]
+
+
+def spawn_cluster_jobs(templates):
+    """Submits the jobs in one call to the job server, returns list of job ids, -1 for failed jobs"""
     try:
-        jobid = jobserver.submitjob(
-            jt_nativeSpecification,
-            jt_remoteCommand,
-            jt_workingDirectory,
-            jt_outputPath,
-            jt_errorPath,
-            jt_args,
-            jt_joinFiles)
+        jobids = jobserver.submitjob_many(templates, str(env.get('primary_key', '')).strip())
+        return [jobid or -1 for jobid in jobids]
+    except xmlrpclib.Fault:
+        # job server without submitjob_many
+        pass
     except:
         traceback.print_exc()
-        jobid = -1
+        return [-1] * len(templates)
+
+    jobids = []
+    for template in templates:
+        try:
+            jobid = jobserver.submitjob(
+                template['nativeSpecification'],
+                template['remoteCommand'],
+                template['workingDirectory'],
+                template['outputPath'],
+                template['errorPath'],
+                template['args'],
+                template['joinFiles'])
+        except:
+            traceback.print_exc()
+            jobid = -1
+        jobids.append(jobid)
+    return jobids
 
-    return jobid
+
+def get_jobs_status(jobids):
+    """Returns dict of job id to status, in one call to the job server if it supports jobstatus_many"""
+    jobids = [str(jobid) for jobid in jobids]
+    try:
+        return jobserver.jobstatus_many(jobids)
+    except xmlrpclib.Fault:
+        # job server without jobstatus_many
+        status = {}
+        for jobid in jobids:
+            try:
+                status[jobid] = jobserver.jobstatus(jobid)
+            except:
+                traceback.print_exc()
+        return status
+
+
+class BlockInputWatcher(object):
+    """
+    Waits for files to be created in the watched directories, wakes up as soon as a file is
+    written or moved into a directory, or after the timeout.
+    Without pyinotify, or on filesystems without inotify support, it sleeps for the timeout.
+    """
+
+    MASK = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE if HAVE_INOTIFY else 0
+
+    def __init__(self):
+        self.watched = set()
+        self.notifier = None
+        if HAVE_INOTIFY:
+            try:
+                self.wm = pyinotify.WatchManager()
+                # events only wake up the wait, the blocks are checked by the caller
+                self.notifier = pyinotify.Notifier(self.wm, default_proc_fun=lambda event: None)
+            except:
+                traceback.print_exc()
+                self.notifier = None
+
+    def watch(self, dirs):
+        """Adds watches for dirs which exist and are not watched yet"""
+        if self.notifier is None:
+            return
+        for d in dirs:
+            if d not in self.watched and os.path.isdir(d):
+                try:
+                    self.wm.add_watch(d, self.MASK, quiet=False)
+                    self.watched.add(d)
+                except:
+                    printtime("cannot watch %s" % d)
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for a file event, returns elapsed seconds"""
+        start = time.time()
+        if self.notifier is None:
+            time.sleep(timeout)
+        elif self.notifier.check_events(timeout=int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+            # let a burst of files settle before checking the blocks
+            time.sleep(0.5)
+        return time.time() - start
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.stop()
 
 
 if __name__ == "__main__":
@@ -630,65 +723,73 @@ if __name__ == "__main__":
 
         plugins_params['block_dirs'] = [os.path.join(env['report_root_dir'], result_dirs[block['id_str']]) for block in blocks_to_process]
 
+        def block_input_file(block):
+            if doSigproc:
+                if is_single:
+                    return os.path.join(env['pathToRaw'], 'acq_0000.dat')
+                elif is_thumbnail:
+                    return os.path.join(env['pathToRaw'], '..', block['id_str'], 'acq_0000.dat')  # TODO
+                else:  # is_composite
+                    return os.path.join(env['pathToRaw'], block['id_str'], 'acq_0000.dat')
+            else:
+                if is_composite:
+                    # look for all analysis_return_code.txt files, this is the last file beeing transfered
+                    return os.path.join(env['SIGPROC_RESULTS'], 'block_'+block['id_str'], 'analysis_return_code.txt')
+                else:  # is_thumbnail or is_single:
+                    return os.path.join(env['SIGPROC_RESULTS'], 'analysis_return_code.txt')
+
+        # wake up as soon as block input files appear instead of polling every 10 sec
+        watcher = BlockInputWatcher()
+        first = True
+
         while len(blocks_to_process) > 0 and timeout > 0:
 
             printtime('waiting for %s block(s) to schedule    %s' % (str(len(blocks_to_process)), get_mem_usage()))
             sys.stdout.flush()
             sys.stderr.flush()
 
-            # wait 10 sec before looking for new files
-            timeout -= 10
-            time.sleep(10)
-
-            blocks_to_process_ready = []
-            if doSigproc:
+            if not first:
+                # watch the input directories and their parents, block directories may not exist yet
+                input_dirs = set()
                 for block in blocks_to_process:
-                    if is_single:
-                        data_file = os.path.join(env['pathToRaw'], 'acq_0000.dat')
-                    elif is_thumbnail:
-                        data_file = os.path.join(env['pathToRaw'], '..', block['id_str'], 'acq_0000.dat')  # TODO
-                    else:  # is_composite
-                        data_file = os.path.join(env['pathToRaw'], block['id_str'], 'acq_0000.dat')
-
-                    if os.path.exists(data_file):
-                        blocks_to_process_ready.append(block)
-                    else:
-                        if debug_mode:
-                            printtime("missing %s" % data_file)
+                    input_dir = os.path.dirname(block_input_file(block))
+                    input_dirs.add(input_dir)
+                    input_dirs.add(os.path.dirname(input_dir))
+                watcher.watch(input_dirs)
+                timeout -= watcher.wait(10)
+            first = False
 
-            else:
-                for block in blocks_to_process:
-                    if is_composite:
-                        # look for all analysis_return_code.txt files, this is the last file beeing transfered
-                        data_file = os.path.join(env['SIGPROC_RESULTS'], 'block_'+block['id_str'], 'analysis_return_code.txt')
-                    else:  # is_thumbnail or is_single:
-                        data_file = os.path.join(env['SIGPROC_RESULTS'], 'analysis_return_code.txt')
-
-                    if os.path.exists(data_file) and os.path.getsize(data_file) > 0:
-                        blocks_to_process_ready.append(block)
-                    else:
-                        if debug_mode:
-                            printtime("missing %s" % data_file)
+            blocks_to_process_ready = []
+            for block in blocks_to_process:
+                data_file = block_input_file(block)
+                if os.path.exists(data_file) and (doSigproc or os.path.getsize(data_file) > 0):
+                    blocks_to_process_ready.append(block)
+                else:
+                    if debug_mode:
+                        printtime("missing %s" % data_file)
 
             printtime('try to schedule %s new block(s)' % str(len(blocks_to_process_ready)))
 
-            for block in blocks_to_process_ready:
-
-                wait_list = []
-                try:
-                    if env['blockArgs'] == "fromRaw":
-                        block_tlscript_options = ['--do-sigproc', '--do-basecalling']
-                    else:
-                        block_tlscript_options = ['--do-basecalling']
-
-                    block['jobid'] = spawn_cluster_job(result_dirs[block['id_str']], 'BlockTLScript.py', block_tlscript_options, wait_list)
-                    block_job_dict[block['id_str']] = str(block['jobid'])
-                    printtime("Submitted block (%s) job with job ID (%s)" % (block['id_str'], str(block['jobid'])))
-                except:
+            # submit all ready blocks in one call
+            if env['blockArgs'] == "fromRaw":
+                block_tlscript_options = ['--do-sigproc', '--do-basecalling']
+            else:
+                block_tlscript_options = ['--do-basecalling']
+            templates = [cluster_job_template(result_dirs[block['id_str']], 'BlockTLScript.py', block_tlscript_options, [])
+                         for block in blocks_to_process_ready]
+            jobids = spawn_cluster_jobs(templates) if templates else []
+
+            for block, jobid in zip(blocks_to_process_ready, jobids):
+                block['jobid'] = jobid
+                block_job_dict[block['id_str']] = str(block['jobid'])
+                if jobid == -1:
                     printtime("submitting job for block (%s) failed" % block['id_str'])
+                else:
+                    printtime("Submitted block (%s) job with job ID (%s)" % (block['id_str'], str(block['jobid'])))
 
                 blocks_to_process.remove(block)
 
+        watcher.close()
         if timeout <= 0:
             printtime("Error: timeout while processing blocks")
 
@@ -713,16 +814,36 @@ if __name__ == "__main__":
         # Watch status of jobs.  As they finish remove the job from the list.
 
         pl_started = False
-        block_job_list = block_job_dict.values()
-        while len(block_job_list) > 0:
-            for job in block_job_list:
-                block = [block for block in blocks if block['jobid'] == job][0]
-                # check status of jobid
-                try:
-                    block['status'] = jobserver.jobstatus(block['jobid'])
-                except:
-                    traceback.print_exc()
+        # running blocks by name, blocks whose submission failed have no job to watch
+        running_blocks = {}
+        for block in blocks:
+            if 'jobid' not in block:
+                continue
+            if block['jobid'] == -1:
+                block['status'] = 'failed'
+                printtime("Block (%s) has ended with status failed, its job was not submitted" % block['id_str'])
+            else:
+                running_blocks[block['id_str']] = block
+        while len(running_blocks) > 0:
+            # check status of all running block jobs in one call
+            try:
+                jobs_status = get_jobs_status([block['jobid'] for block in running_blocks.values()])
+            except:
+                traceback.print_exc()
+                jobs_status = {}
+
+            for id_str, block in sorted(running_blocks.items()):
+                job = str(block['jobid'])
+                if job not in jobs_status:
                     continue
+                block['status'] = jobs_status[job]
+
+                # fold finished block into the running composite merge state
+                if is_composite and block['status'] == 'done':
+                    try:
+                        compositemerge.fold_blocks([result_dirs[block['id_str']]], env)
+                    except:
+                        traceback.print_exc()
 
                 if blocklevel_plugins and (block['status'] == 'done'):
                     plugins_params['blockId'] = block['id_str']
@@ -730,7 +851,7 @@ if __name__ == "__main__":
 
                 if block['status'] == 'done' or block['status'] == 'failed' or block['status'] == "DRMAA BUG":
                     printtime("Job %s has ended with status %s" % (str(block['jobid']), block['status']))
-                    block_job_list.remove(block['jobid'])
+                    del running_blocks[id_str]
 #                else:
 #                    printtime("Job %s has status %s" % (str(block['jobid']),block['status']))
 
@@ -738,7 +859,7 @@ if __name__ == "__main__":
                 plugins = runplugins(plugins, env, RunLevel.SEPARATOR, plugins_params)
                 pl_started = True
 
-            printtime("waiting for %d blocks to be finished    %s" % (len(block_job_list), get_mem_usage()))
+            printtime("waiting for %d blocks to be finished    %s" % (len(running_blocks), get_mem_usage()))
             time.sleep(10)
 
         merge_job_list = merge_job_dict.keys()
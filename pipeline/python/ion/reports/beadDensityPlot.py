@@ -17,6 +17,7 @@ import argparse
 import struct
 import numpy
 import math
+import multiprocessing
 import scipy.ndimage
 import scipy.misc
 import scipy.signal
@@ -55,6 +56,11 @@ def makeContourMap(arr, HEIGHT, WIDTH, outputId, maskId, plt_title, average, out
     scores = scipy.ndimage.correlate(arr, numpy.ones((10, 10), dtype=numpy.int16), mode='reflect')
     del arr
     scores = reasonable_shrink(scores)
+    makeDensityPlots(scores, HEIGHT, WIDTH, outputId, maskId, plt_title, average, outputdir, barcodeId, vmaxVal)
+
+
+def makeDensityPlots(scores, HEIGHT, WIDTH, outputId, maskId, plt_title, average, outputdir, barcodeId=-1, vmaxVal=100):
+    # scores are loading density [0-100] of the downsampled chip
     makeContourPlot(scores, average, HEIGHT, WIDTH, outputId, maskId, plt_title, outputdir, barcodeId, vmaxVal)
     pil_transposed_scores = numpy.flipud(scores)
     makeRawDataPlot(pil_transposed_scores, outputId, outputdir)
@@ -164,31 +170,123 @@ def extractMaskInfo(filename):
 def makeBarcodeArr(qBcId, row, col, bcIds, HEIGHT, WIDTH):
     # TODO: x/y are reversed from what is typical
     # print "makeBarcodeArr", qBcId, row, col, bcIds, HEIGHT, WIDTH
-    counts = 0
+    selected = (bcIds == qBcId)
     arr = numpy.zeros((HEIGHT, WIDTH))
-    for i in range(len(row)):
-        if qBcId == bcIds[i]:
-            arr[row[i], col[i]] = 1
-            counts += 1
-    return arr, counts
+    arr[row[selected], col[selected]] = 1
+    return arr, int(numpy.count_nonzero(selected))
+
+
+def readBarcodeMaskBin(filePath):
+    """Read the barcodeMask.bin written by BaseCaller (Mask::WriteRaw): uint32 rows,
+    uint32 columns, then one uint16 barcode id per well, 0xffff for wells without read."""
+    with open(filePath, 'rb') as f:
+        height, width = struct.unpack('<II', f.read(8))
+        values = numpy.fromfile(f, dtype='<u2', count=height * width)
+    wells = numpy.flatnonzero(values != 0xffff)
+    beadlist = numpy.empty((len(wells) + 1, 3), dtype=numpy.int32)
+    beadlist[0] = (width, height, 0)
+    beadlist[1:, 0] = wells // width
+    beadlist[1:, 1] = wells % width
+    beadlist[1:, 2] = values[wells]
+    return beadlist
+
+
+def readBarcodeMask(filePath):
+    """Read barcode mask, either text, binary .npy or BaseCaller's barcodeMask.bin, as
+    int32 array of (row, col, barcode id) rows. The first row holds the chip width and height."""
+    if filePath.endswith('.npy'):
+        return numpy.load(filePath)
+    if filePath.endswith('.bin'):
+        return readBarcodeMaskBin(filePath)
+    with open(filePath) as f:
+        data = f.read()
+    if '#' in data:
+        data = '\n'.join(line.split('#', 1)[0] for line in data.splitlines())
+    # header line has two values, bead lines have three
+    header, _, data = data.lstrip().partition('\n')
+    width, height = [int(v) for v in header.split()[:2]]
+    beadlist = numpy.fromstring(data, dtype=numpy.int32, sep=' ').reshape(-1, 3)
+    return numpy.vstack(([[width, height, 0]], beadlist))
 
 
 def extractBarcodeMaskInfo(filePath):
     INPUTFILE = filePath
     print "Reading", INPUTFILE
-    beadlist = numpy.loadtxt(INPUTFILE, dtype='int', comments='#')
+    beadlist = readBarcodeMask(INPUTFILE)
     WIDTH = int(beadlist[0, 0])
     HEIGHT = int(beadlist[0, 1])
     bcbead_row = (beadlist[1:, 0])  # really y, but is first column
     bcbead_col = (beadlist[1:, 1])  # really x, but is the second column
     bcbead_bcIds = (beadlist[1:, 2])
 
-    unique_barcodeIds = dict.fromkeys(bcbead_bcIds).keys();
+    unique_barcodeIds = numpy.unique(bcbead_bcIds).tolist()
     print "Unique barcode ids found: ", unique_barcodeIds
 
     return unique_barcodeIds, HEIGHT, WIDTH, bcbead_row, bcbead_col, bcbead_bcIds
 
 
+def barcodeDensityGrids(HEIGHT, WIDTH, row, col, bcIds, bound=1000, threshold=2000):
+    """Yield (barcode id, bead count, scores) for every barcode found.
+
+    Beads are sorted by barcode once and each barcode's wells are binned
+    with numpy.bincount. Chips larger than threshold are binned into blocks
+    of wells, so that the grid is no larger than bound, and scores are the
+    percentage of loaded wells of each block. Smaller chips keep one bin per
+    well and are scored over a 10x10 well area as in makeContourMap.
+    """
+    largest = max(HEIGHT, WIDTH)
+    step = int(math.ceil(float(largest) / bound)) if largest > threshold else 1
+    h = (HEIGHT + step - 1) // step
+    w = (WIDTH + step - 1) // step
+    cells = (row // step).astype(numpy.int64) * w + col // step
+
+    order = numpy.argsort(bcIds, kind='mergesort')
+    sorted_ids = bcIds[order]
+    unique_ids, starts = numpy.unique(sorted_ids, return_index=True)
+    ends = numpy.append(starts[1:], len(sorted_ids))
+    for barcodeId, start, end in zip(unique_ids, starts, ends):
+        counts = numpy.bincount(cells[order[start:end]], minlength=h * w).reshape(h, w)
+        if step > 1:
+            scores = counts * (100.0 / (step * step))
+        else:
+            scores = scipy.ndimage.correlate(counts.astype(numpy.int16), numpy.ones((10, 10), dtype=numpy.int16),
+                                             mode='reflect').astype(float)
+        yield int(barcodeId), end - start, reasonable_shrink(scores)
+
+
+def _plotBarcodeDensity(args):
+    makeDensityPlots(*args)
+    return args[3]
+
+
+def genBarcodeHeatmaps(filePath, outputdir, plot_title, processes=None):
+    """Write loading density plots for every barcode of a barcode mask,
+    named barcode_<id>_density_*.png. Plots are rendered by a process pool.
+    Returns the plotted output ids."""
+    unique_barcodeIds, HEIGHT, WIDTH, row, col, bcIds = extractBarcodeMaskInfo(filePath)
+    if not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+
+    tasks = []
+    for barcodeId, counts, scores in barcodeDensityGrids(HEIGHT, WIDTH, row, col, bcIds):
+        average = 100.0 * counts / (HEIGHT * WIDTH)
+        vmaxVal = min(100, max(5, int(math.ceil(scores.max()))))
+        tasks.append((scores, HEIGHT, WIDTH, 'barcode_%d' % barcodeId, '', plot_title, average, outputdir,
+                      barcodeId, vmaxVal))
+
+    processes = processes or min(multiprocessing.cpu_count(), max(len(tasks), 1))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            done = pool.map(_plotBarcodeDensity, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        done = map(_plotBarcodeDensity, tasks)
+    return done
+
+
 def genHeatmap(filePath, bfmaskstatspath, outputdir, plot_title):
     #
     # Called from TLScript.py
@@ -220,6 +318,10 @@ if __name__ == "__main__":
     parser.add_argument('maskfile', default='bfmask.bin', help='e.g. bfmask.bin')
     parser.add_argument('bfmask', default='bfmask.stats', help='e.g. bfmask.stats')
     parser.add_argument('plt_title', default='title', help='e.g. FOZ-223')
+    parser.add_argument('--barcodemask', default=None, help='e.g. basecaller_results/barcodeMask.bin, also plot each barcode')
+    parser.add_argument('--barcodedir', default='./', help='output directory of the barcode plots')
     args = parser.parse_args()
 
     genHeatmap(args.maskfile, args.bfmask, "./", args.plt_title)
+    if args.barcodemask:
+        genBarcodeHeatmaps(args.barcodemask, args.barcodedir, args.plt_title)
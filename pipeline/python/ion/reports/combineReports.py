@@ -70,9 +70,22 @@ def wait_on_jobs(jobIds, jobName, status="Processing", max_running_jobs=0):
     # wait for job to finish
     while len(jobIds) > max_running_jobs:
         printtime("waiting for %s job(s) to finish ..." % jobName)
-        for jobid in jobIds:
+        try:
+            # status of all jobs in one call
+            jobs_status = jobserver.jobstatus_many([str(jobid) for jobid in jobIds])
+        except xmlrpclib.Fault:
+            # job server without jobstatus_many
+            jobs_status = None
+        except:
+            traceback.print_exc()
+            jobs_status = {}
+
+        for jobid in list(jobIds):
             try:
-                jobstatus = jobserver.jobstatus(jobid)
+                if jobs_status is None:
+                    jobstatus = jobserver.jobstatus(jobid)
+                else:
+                    jobstatus = jobs_status.get(str(jobid))
             except:
                 traceback.print_exc()
                 continue
@@ -243,7 +243,6 @@ def merge_datasets_basecaller_json(dirs, BASECALLER_RESULTS):
     # 
 
     block_datasets_json = []
-    combined_datasets_json = {}
 
     for dir in dirs:
         current_datasets_path = os.path.join(dir, BASECALLER_RESULTS, 'datasets_basecaller.json')
@@ -258,33 +257,53 @@ def merge_datasets_basecaller_json(dirs, BASECALLER_RESULTS):
         printtime("merge_basecaller_results: no block contained a valid datasets_basecaller.json, aborting")
         return
 
-    combined_datasets_json = copy.deepcopy(block_datasets_json[0])
+    combined_datasets_json = init_combined_datasets_json(block_datasets_json[0])
+    for current_datasets_json in block_datasets_json:
+        fold_datasets_json(combined_datasets_json, current_datasets_json)
+    write_combined_datasets_json(combined_datasets_json, BASECALLER_RESULTS)
+
+
+def init_combined_datasets_json(template_datasets_json):
+    '''Returns a composite datasets_basecaller.json with all counts reset, using a block's json as template'''
+
+    combined_datasets_json = copy.deepcopy(template_datasets_json)
+    sections = [combined_datasets_json]
+    if "IonControl" in combined_datasets_json:
+        sections.append(combined_datasets_json['IonControl'])
+    for section in sections:
+        for dataset in section['datasets']:
+            dataset['read_count'] = 0
+        for read_group in section['read_groups'].itervalues():
+            initalize_combined_readgroup(read_group)
+    return combined_datasets_json
+
+
+def fold_datasets_json(combined_datasets_json, current_datasets_json):
+    '''Adds the read counts of one block's datasets_basecaller.json to the composite json'''
 
     # Merging dataset entries
     for dataset_idx in range(len(combined_datasets_json['datasets'])):
-        combined_datasets_json['datasets'][dataset_idx]['read_count'] = 0
-        for current_datasets_json in block_datasets_json:
-            combined_datasets_json['datasets'][dataset_idx]['read_count'] += current_datasets_json['datasets'][dataset_idx].get("read_count", 0)
+        combined_datasets_json['datasets'][dataset_idx]['read_count'] += current_datasets_json['datasets'][dataset_idx].get("read_count", 0)
 
     # Merging read group entries
     for read_group in combined_datasets_json['read_groups'].iterkeys():
-        initalize_combined_readgroup(combined_datasets_json['read_groups'][read_group])
-        for current_datasets_json in block_datasets_json:
-            combine_read_groups(combined_datasets_json['read_groups'][read_group], current_datasets_json['read_groups'], read_group)
-        compute_read_group_averages(combined_datasets_json['read_groups'][read_group])
+        combine_read_groups(combined_datasets_json['read_groups'][read_group], current_datasets_json['read_groups'], read_group)
 
     # And merging information for control barcode datasets & read groups if available
     if "IonControl" in combined_datasets_json:
-        # Merging dataset entries
         for dataset_idx in range(len(combined_datasets_json['IonControl']['datasets'])):
-            combined_datasets_json['IonControl']['datasets'][dataset_idx]['read_count'] = 0
-            for current_datasets_json in block_datasets_json:
-                combined_datasets_json['IonControl']['datasets'][dataset_idx]['read_count'] += current_datasets_json['IonControl']['datasets'][dataset_idx].get("read_count", 0)
-        # Merging read group entries
+            combined_datasets_json['IonControl']['datasets'][dataset_idx]['read_count'] += current_datasets_json['IonControl']['datasets'][dataset_idx].get("read_count", 0)
+        for read_group in combined_datasets_json['IonControl']['read_groups'].iterkeys():
+            combine_read_groups(combined_datasets_json['IonControl']['read_groups'][read_group], current_datasets_json['IonControl']['read_groups'], read_group)
+
+
+def write_combined_datasets_json(combined_datasets_json, BASECALLER_RESULTS):
+    '''Computes averages and barcode filters of the composite json and writes datasets_basecaller.json'''
+
+    for read_group in combined_datasets_json['read_groups'].iterkeys():
+        compute_read_group_averages(combined_datasets_json['read_groups'][read_group])
+    if "IonControl" in combined_datasets_json:
         for read_group in combined_datasets_json['IonControl']['read_groups'].iterkeys():
-            initalize_combined_readgroup(combined_datasets_json['IonControl']['read_groups'][read_group])
-            for current_datasets_json in block_datasets_json:
-                combine_read_groups(combined_datasets_json['IonControl']['read_groups'][read_group], current_datasets_json['IonControl']['read_groups'], read_group)
             compute_read_group_averages(combined_datasets_json['IonControl']['read_groups'][read_group])
 
     # Barcode filters -------------------------------------------------------
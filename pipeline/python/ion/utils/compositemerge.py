@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+
+'''
+Incremental composite merge.
+TLScript folds the outputs of each block into a running composite state as soon as the block
+job is done, MergeTLScript then only folds the blocks that are still missing and writes the
+composite files. Folded per block:
+    datasets_basecaller.json  read counts, read group and barcode statistics
+    avgNukeTrace_<key>.txt    bead weighted trace sums
+The state is kept in a json file in the report directory. BAM files, bead masks and
+BaseCaller.json are merged by MergeTLScript as before.
+'''
+
+import os
+import copy
+import json
+import numpy
+import traceback
+
+from ion.utils.blockprocessing import printtime
+from ion.utils import basecaller
+from ion.utils import sigproc
+
+STATE_FILE = 'composite_merge_state.json'
+
+# basecaller results subdirectories with a datasets_basecaller.json to merge
+DATASETS_SUBDIRS = ['', 'unfiltered.untrimmed', 'unfiltered.trimmed']
+
+
+def avg_nuke_trace_keys(env):
+    return [(env['libraryKey'], 'Library Beads'), (env['tfKey'], 'Test Fragment Beads')]
+
+
+def block_ok(subdir, SIGPROC_RESULTS):
+    '''Same criterion MergeTLScript uses to select the blocks to merge'''
+    analysis_return_code_file = os.path.join(subdir, SIGPROC_RESULTS, "analysis_return_code.txt")
+    if os.path.exists(analysis_return_code_file):
+        with open(analysis_return_code_file, 'r') as f:
+            return f.read() == '0'
+    return False
+
+
+def new_state():
+    return {'blocks': [], 'datasets': {}, 'avgNukeTrace': {'sums': {}, 'wells': {}, 'labels': {}}}
+
+
+def load_state(filename=STATE_FILE):
+    '''Returns the running composite state, a new state if there is none'''
+    state = new_state()
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'r') as f:
+                state = json.load(f)
+            traces = state['avgNukeTrace']
+            for key in traces['sums']:
+                traces['sums'][key] = numpy.array(traces['sums'][key])
+                traces['labels'][key] = numpy.array(traces['labels'][key])
+        except:
+            traceback.print_exc()
+            printtime("ERROR: cannot read %s, starting new composite state" % filename)
+            state = new_state()
+    return state
+
+
+def save_state(state, filename=STATE_FILE):
+    '''Writes the state to a temporary file first, readers never see a partial file'''
+    traces = state['avgNukeTrace']
+    out = dict(state)
+    out['avgNukeTrace'] = {
+        'sums': dict((key, value.tolist()) for key, value in traces['sums'].items()),
+        'wells': traces['wells'],
+        'labels': dict((key, value.tolist()) for key, value in traces['labels'].items()),
+    }
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(out, f)
+    os.rename(tmpfile, filename)
+
+
+def fold_block(state, subdir, env):
+    '''Folds the outputs of one finished block into the state, returns False if the block is not merged'''
+    if subdir in state['blocks']:
+        return True
+    if not block_ok(subdir, env['SIGPROC_RESULTS']):
+        printtime("INFO: %s not merged" % subdir)
+        return False
+
+    for datasets_subdir in DATASETS_SUBDIRS:
+        results_dir = os.path.join(env['BASECALLER_RESULTS'], datasets_subdir) if datasets_subdir else env['BASECALLER_RESULTS']
+        current_datasets_path = os.path.join(subdir, results_dir, 'datasets_basecaller.json')
+        if not os.path.exists(current_datasets_path):
+            continue
+        try:
+            with open(current_datasets_path, 'r') as f:
+                current_datasets_json = json.load(f)
+            if 'datasets' not in current_datasets_json or 'read_groups' not in current_datasets_json:
+                printtime("ERROR: skipped %s" % current_datasets_path)
+                continue
+            if results_dir not in state['datasets']:
+                state['datasets'][results_dir] = basecaller.init_combined_datasets_json(current_datasets_json)
+            basecaller.fold_datasets_json(state['datasets'][results_dir], current_datasets_json)
+        except:
+            traceback.print_exc()
+            printtime("ERROR: skipped %s" % current_datasets_path)
+
+    traces = state['avgNukeTrace']
+    block, block_traces, seconds = sigproc._read_block_traces((subdir, env['SIGPROC_RESULTS'], avg_nuke_trace_keys(env)))
+    sigproc.fold_block_traces(traces['sums'], traces['wells'], traces['labels'], block_traces)
+
+    state['blocks'].append(subdir)
+    return True
+
+
+def fold_blocks(dirs, env, filename=STATE_FILE):
+    '''Folds finished blocks into the state file, called by TLScript as block jobs finish'''
+    state = load_state(filename)
+    folded = [subdir for subdir in dirs if subdir not in state['blocks'] and fold_block(state, subdir, env)]
+    if folded:
+        save_state(state, filename)
+        printtime("Folded %s into composite state, %d blocks merged" % (', '.join(folded), len(state['blocks'])))
+    return state
+
+
+def finalize(dirs, env, filename=STATE_FILE):
+    '''
+    Returns the composite state for the blocks in dirs, blocks not yet folded are folded now.
+    The state file is not modified. Returns None if the state holds blocks which are not in dirs,
+    the caller has to do a full merge then.
+    '''
+    state = load_state(filename)
+    if set(state['blocks']) - set(dirs):
+        printtime("INFO: composite state does not match blocks to merge")
+        return None
+
+    missing = [subdir for subdir in dirs if subdir not in state['blocks']]
+    printtime("Finalizing composite merge: %d blocks folded while running, %d blocks left" %
+              (len(dirs) - len(missing), len(missing)))
+    for subdir in missing:
+        fold_block(state, subdir, env)
+    return state
+
+
+def write_avg_nuke_traces(state, env):
+    traces = state['avgNukeTrace']
+    sigproc.write_avg_nuke_traces(traces['sums'], traces['wells'], traces['labels'],
+                                  env['SIGPROC_RESULTS'], avg_nuke_trace_keys(env))
+
+
+def write_datasets_json(state, results_dir):
+    '''Writes composite datasets_basecaller.json to results_dir, returns False if no block had one'''
+    if results_dir not in state['datasets']:
+        return False
+    basecaller.write_combined_datasets_json(copy.deepcopy(state['datasets'][results_dir]), results_dir)
+    return True
@@ -2,12 +2,23 @@
 # Copyright (C) 2012 Ion Torrent Systems, Inc. All Rights Reserved
 
 import os
+import time
+import math
 import subprocess
 import json
 import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from ion.utils.blockprocessing import printtime
 
+# ionstats reduce: maximum number of files per call, seconds to wait for input files to appear
+# and to be complete
+REDUCE_MAX_FAN_IN = 100
+REDUCE_MISSING_TIMEOUT = 30
+REDUCE_INPUT_TIMEOUT = 300
+REDUCE_INPUT_POLL = 0.5
+
 
 ''' Invoke ionstats basecaller to generate alignment-independent metrics for unmapped BAM files'''
 
@@ -337,37 +348,121 @@ def generate_ionstats_tf(tf_bam_filename, tfref_fasta_filename, ionstats_tf_file
 ''' Invoke ionstats reduce to combine multiple ionstats json files by merging the metrics '''
 
 
-def reduce_stats(input_filename_list, output_filename):
+def wait_for_inputs(filenames, timeout=REDUCE_INPUT_TIMEOUT, missing_timeout=REDUCE_MISSING_TIMEOUT,
+                    poll=REDUCE_INPUT_POLL):
+    '''
+    Wait until the input files are complete: they exist, their size and mtime did not change
+    between two polls, and json files can be parsed. Files written by asynchronous process
+    substitution commands usually complete within seconds. Files which do not exist after
+    missing_timeout are not waited for any longer. Returns list of files not ready when
+    the timeout expired.
+    '''
+    pending = dict((filename, None) for filename in filenames)
+    started = time.time()
+    while pending:
+        for filename, last_stat in pending.items():
+            try:
+                st = os.stat(filename)
+            except OSError:
+                if time.time() - started >= missing_timeout:
+                    printtime("WARNING: ionstats reduce input does not exist: %s" % filename)
+                    del pending[filename]
+                continue
+            current = (st.st_size, st.st_mtime)
+            if current != last_stat or st.st_size == 0:
+                pending[filename] = current
+                continue
+            if filename.endswith('.json'):
+                try:
+                    with open(filename) as f:
+                        json.load(f)
+                except ValueError:
+                    continue
+            del pending[filename]
+        if not pending or time.time() - started >= timeout:
+            break
+        time.sleep(poll)
+    for filename in pending:
+        printtime("WARNING: ionstats reduce input not ready after %d seconds: %s" % (timeout, filename))
+    return pending.keys()
+
+
+def _reduce_tree_levels(input_filename_list, output_filename, fan_in):
+    '''
+    Returns balanced merge tree as list of levels, each a list of (input files, output file)
+    reductions.  Inputs keep their order, the last level writes output_filename.
+    '''
+    levels = []
+    inputs = list(input_filename_list)
+    level = 0
+    while True:
+        groups = int(math.ceil(float(len(inputs)) / fan_in))
+        if groups <= 1:
+            levels.append([(inputs, output_filename)])
+            return levels
+        size = int(math.ceil(float(len(inputs)) / groups))
+        reductions = []
+        for index, start in enumerate(range(0, len(inputs), size)):
+            reductions.append((inputs[start:start+size], "%s.L%d.%d" % (output_filename, level, index)))
+        levels.append(reductions)
+        inputs = [output_file for _, output_file in reductions]
+        level += 1
+
+
+def _reduce(args):
+    command, input_files, output_file, wait = args
+    if wait:
+        wait_for_inputs(input_files)
+    com = command
+    com += " -o %s" % (output_file)
+    com += " " + " ".join(input_files)
+    printtime("DEBUG: Calling '%s'" % com)
+    proc = subprocess.Popen(com, shell=True)
+    proc.wait()
+    if proc.returncode != 0:
+        raise Exception('ERROR: %s return code: %s' % (command, proc.returncode))
+
+
+def reduce_tree(command, input_filename_list, output_filename, max_fan_in=REDUCE_MAX_FAN_IN, processes=None):
+    '''
+    Reduce input files with an ionstats reduce command along a balanced merge tree.
+    The leaf reductions run at the same time, each as soon as its own input files are complete,
+    and each further level starts when the level below it is done.
+    Intermediate files are removed once the output file is written.
+    '''
+    inputs = list(input_filename_list)
+    if not inputs:
+        printtime("%s: no input files for %s" % (command, output_filename))
+        return
+    processes = processes or multiprocessing.cpu_count()
+    # spread the leaves over the available cpus
+    fan_in = max(2, min(max_fan_in, int(math.ceil(float(len(inputs)) / processes))))
+    levels = _reduce_tree_levels(inputs, output_filename, fan_in)
 
-    # wait for asynchronous process substitution processes # TODO
-    import time
-    time.sleep(10)
+    pool = ThreadPool(min(processes, len(levels[0])))
+    try:
+        for level, reductions in enumerate(levels):
+            start = time.time()
+            pool.map(_reduce, [(command, input_files, output_file, level == 0)
+                               for input_files, output_file in reductions])
+            printtime("%s level %d: %d reductions of %d files in %.1f seconds" % (
+                command, level, len(reductions), sum(len(i) for i, _ in reductions), time.time() - start))
+    finally:
+        pool.close()
+        pool.join()
+
+    for reductions in levels[:-1]:
+        for _, output_file in reductions:
+            try:
+                os.remove(output_file)
+            except OSError:
+                pass
+
+
+def reduce_stats(input_filename_list, output_filename):
 
     try:
-        # need to copy, cannot index an iterator
-        copy_input_filename_list = list(input_filename_list)
-        length = len(copy_input_filename_list)
-
-        # process file list in smaller intervalls
-        size = 100
-        i = 0
-        while (i < length):
-            if i+size < length:
-                input_files = copy_input_filename_list[i:i+size]
-                output_file = output_filename+"."+str(i+size)
-            else:
-                input_files = copy_input_filename_list[i:length]
-                output_file = output_filename
-            # add results from earlier iterations
-            if i > 0:
-                input_files = input_files+[output_filename+"."+str(i)]
-            i = i+size
-
-            com = "ionstats reduce"
-            com += " -o %s" % (output_file)
-            com += " " + " ".join(input_files)
-            printtime("DEBUG: Calling '%s'" % com)
-            subprocess.call(com, shell=True)
+        reduce_tree("ionstats reduce", input_filename_list, output_filename)
     except:
         printtime('ERROR: Failed ionstats reduce')
         traceback.print_exc()
@@ -376,33 +471,7 @@ def reduce_stats(input_filename_list, output_filename):
 def reduce_stats_h5(input_filename_list, output_filename):
 
     try:
-        # need to copy, cannot index an iterator
-        copy_input_filename_list = list(input_filename_list)
-        length = len(copy_input_filename_list)
-
-        # process file list in smaller intervalls
-        size = 100
-        i = 0
-        while (i < length):
-            if i+size < length:
-                input_files = copy_input_filename_list[i:i+size]
-                output_file = output_filename+"."+str(i+size)
-            else:
-                input_files = copy_input_filename_list[i:length]
-                output_file = output_filename
-            # add results from earlier iterations
-            if i > 0:
-                input_files = input_files+[output_filename+"."+str(i)]
-            i = i+size
-
-            com = "ionstats reduce-h5"
-            com += " -o %s" % (output_file)
-            com += " " + " ".join(input_files)
-            printtime("DEBUG: Calling '%s'" % com)
-            proc = subprocess.Popen(com, shell=True)
-            status = proc.wait()
-            if proc.returncode != 0:
-                raise Exception('ERROR: ionstats reduce-h5 return code: %s' % proc.returncode)
+        reduce_tree("ionstats reduce-h5", input_filename_list, output_filename)
     except:
         printtime('ERROR: Failed ionstats reduce-h5')
         traceback.print_exc()
@@ -6,6 +6,8 @@ import subprocess
 import traceback
 import time
 import numpy
+import itertools
+import multiprocessing
 import ConfigParser
 
 from ion.reports import beadDensityPlot, StatsMerge, plotKey
@@ -209,45 +211,97 @@ def mergeRawPeakSignals(dirs):
 '''
 
 
-def mergeAvgNukeTraces(dirs, SIGPROC_RESULTS, key, beads):
+def read_avg_nuke_trace(input_trace_file):
+    '''Returns labels and data columns of an avgNukeTrace_*.txt file, read once'''
+    labels = []
+    rows = []
+    with open(input_trace_file) as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split(' ')
+            if not line.strip():
+                continue
+            labels.append(fields[0])
+            # empty fields are nan, as with numpy.genfromtxt(delimiter=' ')
+            rows.append([float(v) if v else numpy.nan for v in fields[1:]])
+    return numpy.array(labels), numpy.array(rows)
 
-    # 
-    # Merging avgNukeTrace_*.txt files            #
-    # 
-    printtime("Merging avgNukeTrace_*.txt files")
 
+def _read_block_traces(args):
+    '''Worker: reads one block's bfmask.stats and avgNukeTrace files'''
+    subdir, SIGPROC_RESULTS, keys = args
+    start = time.time()
+    traces = {}
     try:
-        output_trace_file = os.path.join(SIGPROC_RESULTS, 'avgNukeTrace_%s.txt' % key)
-        sumAvgNukeTraceData = None
-        sumWells = 0
         config = ConfigParser.RawConfigParser()
-
-        for subdir in dirs:
+        config.read(os.path.join(subdir, SIGPROC_RESULTS, 'bfmask.stats'))
+        for key, beads in keys:
+            input_trace_file = os.path.join(subdir, SIGPROC_RESULTS, 'avgNukeTrace_%s.txt' % key)
+            if not os.path.exists(input_trace_file):
+                continue
             try:
-                input_trace_file = os.path.join(subdir, SIGPROC_RESULTS, 'avgNukeTrace_%s.txt' % key)
-                if os.path.exists(input_trace_file):
-                    config.read(os.path.join(subdir, SIGPROC_RESULTS, 'bfmask.stats'))
-                    wells = config.getint('global', beads)
-                    labels = numpy.genfromtxt(input_trace_file, delimiter=' ',  usecols=[0], dtype=str)
-                    currentAvgNukeTraceData = numpy.genfromtxt(input_trace_file, delimiter=' ')[:, 1:]
-                else:
-                    continue
+                wells = config.getint('global', beads)
+                labels, data = read_avg_nuke_trace(input_trace_file)
+                traces[key] = (labels, data, wells)
             except:
                 traceback.print_exc()
-                continue
+    except:
+        traceback.print_exc()
+    return subdir, traces, time.time() - start
 
-            if sumAvgNukeTraceData == None:
-                sumAvgNukeTraceData = currentAvgNukeTraceData * wells
-            else:
-                sumAvgNukeTraceData += currentAvgNukeTraceData * wells
-            sumWells += wells
 
-        AvgNukeTraceData = sumAvgNukeTraceData / sumWells
-        AvgNukeTraceTable = numpy.column_stack((labels, AvgNukeTraceData.astype('|S10')))
-        numpy.savetxt(output_trace_file, AvgNukeTraceTable, fmt='%s')
+def mergeBlockAvgNukeTraces(dirs, SIGPROC_RESULTS, keys, processes=None):
+    '''
+    Merges avgNukeTrace_<key>.txt files of the blocks for each (key, beads) in keys, weighting
+    each block's trace by its number of beads from bfmask.stats.
+    Each block's files are read once by a worker pool, and block results are added up as they
+    arrive.
+    '''
+    printtime("Merging avgNukeTrace_*.txt files")
 
-    except:
-        traceback.print_exc()
-        printtime("ERROR: Merging %s failed" % output_trace_file)
+    sums = dict((key, None) for key, beads in keys)
+    sumWells = dict((key, 0) for key, beads in keys)
+    labels = {}
 
+    tasks = [(subdir, SIGPROC_RESULTS, keys) for subdir in dirs]
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        results = pool.imap(_read_block_traces, tasks) if pool else itertools.imap(_read_block_traces, tasks)
+        for subdir, traces, seconds in results:
+            printtime("DEBUG: %s: read %d avgNukeTrace files in %.2f seconds" % (subdir, len(traces), seconds))
+            fold_block_traces(sums, sumWells, labels, traces)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    write_avg_nuke_traces(sums, sumWells, labels, SIGPROC_RESULTS, keys)
     printtime("Finished mergeAvgNukeTraces")
+
+
+def fold_block_traces(sums, sumWells, labels, traces):
+    '''Adds one block's traces, as returned by _read_block_traces, to the bead weighted sums per key'''
+    for key, (block_labels, data, wells) in traces.items():
+        if sums.get(key) is None:
+            sums[key] = data * wells
+        else:
+            sums[key] += data * wells
+        sumWells[key] = sumWells.get(key, 0) + wells
+        labels[key] = block_labels
+
+
+def write_avg_nuke_traces(sums, sumWells, labels, SIGPROC_RESULTS, keys):
+    '''Writes the composite avgNukeTrace_<key>.txt files from the bead weighted sums'''
+    for key, beads in keys:
+        output_trace_file = os.path.join(SIGPROC_RESULTS, 'avgNukeTrace_%s.txt' % key)
+        try:
+            AvgNukeTraceData = sums[key] / sumWells[key]
+            AvgNukeTraceTable = numpy.column_stack((labels[key], AvgNukeTraceData.astype('|S10')))
+            numpy.savetxt(output_trace_file, AvgNukeTraceTable, fmt='%s')
+        except:
+            traceback.print_exc()
+            printtime("ERROR: Merging %s failed" % output_trace_file)
+
+
+def mergeAvgNukeTraces(dirs, SIGPROC_RESULTS, key, beads):
+    mergeBlockAvgNukeTraces(dirs, SIGPROC_RESULTS, [(key, beads)])
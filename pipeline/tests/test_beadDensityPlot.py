@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+
+import unittest
+import sys
+import os.path
+import shutil
+import struct
+import tempfile
+
+test_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.normpath(os.path.join(test_dir, "../python/")))
+
+import numpy
+
+
+def write_barcode_mask(path, ids):
+    # as BaseCaller writes it, Mask::WriteRaw
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<II', ids.shape[0], ids.shape[1]))
+        f.write(ids.astype('<u2').tostring())
+
+
+class BarcodeHeatmaps(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(1)
+        # rows, columns; wells without read are 0xffff
+        self.ids = rng.choice([0, 1, 2, 5, 0xffff], size=(120, 100))
+        self.mask = os.path.join(self.tmpdir, 'barcodeMask.bin')
+        write_barcode_mask(self.mask, self.ids)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_barcode_mask_bin(self):
+        from ion.reports import beadDensityPlot
+        unique_ids, HEIGHT, WIDTH, row, col, bcIds = beadDensityPlot.extractBarcodeMaskInfo(self.mask)
+        self.assertEqual((HEIGHT, WIDTH), (120, 100))
+        self.assertEqual(unique_ids, [0, 1, 2, 5])
+        self.assertTrue((self.ids[row, col] == bcIds).all())
+        self.assertEqual(len(bcIds), (self.ids != 0xffff).sum())
+
+    def test_barcode_heatmaps(self):
+        from ion.reports import beadDensityPlot
+        outputdir = os.path.join(self.tmpdir, 'barcode_density')
+        done = beadDensityPlot.genBarcodeHeatmaps(self.mask, outputdir, 'test run', processes=1)
+        self.assertEqual(sorted(done), ['barcode_0', 'barcode_1', 'barcode_2', 'barcode_5'])
+        for outputId in done:
+            for plot in ('contour', 'raw'):
+                path = os.path.join(outputdir, '%s_density_%s.png' % (outputId, plot))
+                self.assertTrue(os.path.getsize(path) > 0, path)
+
+
+if __name__ == "__main__":
+    unittest.main()
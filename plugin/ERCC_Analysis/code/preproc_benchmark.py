@@ -0,0 +1,133 @@
+# Copyright (C) 2016 Ion Torrent Systems, Inc. All Rights Reserved
+#
+# Throughput of the ERCC base quality trimming in reads/s, compared to the previous per base
+# implementation. Trimmed reads of both implementations are compared, the exit code is 1 if
+# they differ. Reads are taken from a bam file, or generated if no bam file is given.
+#
+# Usage: preproc_benchmark.py [-i reads.bam] [-n reads] [-j processes]
+
+from __future__ import division
+import argparse
+import os
+import sys
+import time
+import tempfile
+from itertools import izip
+import numpy as np
+
+import preproc_fastq
+
+THRESHOLD = 15
+MIN_LENGTH = 20
+
+
+# --------------------------------------------------#
+# Previous implementation
+# --------------------------------------------------#
+
+reverse_enumerate = lambda l: izip(xrange(len(l)-1, -1, -1), reversed(l))
+
+def window_mean_quality_score(ascii_string):
+    mean_quality_score = 0
+    for char in ascii_string:
+        mean_quality_score += (ord(char) - 33)
+    mean_quality_score = mean_quality_score / len(ascii_string)
+    return mean_quality_score
+
+def legacy_base_quality_trim(base_seq, quality_metric_seq, threshold, min_length):
+    base_seq_length = len(base_seq)
+    if base_seq_length < min_length:
+        return ''
+    else:
+        window_size = int(base_seq_length / 10)
+    new_base_seq = []
+    for position, base in reverse_enumerate(base_seq):
+        if (position + window_size) >= base_seq_length:
+            window_end = base_seq_length
+        else:
+            window_end = position + window_size
+        if (window_mean_quality_score(quality_metric_seq[position:window_end]) >= threshold):
+            new_base_seq = base_seq[:position]
+            break
+        else:
+            continue
+    if (len(new_base_seq) >= min_length):
+        return new_base_seq
+    else:
+        return ''
+
+# --------------------------------------------------#
+# Benchmark
+# --------------------------------------------------#
+
+def generated_reads(nreads, seed=1):
+    '''Returns (seq, qual) reads of 20 to 300 bases, quality decreasing along the read'''
+    rng = np.random.RandomState(seed)
+    reads = []
+    for length in rng.randint(20, 300, nreads):
+        qual = np.clip(35 - np.arange(length) * rng.uniform(0.05, 0.3) + rng.normal(0, 6, length), 2, 40)
+        reads.append(('A' * length, ''.join(chr(int(q) + 33) for q in qual)))
+    return reads
+
+def bam_reads(bam, nreads):
+    import pysam
+    input_bam = pysam.Samfile(bam, mode="rb", check_header=False, check_sq=False)
+    reads = []
+    for x in input_bam.fetch(until_eof=True):
+        reads.append((x.seq, x.qual))
+        if len(reads) >= nreads:
+            break
+    input_bam.close()
+    return reads
+
+def main(bam, nreads, processes):
+    reads = bam_reads(bam, nreads) if bam else generated_reads(nreads)
+    print('%d reads from %s' % (len(reads), bam or 'generator'))
+
+    start_time = time.time()
+    legacy = [legacy_base_quality_trim(seq, qual, THRESHOLD, MIN_LENGTH) for seq, qual in reads]
+    legacy_rate = len(reads) / (time.time() - start_time)
+
+    start_time = time.time()
+    trimmed = []
+    for i in range(0, len(reads), preproc_fastq.BATCH_READS):
+        batch = reads[i:i + preproc_fastq.BATCH_READS]
+        lengths = preproc_fastq.quality_trim_lengths([qual for seq, qual in batch], THRESHOLD, MIN_LENGTH)
+        trimmed.extend(seq[:length] for (seq, qual), length in izip(batch, lengths))
+    rate = len(reads) / (time.time() - start_time)
+
+    different = sum(1 for a, b in izip(legacy, trimmed) if a != b)
+    print('base quality trim  %10.0f reads/s   legacy %10.0f reads/s   %s' % (
+        rate, legacy_rate, 'same' if different == 0 else '%d reads DIFFERENT' % different))
+
+    if bam:
+        # whole preprocessing including bam reading and fastq writing
+        fd, fastq = tempfile.mkstemp(suffix='.fastq')
+        os.close(fd)
+        total = nreads_in(bam)
+        try:
+            for nproc in sorted(set([1, processes])):
+                start_time = time.time()
+                preproc_fastq.bam_preproc(bam, fastq, THRESHOLD, MIN_LENGTH, nproc)
+                print('bam_preproc, %2d processes  %10.0f reads/s' % (nproc, total / (time.time() - start_time)))
+        finally:
+            os.remove(fastq)
+
+    return 1 if different else 0
+
+def nreads_in(bam):
+    import pysam
+    input_bam = pysam.Samfile(bam, mode="rb", check_header=False, check_sq=False)
+    n = sum(1 for x in input_bam.fetch(until_eof=True))
+    input_bam.close()
+    return n
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', dest='bam', default=None, help='bam file, reads are generated if not given')
+    parser.add_argument('-n', dest='nreads', type=int, default=100000, help='number of reads to trim')
+    parser.add_argument('-j', dest='processes', type=int, default=4, help='number of processes for bam_preproc')
+    args = parser.parse_args()
+
+    sys.exit(main(args.bam, args.nreads, args.processes))
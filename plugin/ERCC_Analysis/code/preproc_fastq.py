@@ -6,38 +6,45 @@ import os
 import sys
 from itertools import izip
 import traceback
+import shutil
+import multiprocessing
+import numpy as np
 import pysam
 
-reverse_enumerate = lambda l: izip(xrange(len(l)-1, -1, -1), reversed(l))
+# reads trimmed at once
+BATCH_READS = 10000
 
-def window_mean_quality_score(ascii_string):
-    mean_quality_score = 0
-    for char in ascii_string:
-        mean_quality_score += (ord(char) - 33)
-    mean_quality_score = mean_quality_score / len(ascii_string)
-    return mean_quality_score
+def quality_trim_lengths(quals, threshold, min_length):
+    """
+    Returns the trimmed length of each read of a list of quality strings, 0 if the read is dropped.
+    Reads are trimmed before the last position where the mean quality of the window of
+    1/10 of the read length starting there is >= threshold. The window means of all bases
+    of all reads are computed at once from a cumulative sum.
+    """
+    lengths = np.array([len(q) for q in quals], dtype=np.int64)
+    trimmed = np.zeros(len(quals), dtype=np.int64)
+    # reads shorter than 10 bases have an empty window, they are dropped
+    sel = np.nonzero((lengths >= min_length) & (lengths >= 10))[0]
+    if sel.size == 0:
+        return trimmed
+
+    read_lengths = lengths[sel]
+    offsets = np.concatenate(([0], np.cumsum(read_lengths)))
+    qual = np.frombuffer(''.join(quals[i] for i in sel), dtype=np.uint8).astype(np.int64) - 33
+    qsum = np.concatenate(([0], np.cumsum(qual)))
+
+    base = np.arange(offsets[-1])
+    window_end = np.minimum(base + np.repeat(read_lengths // 10, read_lengths), np.repeat(offsets[1:], read_lengths))
+    window_mean = (qsum[window_end] - qsum[base]) / (window_end - base)
+
+    # last position per read with window mean >= threshold, -1 if there is none
+    last = np.maximum.reduceat(np.where(window_mean >= threshold, base, -1), offsets[:-1])
+    position = last - offsets[:-1]
+    trimmed[sel] = np.where((last >= 0) & (position >= min_length), position, 0)
+    return trimmed
 
 def base_quality_trim(base_seq, quality_metric_seq, threshold, min_length):
-    base_seq_length = len(base_seq)
-    if base_seq_length < min_length:
-        return ''
-    else:
-        window_size = int(base_seq_length / 10)
-    new_base_seq = []
-    for position, base in reverse_enumerate(base_seq):
-        if (position + window_size) >= base_seq_length:
-            window_end = base_seq_length
-        else:
-            window_end = position + window_size
-        if (window_mean_quality_score(quality_metric_seq[position:window_end]) >= threshold):
-            new_base_seq = base_seq[:position]
-            break
-        else:
-            continue
-    if (len(new_base_seq) >= min_length):
-        return new_base_seq
-    else:
-        return ''
+    return base_seq[:quality_trim_lengths([quality_metric_seq], threshold, min_length)[0]]
 
 
 def process_read(read,threshold,min_length):
@@ -51,24 +58,92 @@ def process_read(read,threshold,min_length):
         read.qual = ''
 
 
-def bam_preproc(path_to_input_bam, path_to_output_file, threshold, min_length):
+def write_trimmed(records, output_fastq, threshold, min_length):
+    lengths = quality_trim_lengths([qual for qname, seq, qual in records], threshold, min_length)
+    for (qname, seq, qual), length in izip(records, lengths):
+        if length:
+            output_fastq.write("@%s\n%s\n+\n%s\n" % (qname, seq[:length], qual[:length]))
 
-    input_bam = pysam.Samfile(path_to_input_bam, mode="rb",check_header=False,check_sq=False)
-    #output_bam = pysam.Samfile(path_to_output_file, mode="wb",template=input_bam,check_header=False,check_sq=False)
-    output_fastq = open(path_to_output_file, 'w')
-    for y in input_bam.fetch(until_eof=True):
-        x = y
+
+def preproc_reads(reads, output_fastq, threshold, min_length):
+    """
+    Trims the bam records of reads in batches and writes them to output_fastq.
+    Reverse reads are reverse complemented first.
+    """
+    records = []
+    for x in reads:
         if x.is_reverse:
-            xqual = x.qual
-            x.seq = reverse_complement(x.seq)
-            x.qual = xqual[::-1]       
-        process_read(x,threshold,min_length)
-        #output_bam.write(x)
-        if x.seq:
-            output_fastq.write("@%s\n%s\n+\n%s\n" % (x.qname,x.seq,x.qual))
+            records.append((x.qname, reverse_complement(x.seq), x.qual[::-1]))
+        else:
+            records.append((x.qname, x.seq, x.qual))
+        if len(records) >= BATCH_READS:
+            write_trimmed(records, output_fastq, threshold, min_length)
+            records = []
+    write_trimmed(records, output_fastq, threshold, min_length)
+
+
+def bam_regions(input_bam):
+    """
+    Returns the references of an indexed bam to process in parallel, None stands for the
+    reads without coordinate. Returns an empty list if the bam has no index.
+    """
+    try:
+        input_bam.mapped # needs the index
+    except (ValueError, AttributeError):
+        return []
+    if not input_bam.references:
+        return []
+    regions = list(input_bam.references)
+    if getattr(input_bam, 'nocoordinate', 1):
+        regions.append(None)
+    return regions
+
+
+def preproc_region(args):
+    """Pool worker, writes the trimmed reads of one region to a fastq shard"""
+    path_to_input_bam, path_to_shard, region, threshold, min_length = args
+    input_bam = pysam.Samfile(path_to_input_bam, mode="rb",check_header=False,check_sq=False)
+    if region is None:
+        reads = (x for x in input_bam.fetch(until_eof=True) if x.tid < 0)
+    else:
+        reads = input_bam.fetch(region)
+    with open(path_to_shard, 'w') as output_fastq:
+        preproc_reads(reads, output_fastq, threshold, min_length)
+    input_bam.close()
+    return path_to_shard
+
+
+def bam_preproc(path_to_input_bam, path_to_output_file, threshold, min_length, processes=None):
+    """
+    Writes the quality trimmed reads of a bam file to a fastq file.
+    Indexed bam files are split by reference across a pool of processes, the fastq shards
+    written per reference are concatenated at the end. Other bam files are read serially.
+    """
+    input_bam = pysam.Samfile(path_to_input_bam, mode="rb",check_header=False,check_sq=False)
+    regions = bam_regions(input_bam)
+    processes = processes or multiprocessing.cpu_count()
+
+    if processes < 2 or not regions:
+        with open(path_to_output_file, 'w') as output_fastq:
+            preproc_reads(input_bam.fetch(until_eof=True), output_fastq, threshold, min_length)
+        input_bam.close()
+        return
     input_bam.close()
-    #output_bam.close()
-    output_fastq.close()
+
+    tasks = [(path_to_input_bam, '%s.%d' % (path_to_output_file, i), region, threshold, min_length)
+             for i, region in enumerate(regions)]
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        shards = pool.map(preproc_region, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(path_to_output_file, 'w') as output_fastq:
+        for shard in shards:
+            with open(shard, 'r') as f:
+                shutil.copyfileobj(f, output_fastq)
+            os.remove(shard)
 
 def reverse_complement(seq):
     revcomp = {'A':'T','T':'A','C':'G','G':'C','N':'N','t':'a','c':'g','g':'c','n':'n','a': 't'}
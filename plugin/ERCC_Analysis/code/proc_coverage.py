@@ -5,9 +5,16 @@
 import numpy as np
 import sys
 import time
+import array
+import multiprocessing
+
+import pysam
 
 import ercc_seq_utils
 
+# reads buffered per contig before they are added to the coverage arrays
+READ_BUFFER = 1000000
+
 
 # ------------------------------
 # HTML Template
@@ -105,6 +112,58 @@ def bin_contig(contig, nbins=100):
   return bins
 
 
+# ------------------------------
+# Coverage events
+# ------------------------------
+
+def coverage_events(length, starts, read_lengths):
+  """
+  Returns (diff, start_sites) for reads at 0-based starts on a contig of length.
+  diff is the int32 difference array of the coverage (length + 1 values, the
+  coverage is its prefix sum), start_sites the int32 count of reads per start
+  position. Reads are clipped like the slice contig[start:start+read_length].
+  """
+
+  starts = np.asarray(starts, dtype=np.int64)
+  ends   = starts + np.asarray(read_lengths, dtype=np.int64)
+
+  # numpy slice semantics: negative positions count from the contig end, then clip
+  first = np.clip(np.where(starts < 0, starts + length, starts), 0, length)
+  last  = np.clip(np.where(ends < 0, ends + length, ends), 0, length)
+  keep  = last > first
+
+  diff  = np.bincount(first[keep], minlength=length + 1).astype(np.int32)
+  diff -= np.bincount(last[keep], minlength=length + 1).astype(np.int32)
+
+  sites = np.where(starts < 0, starts + length, starts)
+  sites = sites[(sites >= 0) & (sites < length)]
+  start_sites = np.bincount(sites, minlength=length).astype(np.int32)
+
+  return diff, start_sites
+
+def contig_events(args):
+  """
+  Pool worker, returns (contig_id, count, diff, start_sites) of the reads
+  of one contig of an indexed bam file, diff and start_sites are None if the
+  contig has no reads.
+  """
+
+  bam, contig_id, length = args
+  starts = array.array('l')
+  read_lengths = array.array('l')
+
+  stream = pysam.Samfile(bam, 'rb')
+  for read in stream.fetch(contig_id):
+    starts.append(read.pos - 1)
+    read_lengths.append(len(read.seq))
+  stream.close()
+
+  if not starts:
+    return contig_id, 0, None, None
+  diff, start_sites = coverage_events(length, starts, read_lengths)
+  return contig_id, len(starts), diff, start_sites
+
+
 # ------------------------------
 # Sam File Processor
 # ------------------------------
@@ -115,10 +174,13 @@ class SamCoverage:
   """
 
   def __init__(self, genome=None):
-    self.contigs     = {} # id: coverage array
-    self.start_sites = {} # id: start-site array
+    self.lengths     = {} # id: contig length
+    self.diffs       = {} # id: coverage difference array, only for contigs with reads
+    self.start_sites = {} # id: start-site array, only for contigs with reads
     self.counts      = {} # id: read count
     self.order       = []   # maintain the contig order for output
+    self.buffered    = {} # id: (starts, read lengths) of reads not yet added
+    self.nbuffered   = 0
 
     if genome is not None:
       self.parse_genome(genome)
@@ -134,20 +196,59 @@ class SamCoverage:
       ...
       contigN size
 
-    Each contig is represented by a np array with one integer for
-    each base position.  Note that for human scale genomes, this will
-    use approximately 24 GB of RAM (12 GB each for the contigs and
-    start site arrays).
+    Coverage arrays are allocated when the first reads of a contig are
+    added, and hold differences of the coverage depth between positions.
+    The coverage of a contig is computed when it is requested.
     """
 
     for contig, length in ercc_seq_utils.file_values(genome, skip_header=False):
-      self.contigs[contig]     = np.zeros(int(length), np.int32)
-      self.start_sites[contig] = np.zeros(int(length), np.int32)      
+      self.lengths[contig] = int(length)
       self.counts[contig]  = 0
       self.order.append(contig)
       
     return
 
+  def add_read(self, rname, pos, length):
+    """
+    Add a read at 0-based pos to contig rname. Reads are buffered and added
+    to the coverage arrays in batches.
+    """
+
+    if rname not in self.buffered:
+      self.buffered[rname] = (array.array('l'), array.array('l'))
+    starts, read_lengths = self.buffered[rname]
+    starts.append(pos)
+    read_lengths.append(length)
+    self.counts[rname] += 1
+
+    self.nbuffered += 1
+    if self.nbuffered >= READ_BUFFER:
+      self.flush()
+
+    return
+
+  def add_events(self, contig_id, diff, start_sites):
+    if contig_id in self.diffs:
+      self.diffs[contig_id]       += diff
+      self.start_sites[contig_id] += start_sites
+    else:
+      self.diffs[contig_id]       = diff
+      self.start_sites[contig_id] = start_sites
+    return
+
+  def flush(self):
+    """
+    Add the buffered reads to the coverage arrays.
+    """
+
+    for contig_id, (starts, read_lengths) in self.buffered.items():
+      diff, start_sites = coverage_events(self.lengths[contig_id], starts, read_lengths)
+      self.add_events(contig_id, diff, start_sites)
+
+    self.buffered  = {}
+    self.nbuffered = 0
+    return
+
   def parse_sam(self, sam):
     """
     Read the records from a sam file, updating the coverage arrays
@@ -155,18 +256,54 @@ class SamCoverage:
     """
 
     for read, rname in ercc_seq_utils.sam_stream(sam):
-      pos    = read.pos - 1 # convert to 0-based positions
-      length = len(read.seq)
-
       # Ignore contigs that are not in the genome file
-      if not self.contigs.has_key(rname): continue
+      if rname not in self.lengths: continue
+
+      self.add_read(rname, read.pos - 1, len(read.seq)) # convert to 0-based positions
+
+    self.flush()
+    return
 
-      self.contigs[rname][pos:pos+length] += 1
-      self.start_sites[rname][pos] += 1
-      self.counts[rname] += 1
+  def parse_bam(self, bam, processes=None):
+    """
+    Read the records from an indexed bam file, the contigs are read by
+    a pool of processes.
+    """
+
+    stream = pysam.Samfile(bam, 'rb')
+    tasks = [(bam, contig_id, self.lengths[contig_id]) for contig_id in stream.references if contig_id in self.lengths]
+    stream.close()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+      for contig_id, count, diff, start_sites in pool.imap_unordered(contig_events, tasks):
+        self.counts[contig_id] += count
+        if count:
+          self.add_events(contig_id, diff, start_sites)
+    finally:
+      pool.close()
+      pool.join()
 
     return
 
+  def coverage(self, contig_id):
+    """
+    Return the coverage array of a contig.
+    """
+
+    if contig_id not in self.diffs:
+      return np.zeros(self.lengths[contig_id], np.int32)
+    return np.cumsum(self.diffs[contig_id][:-1], dtype=np.int32)
+
+  def starts(self, contig_id):
+    """
+    Return the start-site array of a contig.
+    """
+
+    if contig_id not in self.start_sites:
+      return np.zeros(self.lengths[contig_id], np.int32)
+    return self.start_sites[contig_id]
+
   # ------------------------------
   # Iterators
   # ------------------------------
@@ -180,12 +317,12 @@ class SamCoverage:
     
   def coverage_iter(self):
     for contig_id in self.order:
-      yield contig_id, self.contigs[contig_id]
+      yield contig_id, self.coverage(contig_id)
     return
   
   def start_site_iter(self):
     for contig_id in self.order:
-      yield contig_id, self.start_sites[contig_id]
+      yield contig_id, self.starts(contig_id)
     return
   
   def bin_iter(self, nbins=100, start_sites = False):
@@ -193,11 +330,11 @@ class SamCoverage:
     Return a binned version of each contig.
     """
 
-    if start_sites: contigs = self.start_sites
-    else:           contigs = self.contigs
+    if start_sites: contigs = self.start_site_iter()
+    else:           contigs = self.coverage_iter()
       
-    for contig_id in self.order:
-      yield contig_id, bin_contig(contigs[contig_id], nbins)
+    for contig_id, contig in contigs:
+      yield contig_id, bin_contig(contig, nbins)
 
     return
 
@@ -214,8 +351,8 @@ class SamCoverage:
     """
     
     for contig_id in self.order:
-      contig = self.contigs[contig_id]
-      start_sites = self.start_sites[contig_id]
+      contig = self.coverage(contig_id)
+      start_sites = self.starts(contig_id)
       counts = self.counts[contig_id]
 
       results = {}
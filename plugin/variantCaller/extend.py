@@ -11,6 +11,7 @@ import subprocess
 import zipfile
 import glob
 import sqlite3
+import threading
 
 def printtime(message, *args):
     if args:
@@ -30,29 +31,94 @@ def run_command(command,description):
 
 WINDOW = 300
 
-def _execute(path, query, limit, offset):
-    """Function to execute queries against a local sqlite database"""
+# imp.load_source executes this module again for every extend request,
+# keep the connections and caches of earlier requests
+_connections = globals().get('_connections', {}) # db path: (db file identity, connection)
+_counts = globals().get('_counts', {}) # (db path, db file identity, where): number of matching rows
+_page_keys = globals().get('_page_keys', {}) # (db path, db file identity, query, offset): sort key of the row before offset
+_lock = globals().get('_lock', threading.Lock())
+
+# cached page keys are dropped when there are more
+MAX_PAGE_KEYS = 10000
+
+
+def _connection(dbPath):
+    """Returns (db file identity, connection), the read only connection is reused until the db file changes"""
+    stat = os.stat(dbPath)
+    identity = (stat.st_ino, stat.st_size, stat.st_mtime)
+    cached = _connections.get(dbPath)
+    if cached and cached[0] == identity:
+        return cached
+    if cached:
+        cached[1].close()
+    connection = sqlite3.connect(dbPath, check_same_thread=False)
+    connection.execute("PRAGMA query_only = 1")
+    _connections[dbPath] = (identity, connection)
+    return _connections[dbPath]
+
+
+def _keyset(columns, key, direction):
+    """Returns SQL condition and parameters selecting the rows after key in the order of columns"""
+    op = "<" if direction == "DESC" else ">"
+    terms = []
+    params = []
+    for i, column in enumerate(columns):
+        term = ['"{0}" = ?'.format(c) for c in columns[:i]] + ['"{0}" {1} ?'.format(column, op)]
+        terms.append("(" + " AND ".join(term) + ")")
+        params.extend(key[:i+1])
+    # bound on the first column lets sqlite use the index of the sort column as a range
+    return '"{0}" {1}= ? AND ('.format(columns[0], op) + " OR ".join(terms) + ")", [key[0]] + params
+
+
+def _execute(path, where, columns, direction, limit, offset):
+    """
+    Function to execute queries against a local sqlite database.
+    Returns the number of rows matching where and one page of rows ordered by columns.
+    Pages following a page read before are selected by the sort key of its last row
+    instead of OFFSET, the number of matching rows is counted once per filter.
+    """
 
-    page_str = " LIMIT {limit} OFFSET {offset}".format(limit=limit, offset=offset)
+    if not os.path.exists(os.path.join(path,"alleles.db")):
+        raise Exception("Unable to open database file")
+    dbPath = os.path.join(path,'alleles.db')
 
-    if os.path.exists(os.path.join(path,"alleles.db")):
-        dbPath = os.path.join(path,'alleles.db')
-        connection = sqlite3.connect(dbPath)
+    # id makes the order unique
+    columns = list(columns) + ["id"]
+    order = ", ".join('"{0}" {1}'.format(column, direction) for column in columns)
+    limit = int(limit)
+    offset = int(offset)
 
+    with _lock:
+        identity, connection = _connection(dbPath)
         cursorobj = connection.cursor()
-        try:
-                cursorobj.execute(query + page_str)
-                result = cursorobj.fetchall()
-
-                #now find the total number of records that match the query
-                cursorobj.execute(query.replace("SELECT *", "SELECT COUNT(*)") )
-                count =  cursorobj.fetchall()
-        except Exception as e:
-                raise e
-        connection.close()
-        return count, result
-    else:
-        raise Exception("Unable to open database file")
+
+        page_key = (dbPath, identity, where, order)
+        key = _page_keys.get(page_key + (offset,))
+        if key is not None:
+            condition, params = _keyset(columns, key, direction)
+            condition = (where + " AND " if where else "WHERE ") + condition
+            q = 'SELECT * FROM variants {where} ORDER BY {order} LIMIT ?'.format(where=condition, order=order)
+            cursorobj.execute(q, params + [limit])
+        else:
+            q = 'SELECT * FROM variants {where} ORDER BY {order} LIMIT ? OFFSET ?'.format(where=where, order=order)
+            cursorobj.execute(q, [limit, offset])
+        result = cursorobj.fetchall()
+
+        if result and None not in result[-1]:
+            names = [d[0] for d in cursorobj.description]
+            if len(_page_keys) >= MAX_PAGE_KEYS:
+                _page_keys.clear()
+            _page_keys[page_key + (offset + len(result),)] = [result[-1][names.index(column)] for column in columns]
+
+        #now find the total number of records that match the query
+        count_key = (dbPath, identity, where)
+        if count_key not in _counts:
+            cursorobj.execute('SELECT COUNT(*) FROM variants {where}'.format(where=where))
+            _counts[count_key] = cursorobj.fetchone()[0]
+        count = _counts[count_key]
+        cursorobj.close()
+
+    return count, result
 
 
 def query(bucket):
@@ -98,26 +164,23 @@ def query(bucket):
     #now do filtering 1 column and direction at a time
     column = bucket["request_get"].get("column", False)
     direction = bucket["request_get"].get("direction", "ASC")
+    if direction != "DESC":
+        direction = "ASC"
 
-    #TODO do the WHERE filtering
-    #TODO just use string.format to make all the SQL, the built in parameterasation feature isn't good enough
     if column:
-        q= 'SELECT * FROM variants {where} ORDER BY "{column}" {direction}'.format(
-                        column=column, direction=direction, where=where_str)
+        columns = [column]
         #lower case position is a special field that has a combination of chrm and the Position (int)
         if column == "position":
             #order by the by the ChromSort, then the position
-            q= 'SELECT * FROM variants {where} ORDER BY "ChromSort" {direction}, "Position" {direction}'.format(
-                direction=direction, where=where_str)
-        count, rows = _execute(path, q, limit, offset)
+            columns = ["ChromSort", "Position"]
     else:
-        q = 'SELECT * FROM variants {where} ORDER BY "id"'.format(
-                where=where_str)
-        count, rows = _execute(path, q, limit, offset)
+        columns = []
+        direction = "ASC"
+    count, rows = _execute(path, where_str, columns, direction, limit, offset)
 
     #make the first item the total count of items
     data = {}
-    data["total"] = [count[0][0]]
+    data["total"] = [count]
     data["items"] = []
     for row in rows:
         data["items"].append(row)
@@ -12,6 +12,28 @@ import sqlite3
 import json
 import os
 
+# columns the variantCaller allele table sorts and filters by, indexed when present
+INDEXED_COLUMNS = [
+    ('ChromSort', 'Position'),
+    ('Position',),
+    ('Chrom',),
+    ('Frequency',),
+    ('Quality',),
+    ('Coverage',),
+    ('Allele Call',),
+    ('Type',),
+    ('Allele Source',),
+    ('Allele Name',),
+    ('Gene ID',),
+    ('Region Name',),
+]
+
+def create_indexes(c, table, headers):
+    for i, columns in enumerate(INDEXED_COLUMNS):
+        if all(column in headers for column in columns):
+            c.execute('CREATE INDEX IF NOT EXISTS %s_idx%d ON %s (%s)' % (
+                table, i, table, ','.join('"%s"' % column for column in columns)))
+
 def convert(filepath_or_fileobj, dbpath, table='data'):
     if isinstance(filepath_or_fileobj, basestring):
         fo = open(filepath_or_fileobj)
@@ -48,19 +70,25 @@ def convert(filepath_or_fileobj, dbpath, table='data'):
     else:
         print "there isn't a variant_summary file, the ordering will be random"
 
+    def rows():
+        for i, row in enumerate(reader):
+            # we need to take out commas from int and floats for sqlite to
+            # recognize them properly ...
+            row = [ x.replace(',', '') if y in ['real', 'integer'] else x
+                    for (x,y) in zip(row, types) ]
+
+            #convert the chrom name into an int so it can be sorted
+            row.insert(0, chromosome_order.get(row[0], 0))
+            #insert the PK, starting at 0
+            row.insert(0,i)
+            yield row
+
     #add one more ? to be for the PK
     _insert_tmpl = 'insert into %s values (%s)' % (table, ','.join(['?']*(2+len(headers))))
-    for i, row in enumerate(reader):
-        # we need to take out commas from int and floats for sqlite to
-        # recognize them properly ...
-        row = [ x.replace(',', '') if y in ['real', 'integer'] else x
-                for (x,y) in zip(row, types) ]
-
-        #convert the chrom name into an int so it can be sorted
-        row.insert(0, chromosome_order.get(row[0], 0))
-        #insert the PK, starting at 0
-        row.insert(0,i)
-        c.execute(_insert_tmpl, row)
+    #all rows in one transaction, indexes are built after loading
+    c.executemany(_insert_tmpl, rows())
+    create_indexes(c, table, ['ChromSort'] + headers)
+    c.execute('ANALYZE')
 
     conn.commit()
     c.close()
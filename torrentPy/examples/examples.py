@@ -75,6 +75,20 @@ def read_Dat( file_name ):
     
     return locals()
 
+def read_Tiles( wells_name, dat_name, bam_name ):
+    #Work through a whole chip one tile at a time, the next tile is loaded while the current one is processed
+    max_amplitude = 0
+    for row, col, w in torrentPy.IO.wellsTiles(wells_name, tile=(10,10), flows=(0,8)):   #(row,col) of the tile corner, (10,10,8) array
+        max_amplitude = max(max_amplitude, w.max())
+    wells = torrentPy.IO.wellsReader(wells_name)   #whole chip at once, for comparison
+
+    flow_means = [ w.mean() for flow, w in torrentPy.IO.wellsFlows(wells_name, flows=(0,4)) ]   #one (rows,cols) array per flow
+
+    dat_tiles = [ (row, col, d.shape) for row, col, d in torrentPy.IO.datTiles(dat_name, tile=(50,50), region=(10,20,100,100)) ]
+
+    numReads = sum( len(reads) for reads in torrentPy.IO.bamReads(bam_name, chunk=100) )   #lists of up to 100 reads
+    return locals()
+
 def read_BfMask( file_name ):
     #Loading beadfind mask, Library reads
     bfmask = torrentPy.LoadBfMaskByType(file_name,torrentPy.BfMask.MaskLib)
@@ -93,6 +107,17 @@ def read_Debug( dir_name ):
     print "Bead Params: ", beadParams
     return locals()
 
+def read_Debug_Batch( dir_name ):
+    db = torrentPy.IonDebugData.DebugParams( dir_name )
+    db.LoadData()
+    pos = numpy.array([(row,col) for row in range(10,30) for col in range(10,40)]) #(N,2) array of (row,col) positions
+    #batch versions return structured arrays, one record per position
+    regParams=db.getBgRegionParamsArray(pos, 7, "G")
+    beadParams=db.getBeadParamsArray(pos, 7)
+    print "Regional Params: ", regParams.dtype.names
+    print "Bead amplitude: ", beadParams['amplitude'].mean()
+    return locals()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-d','--data-dir',help='path to debug data directory',default='.')
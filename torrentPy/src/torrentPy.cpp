@@ -644,79 +644,74 @@ boost::python::object PyRawDat::LoadWells( const boost::python::tuple& pos ){
 
 class PyWells{
     std::string fname;
+    RawWells wells;
+    size_t valuesRead;
+
+    void LoadChunk( float* out, int row, int col, int h, int w, int flowStart, int flowDepth );
 
 public:
-    PyWells( std::string _fname ): fname(_fname){}
+    // only the metadata is read here, wells are read from disk chunk by chunk
+    PyWells( std::string _fname ): fname(_fname), wells("",_fname.c_str()), valuesRead(0) {
+        IonErr::SetThrowStatus(true);
+        wells.OpenForIncrementalRead();
+    }
+
     boost::python::object LoadWells(int rows, int cols , int h, int w);
     boost::python::object LoadWellsFlow(int rows, int cols , int h, int w, int flow);
+    boost::python::object LoadWellsFlows(int rows, int cols , int h, int w, int flowStart, int flowDepth);
+    boost::python::tuple Size(){ return boost::python::make_tuple( wells.NumRows(), wells.NumCols(), wells.NumFlows() ); }
+    size_t ValuesRead(){ return valuesRead; }
 };
 
-boost::python::object PyWells::LoadWells(int row , int col, int h, int w){
-    IonErr::SetThrowStatus(true);
-    RawWells wells("",fname.c_str());
-    std::vector<int32_t> col_list;
-    std::vector<int32_t> row_list;
-
-    for( int r = row; r < row+h; ++r ){
-        for( int c = col; c < col+w; ++c ){
-            col_list.push_back(c);
-            row_list.push_back(r);
+// largest chunk side read at once, RawWells does not take chunks of 10000 rows or columns
+static const int WELLS_READ_CHUNK = 1000;
+
+void PyWells::LoadChunk( float* out, int row, int col, int h, int w, int flowStart, int flowDepth ){
+    for( int r0 = row; r0 < row+h; r0 += WELLS_READ_CHUNK ){
+        int ch = std::min( WELLS_READ_CHUNK, row+h-r0 );
+        for( int c0 = col; c0 < col+w; c0 += WELLS_READ_CHUNK ){
+            int cw = std::min( WELLS_READ_CHUNK, col+w-c0 );
+            wells.SetChunk( r0, ch, c0, cw, flowStart, flowDepth );
+            wells.ReadWells();
+            valuesRead += (size_t)ch*cw*flowDepth;
+
+            for( int r = r0; r < r0+ch; ++r ){
+                for( int c = c0; c < c0+cw; ++c ){
+                    float* data = out + ((size_t)(r-row)*w + (c-col))*flowDepth;
+                    for( int f = 0; f < flowDepth; ++f )
+                        data[f] = wells.At(r,c,flowStart+f);
+                }
+            }
         }
     }
+}
 
-    wells.OpenForRead();
-
-    h = std::min( h, (int)wells.NumRows()-row );
-    w = std::min( w, (int)wells.NumCols()-col );
+boost::python::object PyWells::LoadWellsFlows(int row , int col, int h, int w, int flowStart, int flowDepth){
+    h = std::max( 0, std::min( h, (int)wells.NumRows()-row ) );
+    w = std::max( 0, std::min( w, (int)wells.NumCols()-col ) );
     int flows = wells.NumFlows();
-    npy_intp dims[]={h, w, flows};
-    handle<> array( PyArray_SimpleNew(3,dims,NPY_FLOAT) );
-
-    for( int r = row; r < row+h; ++r ){
-        for( int c = col; c < col+w; ++c ){
-            for( int f = 0; f < flows; ++f ){
-                float* data = (float*)PyArray_GETPTR3(array.get(),r-row,c-col,f);
-                *data = wells.At(r,c,f);
-            }
-        }
-    }
+    if( flowStart < 0 || flowDepth < 1 || flowStart+flowDepth > flows )
+        throw std::runtime_error("flow value too large");
 
-    wells.Close();
+    npy_intp dims[]={h, w, flowDepth};
+    handle<> array( PyArray_SimpleNew(3,dims,NPY_FLOAT) );
+    LoadChunk( (float*)PyArray_DATA( array.get() ), row, col, h, w, flowStart, flowDepth );
     return object(array);
 }
 
-boost::python::object PyWells::LoadWellsFlow(int row , int col, int h, int w, int flow){
-
-    RawWells wells("",fname.c_str());
-//    std::vector<int32_t> col_list;
-//    std::vector<int32_t> row_list;
-
-//    for( int r = row; r < row+h; ++r ){
-//        for( int c = col; c < col+w; ++c ){
-//            col_list.push_back(c);
-//            row_list.push_back(r);
-//        }
-//    }
-
-    wells.OpenForRead();
+boost::python::object PyWells::LoadWells(int row , int col, int h, int w){
+    return LoadWellsFlows( row, col, h, w, 0, wells.NumFlows() );
+}
 
-    h = std::min( h, (int)wells.NumRows()-row );
-    w = std::min( w, (int)wells.NumCols()-col );
-    int flows = wells.NumFlows();
-    if( flow > flows )
+boost::python::object PyWells::LoadWellsFlow(int row , int col, int h, int w, int flow){
+    h = std::max( 0, std::min( h, (int)wells.NumRows()-row ) );
+    w = std::max( 0, std::min( w, (int)wells.NumCols()-col ) );
+    if( flow < 0 || flow >= (int)wells.NumFlows() )
         throw std::runtime_error("flow value too large");
 
     npy_intp dims[]={h, w};
     handle<> array( PyArray_SimpleNew(2,dims,NPY_FLOAT) );
-
-    for( int r = row; r < row+h; ++r ){
-        for( int c = col; c < col+w; ++c ){
-            float* data = (float*)PyArray_GETPTR2(array.get(),r-row,c-col);
-            *data = wells.At(r,c,flow);
-        }
-    }
-
-    wells.Close();
+    LoadChunk( (float*)PyArray_DATA( array.get() ), row, col, h, w, flow, 1 );
     return object(array);
 }
 
@@ -1474,9 +1469,12 @@ BOOST_PYTHON_MODULE(torrentPyLib)
             .def_readwrite("uncompress", &PyRawDat::uncompress, "should uncompress trace data")
             ;
 
-    class_<PyWells>("WellsReader",boost::python::init<std::string>("Reader for Ion wells files",(boost::python::arg("fname"))))
+    class_<PyWells, boost::noncopyable>("WellsReader",boost::python::init<std::string>("Reader for Ion wells files",(boost::python::arg("fname"))))
             .def("LoadWells",&PyWells::LoadWells,"LoadWells( start_row, start_col, height, width )")
             .def("LoadWellsFlow",&PyWells::LoadWellsFlow,"LoadWellsFlow( start_row, start_col, height, width, flow )")
+            .def("LoadWellsFlows",&PyWells::LoadWellsFlows,"LoadWellsFlows( start_row, start_col, height, width, flow_start, flow_count )")
+            .def("Size",&PyWells::Size,"Size() - returns (rows, cols, flows) of the wells file, read from the metadata only")
+            .def("ValuesRead",&PyWells::ValuesRead,"ValuesRead() - number of well values read from the file so far")
             ;
 
     class_<PyBam>("BamReader",boost::python::init<std::string>("Reader for bam files",(boost::python::arg("fname"))))
@@ -3,6 +3,8 @@
 import torrentPy
 import unittest
 import os
+import numpy
+import tables
 
 #execfile('../example/examples.py')
 
@@ -41,6 +43,32 @@ class TestTorrentPy(unittest.TestCase):
             print "Expected Error:"
             r=read_Dat(os.path.join('.','blah.dat'))
         
+    def test_read_Tiles(self):
+        r=read_Tiles(os.path.join('.','1.wells'),os.path.join('.','acq_0000.dat'),os.path.join('.','rawlib.bam'))
+        self.assertEqual(r['max_amplitude'],r['wells'][:,:,0:8].max())
+        self.assertEqual(len(r['flow_means']),4)
+        self.assertEqual(r['dat_tiles'][0][:2],(10,20))
+        self.assertTrue(all(shape[0]<=50 and shape[1]<=50 for row,col,shape in r['dat_tiles']))
+        self.assertEqual(r['numReads'],len(list(torrentPy.BamReader(os.path.join('.','rawlib.bam')))))
+
+        with self.assertRaises(Exception):
+            print "Expected Error:"
+            list(torrentPy.IO.wellsTiles(os.path.join('.','blah.wells')))
+
+    def test_read_Wells_Tile(self):
+        w=torrentPy.WellsReader(os.path.join('.','1.wells'))
+        rows,cols,flows=w.Size()
+        self.assertEqual(w.ValuesRead(),0)
+        a=w.LoadWells(10,20,5,6)
+        self.assertEqual(a.shape,(5,6,flows))
+        self.assertEqual(w.ValuesRead(),5*6*flows)
+        self.assertLess(w.ValuesRead(),rows*cols*flows)
+
+        f=w.LoadWellsFlow(10,20,5,6,3)
+        self.assertTrue((f==a[:,:,3]).all())
+        self.assertEqual(w.ValuesRead(),5*6*flows+5*6)
+        self.assertTrue((w.LoadWellsFlows(10,20,5,6,2,4)==a[:,:,2:6]).all())
+
     def test_read_BfMask(self):
         r=read_BfMask(os.path.join('.','bfmask.bin'))
         v=r['bfmask'].flatten().sum()
@@ -54,6 +82,51 @@ class TestTorrentPy(unittest.TestCase):
         with self.assertRaises(Exception):
             print "Expected Error:"
             r=read_Debug('blah')
+
+
+    def test_read_Debug_Batch(self):
+        r=read_Debug_Batch('.')
+        pos=r['pos']
+        self.assertEqual(len(r['regParams']),len(pos))
+
+        #expected values read directly from the hdf5 files
+        bead=tables.openFile(os.path.join('.','bead_param.h5'))
+        amplitude=bead.getNode('/bead/amplitude').read()
+        base=bead.getNode('/bead/bead_base_parameters').read()
+        bead.close()
+        self.assertTrue((r['beadParams']['amplitude']==amplitude[pos[:,0],pos[:,1],7]).all())
+        self.assertTrue((r['beadParams']['etbR']==base[pos[:,0],pos[:,1],1]).all())
+
+        region=tables.openFile(os.path.join('.','region_param.h5'))
+        loc=region.getNode('/region/region_location').read()[:,:,0]
+        krate=region.getNode('/region/region_param/enzymatics').read()
+        krate_idx=region.getNodeAttr('/region/region_param/enzymatics','paramNames').split(',').index('krate_3')
+        region.close()
+        db=r['db']
+        def regionOf(p):
+            corner=numpy.floor_divide(p,db.step)*db.step
+            found=numpy.nonzero((loc==corner).all(axis=1))[0]
+            return found[0] if found.size else -1
+
+        #positions in every region and one outside all regions
+        pos=numpy.array([(10,11),(52,10),(10,52),(55,55),(150,10)])
+        reg=[regionOf(p) for p in pos]
+        self.assertEqual(reg[-1],-1)
+        self.assertEqual(len(set(reg[:-1])),4)
+        regParams=db.getBgRegionParamsArray(pos,7,'G')
+        single=db.getBgRegionParams(pos,7,'G')
+        expected=[krate[k,krate_idx,7//db.nFlowsPerGroup] for k in reg[:-1]]
+        self.assertEqual(list(regParams['krate'][:-1]),expected)
+        self.assertEqual(list(single['krate'][:-1]),expected)
+        self.assertTrue(numpy.isnan(regParams['krate'][-1]))
+        self.assertTrue(numpy.isnan(single['krate'][-1]))
+        self.assertTrue(numpy.isnan(single['missingMass'][-1]).all())
+        self.assertTrue(numpy.isnan(db.getEmptyTrace((150,10),7)).all())
+        self.assertFalse(numpy.isnan(db.getEmptyTrace((55,55),7)).any())
+
+        beads=db.getBeadParams(pos[:-1],7)
+        self.assertEqual(beads['amplitude'],list(amplitude[pos[:-1,0],pos[:-1,1],7]))
+        self.assertEqual(beads['copies'],list(base[pos[:-1,0],pos[:-1,1],0]))
         
         
 if __name__ == "__main__":
@@ -1,28 +1,195 @@
 # Copyright (C) 2013 Ion Torrent Systems, Inc. All Rights Reserved
 
+import sys
+import threading
+import Queue
+
 import torrentPyLib
 
+# default (height, width) of the tiles returned by the tile readers
+DEFAULT_TILE = (100, 100)
+
+# larger than any chip dimension, the readers clip regions to the chip
+MAX_CHIP = 60000
+
 def bamReader(fname):
-    bam=torrentPyLib.BamReader()
-    bam.Open(fname)
+    bam=torrentPyLib.BamReader(fname)
     #nrec = bam.GetNumRecords()
     hdr=bam.ReadBamHeader()
     dat = bam.ReadBam()
     return (hdr,dat)
 
 def wellsReader(fname):
-    w=torrentPyLib.WellsReader()
-    w.Open(fname)
-    a=w.LoadWells(0,0,60000,60000)
+    w=torrentPyLib.WellsReader(fname)
+    rows, cols, flows = w.Size()
+    a=w.LoadWells(0,0,rows,cols)
     return a
 
 def bfMaskReader( path, mask ):
     bf = torrentPyLib.LoadBfMaskByType(path,mask)
     return bf
-    
+
 def rawDat(path):
-    i = torrentPyLib.RawDatReader()
-    i.Open(path)
-    a=i.LoadSlice(0,0,60000,60000)
+    i = torrentPyLib.RawDatReader(path)
+    a=i.LoadSlice(0,0,MAX_CHIP,MAX_CHIP)
     return a
-      
+
+
+# --------------------------------------------------#
+# Streaming readers
+# Generators returning a chip one tile or one flow at a time, memory use is bounded by the
+# tile size and the number of tiles loaded ahead (prefetch).
+# The wells readers keep one WellsReader open and read only the requested wells and flows from
+# the file, dat files are loaded whole by RawDatReader and only sliced tile by tile.
+# Regions are given as (start_row, start_col, height, width), same as LoadSlice.
+# --------------------------------------------------#
+
+def wellsSize(fname):
+    '''Returns (rows, cols, flows) of a wells file, no wells are read'''
+    return torrentPyLib.WellsReader(fname).Size()
+
+def datSize(dat):
+    '''Returns (rows, cols, frames) of an open RawDatReader'''
+    rows, _, frames = dat.LoadSlice(0,0,MAX_CHIP,1).shape
+    cols = dat.LoadSlice(0,0,1,MAX_CHIP).shape[1]
+    return (rows, cols, frames)
+
+def tileRegions(rows, cols, tile=DEFAULT_TILE, region=None):
+    '''Returns list of (start_row, start_col, height, width) tiles covering region of a rows x cols chip'''
+    row0, col0, height, width = region or (0, 0, rows, cols)
+    row1 = min(row0 + height, rows)
+    col1 = min(col0 + width, cols)
+    tiles = []
+    for r in range(row0, row1, tile[0]):
+        for c in range(col0, col1, tile[1]):
+            tiles.append((r, c, min(tile[0], row1 - r), min(tile[1], col1 - c)))
+    return tiles
+
+def _flowSlice(flows):
+    if flows is None:
+        return slice(None)
+    if isinstance(flows, slice):
+        return flows
+    return slice(*flows)
+
+def _flowRange(flows, nflows):
+    '''Returns (start, count, step) of the flows to read for a flow range or slice'''
+    start, stop, step = _flowSlice(flows).indices(nflows)
+    if step < 0:
+        start, stop, step = stop + 1, start + 1, step
+    return start, max(stop - start, 0), step
+
+def _prefetch(loader, items, prefetch):
+    '''
+    Yields (item, loader(item)) for items, loading up to prefetch items ahead in a background thread.
+    Errors of the loader are raised in the caller.
+    '''
+    if prefetch < 1:
+        for item in items:
+            yield item, loader(item)
+        return
+
+    queue = Queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in items:
+                if not put((item, loader(item), None)):
+                    return
+        except:
+            put((None, None, sys.exc_info()))
+            return
+        put((done, None, None))
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, data, error = queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if item is done:
+                return
+            yield item, data
+    finally:
+        # consumer stopped early, let the loading thread exit
+        stop.set()
+
+def wellsTiles(fname, tile=DEFAULT_TILE, flows=None, region=None, prefetch=1):
+    '''
+    Generator over the tiles of a wells file, yields (start_row, start_col, array).
+    array is a (height, width, flows) view of the tile, flows is a (start, stop) flow range or slice.
+    '''
+    w = torrentPyLib.WellsReader(fname)
+    rows, cols, nflows = w.Size()
+    start, count, step = _flowRange(flows, nflows)
+    if count == 0:
+        return
+    load = lambda t: w.LoadWellsFlows(*(t + (start, count)))[:,:,::step]
+    for t, a in _prefetch(load, tileRegions(rows, cols, tile, region), prefetch):
+        yield t[0], t[1], a
+
+def wellsFlows(fname, flows=None, region=None, prefetch=1):
+    '''
+    Generator over the flows of a wells file, yields (flow, array).
+    array is the (height, width) signal of region for one flow, region defaults to the whole chip.
+    '''
+    w = torrentPyLib.WellsReader(fname)
+    rows, cols, nflows = w.Size()
+    row, col, height, width = region or (0, 0, rows, cols)
+    load = lambda flow: w.LoadWellsFlow(row, col, height, width, flow)
+    for flow, a in _prefetch(load, range(nflows)[_flowSlice(flows)], prefetch):
+        yield flow, a
+
+def datTiles(fname, tile=DEFAULT_TILE, normalize=True, frames=None, region=None, prefetch=1):
+    '''
+    Generator over the tiles of a dat file, yields (start_row, start_col, array).
+    array is a (height, width, frames) view of the tile traces, frames is a (start, stop) range or slice.
+    RawDatReader has no partial read, the whole dat file is loaded when the generator starts and only
+    the returned tiles are bounded by tile.
+    '''
+    dat = torrentPyLib.RawDatReader(fname, normalize)
+    rows, cols, nframes = datSize(dat)
+    fslice = _flowSlice(frames)
+    load = lambda t: dat.LoadSlice(*t)[:,:,fslice]
+    for t, a in _prefetch(load, tileRegions(rows, cols, tile, region), prefetch):
+        yield t[0], t[1], a
+
+def bamReads(fname, region=None, dna_region=None, chunk=None):
+    '''
+    Generator over the reads of a bam file, yields one read dict at a time, or lists of up to
+    chunk reads if chunk is set. region restricts reads to a chip region,
+    dna_region to (leftRefId, leftPosition, rightRefId, rightPosition).
+    '''
+    bam = torrentPyLib.BamReader(fname)
+    if region:
+        row, col, height, width = region
+        bam.SetChipRegion(row, row + height, col, col + width)
+    if dna_region:
+        bam.SetDNARegion(*dna_region)
+
+    if not chunk:
+        for read in bam:
+            yield read
+        return
+
+    reads = []
+    for read in bam:
+        reads.append(read)
+        if len(reads) >= chunk:
+            yield reads
+            reads = []
+    if reads:
+        yield reads
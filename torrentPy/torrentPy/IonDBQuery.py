@@ -10,10 +10,15 @@ import datetime
 import numpy as np
 
 import os.path
+import hashlib
+import itertools
 import urllib
 import urllib2
 from cookielib import CookieJar
 
+# names of server side cursors
+_cursor_ids = itertools.count()
+
 def flatten_dict(dd, separator='_', prefix=''):
     ret = {}
     if isinstance(dd, dict):
@@ -54,6 +59,16 @@ class IonDBData( object ):
                                     coerce_float=True)
         return result
 
+    def df_chunks_from_db(self, query, params=None, chunksize=10000):
+        '''Generator of DataFrames of up to chunksize rows of the query, streamed from a server side cursor'''
+        for columns, rows in self.__db.iterquery(query, params, chunksize):
+            yield pandas.DataFrame.from_records(rows, columns=self.uniquify_columns(columns),
+                                    coerce_float=True)
+
+    def df_from_db_chunked(self, query, params=None, chunksize=10000):
+        chunks = list(self.df_chunks_from_db(query, params, chunksize))
+        return pandas.concat(chunks, ignore_index=True) if len(chunks)>1 else chunks[0]
+
 
     def getExplogData( self, data, username, password ):
         host = self.__db._IonDB__host
@@ -125,57 +140,71 @@ class IonDBData( object ):
     def getPluginData(self,run_df,plugin_list):
         if len(plugin_list)<1:
             return run_df
-            
-        query="""SELECT rundb_plugin.name,state,store FROM rundb_pluginresult JOIN rundb_plugin ON rundb_plugin.id=rundb_pluginresult.plugin_id WHERE rundb_plugin.name IN %s AND rundb_pluginresult.result_id=%s"""
-        plugin_data_list=[]
-        for run_id in run_df.index:
-            #db.cursor.mogrify(query,(plugin_list,run_id))
-            self.__db.cursor.execute(query,(plugin_list,run_id))
-            rf={'run_id':run_id}
-            for r in self.__db.cursor:
-                if r[1]=='Completed':
-                    plugin_name=r[0]
+
+        # one query for all runs, rows are streamed
+        query="""SELECT rundb_pluginresult.result_id,rundb_plugin.name,state,store FROM rundb_pluginresult JOIN rundb_plugin ON rundb_plugin.id=rundb_pluginresult.plugin_id WHERE rundb_plugin.name IN %s AND rundb_pluginresult.result_id = ANY(%s::int[])"""
+        plugin_data=dict( (run_id,{'run_id':run_id}) for run_id in run_df.index )
+        for columns, rows in self.__db.iterquery(query,(tuple(plugin_list),[int(i) for i in run_df.index])):
+            for r in rows:
+                if r[2]=='Completed':
+                    plugin_name=r[1]
                     try:
-                        plugin_data=json.loads(r[2])
-                        rf.update(flatten_dict(plugin_data,plugin_name+'_'))
+                        plugin_data[r[0]].update(flatten_dict(json.loads(r[3]),plugin_name+'_'))
                     except Exception as e:
                         #print e
-                        #print plugin_data
-                        #print r[0], r[2], run_id
+                        #print r[0], r[1], r[3]
                         pass
-            plugin_data_list.append(rf)
-            self.__db.connection.commit()
-            
-        plugin_df = pandas.DataFrame(plugin_data_list)
+
+        plugin_df = pandas.DataFrame([plugin_data[run_id] for run_id in run_df.index])
         plugin_df.set_index('run_id',inplace=True)
         data = run_df.join(plugin_df)
         return data
 
     def __getProjectId(self, run_df):
-        query = """SELECT rundb_project.name FROM rundb_project JOIN rundb_results_projects ON  rundb_project.id=rundb_results_projects.project_id WHERE rundb_results_projects.results_id=%s"""
-        for run_id in run_df.index:
-            try:
-                querystr=self.__db.cursor.mogrify(query,(run_id,))
-                dat = self.__db.query(querystr)
-                project_id = dat[0][0]
-                run_df=run_df.set_value(run_id,'project_id',project_id)
-            except:
-                pass
+        query = """SELECT rundb_results_projects.results_id,rundb_project.name FROM rundb_project JOIN rundb_results_projects ON  rundb_project.id=rundb_results_projects.project_id WHERE rundb_results_projects.results_id = ANY(%s::int[])"""
+        projects = {}
+        for columns, rows in self.__db.iterquery(query,([int(i) for i in run_df.index],)):
+            for run_id, project_id in rows:
+                projects.setdefault(run_id, project_id)
+        if projects:
+            run_df.loc[projects.keys(),'project_id'] = projects.values()
         return run_df
 
+    def __cacheFile(self, cache_dir, start, end, plugin_list):
+        '''Cache file of a getDataByDate query, keyed by database and date range'''
+        key = hashlib.md5(','.join(sorted(plugin_list))).hexdigest()[:8]
+        name = 'iondb_%s_%s_%s_%s_%s.h5' % (self.__db._IonDB__host, self.__db._IonDB__database,
+                    start.strftime('%Y%m%d%H%M%S'), end.strftime('%Y%m%d%H%M%S'), key)
+        return os.path.join(cache_dir, name)
 
+    def getDataByDate(self,start=(datetime.datetime.now()-datetime.timedelta(days=31)),end=(datetime.datetime.now()-datetime.timedelta(days=0)),plugin_list=(),cache_dir=None):
+        '''
+        Returns DataFrame of the reports between start and end.
+        If cache_dir is set the result is saved there and later calls for the same date range and
+        plugins read it from disk instead of the database.
+        '''
+        if cache_dir:
+            cache_file = self.__cacheFile(cache_dir, start, end, plugin_list)
+            if os.path.exists(cache_file):
+                return pandas.read_hdf(cache_file, 'runs')
 
-    def getDataByDate(self,start=(datetime.datetime.now()-datetime.timedelta(days=31)),end=(datetime.datetime.now()-datetime.timedelta(days=0)),plugin_list=()):
         query="""select * from rundb_results JOIN rundb_experiment ON rundb_results.experiment_id=rundb_experiment.id JOIN rundb_libmetrics ON rundb_results.id=rundb_libmetrics.report_id JOIN rundb_analysismetrics ON rundb_results.id=rundb_analysismetrics.report_id where "timeStamp">=%s AND "timeStamp"<=%s ORDER BY "timeStamp" DESC"""
-        querystr=self.__db.cursor.mogrify(query,(start,end))
-        run_df=self.df_from_db(querystr)
+        run_df=self.df_from_db_chunked(query,(start,end))
         run_df.set_index('report_id',inplace=True)
         run_df['project_id']=""
         run_df = self.__getProjectId(run_df)
         run_df = self.getPluginData(run_df,plugin_list)
+
+        if cache_dir:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                run_df.to_hdf(cache_file, 'runs', mode='w')
+            except Exception as e:
+                print "Can't write cache file %s: %s" % (cache_file, e)
         return run_df
 
-    def getData(self,query,params):
+    def getData(self,query,params,plugin_list=()):
         querystr=self.__db.cursor.mogrify(query,params)
         run_df=self.df_from_db(querystr)
         run_df.set_index('report_id',inplace=True)
@@ -202,6 +231,28 @@ class IonDB(object):
         self.rows = self.cursor.fetchall()
         self.connection.commit()
         return self.rows
+
+    def iterquery(self, queryString, params=None, chunksize=10000):
+        '''
+        Generator of (columns, rows) with up to chunksize rows of the query, rows are fetched from
+        a server side cursor. The first chunk is returned even if the query has no rows.
+        '''
+        cursor = self.connection.cursor(name='iondb_%d' % next(_cursor_ids))
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(queryString, params)
+            first = True
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows and not first:
+                    break
+                first = False
+                yield [col_desc[0] for col_desc in cursor.description], rows
+                if not rows:
+                    break
+        finally:
+            cursor.close()
+            self.connection.commit()
     
     def __del__(self):
         self.connection.commit()
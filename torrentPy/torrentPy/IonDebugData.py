@@ -6,104 +6,203 @@ import os
 import os.path
 
 
+def _structured( columns ):
+    '''Returns structured array of the (name, array) columns, rows of multi-dimensional arrays become sub-arrays'''
+    values = [ np.asarray(v) for name, v in columns ]
+    out = np.empty( len(values[0]), dtype=[ (name, v.dtype, v.shape[1:]) for (name, temp), v in zip(columns, values) ] )
+    for (name, temp), v in zip(columns, values):
+        out[name] = v
+    return out
+
+
 class DebugParams(object):
+    # bead_base_parameters in order
+    BEAD_BASE_PARAMS = ('copies', 'etbR', 'dmult', 'gain', 'deltaTime')
+    # per flow bead parameters and their bead_param.h5 dataset
+    BEAD_FLOW_PARAMS = (('kmult', 'kmult'), ('amplitude', 'amplitude'), ('resError', 'residual_error'), ('dcOffset', 'trace_dc_offset'))
+    # rows of the bead datasets read at once by the batch functions
+    READ_ROWS = 64
+
     def __init__(self,path_to_sigproc):
         self.__path = path_to_sigproc
+        self.__nodes = {}
+        self.__region_arrays = {}
+        self.__param_idx = {}
         self.__nuc_param = {'sigma':'derived_param','midNucTime':'derived_param','krate':'enzymatics','NucModifyRatio':'buffering', 'd':'enzymatics', 't_mid_nuc_delay':'nuc_shape', 'Concentration':'nuc_shape', 'sigma_mult':'nuc_shape', 'kmax':'enzymatics'}
         self.__flow_param = {'t_mid_nuc':'nuc_shape', 't_mid_nuc_shift_per_flow':'nuc_shape','darkness':'misc'}
         self.__flow_group_param = {'tau_R_o':'buffering', 'tau_R_m':'buffering', 'tauE':'buffering', 'RatioDrift':'buffering', 'valve_open':'nuc_shape', 'magic_divisor_for_timing':'nuc_shape','CopyDrift':'misc', 'molecules_to_micromolar':'misc', 'tshift':'misc', 'sens':'misc', 'SENSMULTIPLIER':'misc' } #'sigma':'nuc_shape', 
         self.__nuc_map={"T":0, "A":1, "C":2, "G":3}
 
-    def getRegionIdxByPos( self, pos ):
-        reg_corner = np.floor_divide( pos, self.step )*self.step
-        ind = np.where((self.loc==reg_corner).all(axis=1))
-        return (ind[0] if ind[0].size>0 else -1).min()
+    def getRegionIdx( self, pos ):
+        '''Returns array of region indices of the (row,col) positions in pos, -1 for positions outside all regions'''
+        cell = np.floor_divide( self.__positions(pos), self.step ).astype(int)
+        grid = self.__region_grid
+        inside = (cell >= 0).all(axis=1) & (cell < grid.shape).all(axis=1)
+        reg = -np.ones( len(cell), dtype=int )
+        reg[inside] = grid[cell[inside,0], cell[inside,1]]
+        return reg
 
-    def __get_nuc_attr( self, name, attr, flow, nuc, reg ):
+    def getRegionIdxByPos( self, pos ):
+        return self.getRegionIdx( [pos] )[0]
+
+    def __positions( self, pos ):
+        return np.asarray( pos, dtype=int ).reshape(-1,2)
+
+    def __make_region_grid( self ):
+        '''Lookup table of region index by region corner / step'''
+        corner = np.floor_divide( self.loc, self.step ).astype(int)
+        exact = np.nonzero( ((corner*self.step)==self.loc).all(axis=1) & (corner>=0).all(axis=1) )[0]
+        if exact.size==0:
+            return -np.ones( (0,0), dtype=int )
+        grid = -np.ones( corner[exact].max(axis=0)+1, dtype=int )
+        # reversed, the first region with a corner wins like in a linear search
+        exact = exact[::-1]
+        grid[corner[exact,0], corner[exact,1]] = exact
+        return grid
+
+    def __getNode( self, h5, path ):
+        key = (h5.filename, path)
+        if key not in self.__nodes:
+            self.__nodes[key] = h5.getNode(path)
+        return self.__nodes[key]
+
+    def __readRegionNode( self, path ):
+        '''Region parameters are small, they are read once and kept in memory'''
+        if path not in self.__region_arrays:
+            self.__region_arrays[path] = self.__getNode( self.__region_param, path ).read()
+        return self.__region_arrays[path]
+
+    def __paramIdx( self, path ):
+        '''Returns the name to index map of the paramNames attribute of path'''
+        if path not in self.__param_idx:
+            idx = {}
+            for i, name in enumerate( self.__region_param.getNodeAttr(path,'paramNames').split(',') ):
+                idx.setdefault( name, i )
+            self.__param_idx[path] = idx
+        return self.__param_idx[path]
+
+    def __regionParamValues( self, name, flow, nuc ):
+        '''Returns array of the values of region parameter name for all regions'''
         flow_group = int(flow // self.nFlowsPerGroup)
-        nuc_idx = self.__nuc_map[nuc]
-        full_name = name+'_'+str(nuc_idx)
+        if name in self.__nuc_param:
+            attr = self.__nuc_param[name]
+            full_name = name+'_'+str(self.__nuc_map[nuc])
+        elif name in self.__flow_param:
+            attr = self.__flow_param[name]
+            full_name = name+'_'+str(int(flow % self.nFlowsPerGroup))
+        else:
+            attr = self.__flow_group_param[name]
+            full_name = name
         full_attr= ('/region/region_param/'+attr) if attr!='derived_param' else '/region/derived_param'
-        namedParameterList=np.array(self.__region_param.getNodeAttr(full_attr,'paramNames').split(','))
-        param_idx=np.where(namedParameterList==full_name)[0][0]
-        val = self.__region_param.getNode(full_attr)
-        return val[reg,param_idx,flow_group]
+        return self.__readRegionNode(full_attr)[:, self.__paramIdx(full_attr)[full_name], flow_group]
 
-    def __get_flow_group_attr( self, name, attr, flow, nuc, reg ):
-        flow_group = int(flow // self.nFlowsPerGroup)
-        full_name = name
-        full_attr='/region/region_param/'+attr
-        namedParameterList=np.array(self.__region_param.getNodeAttr(full_attr,'paramNames').split(','))
-        param_idx=np.where(namedParameterList==full_name)[0][0]
-        val = self.__region_param.getNode(full_attr)
-        return val[reg,param_idx,flow_group]
-
-    def __get_flow_attr( self, name, attr, flow, nuc, reg ):
-        flow_group = int(flow // self.nFlowsPerGroup)
-        flow_idx = int(flow % self.nFlowsPerGroup)
-        full_name = name+'_'+str(flow_idx)
-        full_attr='/region/region_param/'+attr
-        namedParameterList=np.array(self.__region_param.getNodeAttr(full_attr,'paramNames').split(','))
-        param_idx=np.where(namedParameterList==full_name)[0][0]
-        val = self.__region_param.getNode(full_attr)
-        return val[reg,param_idx,flow_group]
+    def __outsideToNan( self, values, reg ):
+        '''Returns values of the regions reg as float, nan for the -1 of positions outside all regions'''
+        values = np.array( values, dtype=float )
+        values[np.asarray(reg)<0] = np.nan
+        return values
 
     def __get_darkness_attr( self, reg, nuc ):
-        full_attr='/region/darkMatter/missingMass'
-        val = self.__region_param.getNode(full_attr).read()
+        val = self.__readRegionNode('/region/darkMatter/missingMass')
         nuc_idx = self.__nuc_map[nuc]
-        return val[reg,nuc_idx,:]
+        return self.__outsideToNan( val[reg,nuc_idx,:], reg )
 
     def getRegionParam( self, reg, name, flow, nuc ):
         try:
-            attr = self.__nuc_param[name]
-            return( self.__get_nuc_attr( name, attr, flow, nuc, reg ) )
-        except: pass
-        try:
-            attr = self.__flow_param[name]
-            return( self.__get_flow_attr( name, attr, flow, nuc, reg ) )
-        except: pass
-        try:
-            attr = self.__flow_group_param[name]
-            return( self.__get_flow_group_attr( name, attr, flow, nuc, reg ) )
+            reg = np.asarray(reg)
+            return self.__outsideToNan( self.__regionParamValues( name, flow, nuc )[reg], reg )
         except:
             return
 
     def getBgRegionParams( self, pos, flow, nuc ):
         ret = dict()
-        reg = tuple( self.getRegionIdxByPos(pos_1) for pos_1 in pos )
-        for (par, temp) in self.__nuc_param.items()+self.__flow_param.items()+self.__flow_group_param.items():
+        reg = self.getRegionIdx(pos)
+        for par in self.__region_param_names():
             ret[par]=self.getRegionParam(reg, par, flow, nuc)
         ret['missingMass']=tuple(self.__get_darkness_attr( r, nuc ) for r in reg)
         return(ret)
 
+    def __region_param_names( self ):
+        return list(self.__nuc_param)+list(self.__flow_param)+list(self.__flow_group_param)
+
+    def getBgRegionParamsArray( self, pos, flow, nuc ):
+        '''
+        Batch version of getBgRegionParams, pos is a (N,2) array of (row,col) positions.
+        Returns a structured array with one record per position: row, col, region, the region
+        parameters and missingMass. Parameters of positions outside all regions are nan.
+        '''
+        pos = self.__positions(pos)
+        reg = self.getRegionIdx(pos)
+        outside = reg<0
+        columns = [ ('row',pos[:,0]), ('col',pos[:,1]), ('region',reg) ]
+        for par in sorted(self.__region_param_names()):
+            columns.append( (par, self.__regionParamValues(par, flow, nuc)[reg].astype(float)) )
+        columns.append( ('missingMass', self.__get_darkness_attr(reg, nuc)) )
+        for name, values in columns[3:]:
+            values[outside] = np.nan
+        return _structured(columns)
+
     def _getRegionParams(self,pos):
         attributes=('/region/region_param/nuc_shape','/region/region_param/misc','/region/region_param/enzymatics','/region/region_param/buffering')
         params={}
+        reg = self.getRegionIdx(pos)
 
         for attr in attributes:
             namedParameterList=self.__region_param.getNodeAttr(attr,'paramNames').split(',')
             namedParameterList = namedParameterList[:-1] if namedParameterList[-1]=='' else namedParameterList
-            param_values = self.__region_param.getNode(attr)
+            param_values = self.__readRegionNode(attr)
 
             for k in range(len(namedParameterList)):
-                val = [ param_values[ self.getRegionIdxByPos(well_pos),k,:] for well_pos in pos ]
-                params[namedParameterList[k]]=val[0]
+                params[namedParameterList[k]]=self.__outsideToNan( param_values[reg[0],k,:], reg[0] )
 
         return params
 
+    def __readWells( self, node, rows, cols, flow ):
+        '''
+        Returns node[rows[i],cols[i],flow] for all positions. The dataset is read in blocks of up to
+        READ_ROWS rows, each limited to the rows and columns of the positions it holds, positions
+        are picked by fancy indexing.
+        '''
+        if len(rows)==0:
+            return np.empty( (0,)+node[0:1,0:1,flow].shape[2:], dtype=node.dtype )
+        order = np.argsort( rows, kind='mergesort' )
+        sorted_rows = rows[order]
+        out = None
+        start = 0
+        while start < len(rows):
+            r0 = sorted_rows[start]
+            end = np.searchsorted( sorted_rows, r0+self.READ_ROWS, 'left' )
+            sel = order[start:end]
+            c0 = cols[sel].min()
+            block = node[r0:sorted_rows[end-1]+1,c0:cols[sel].max()+1,flow]
+            values = block[rows[sel]-r0, cols[sel]-c0]
+            if out is None:
+                out = np.empty( (len(rows),)+values.shape[1:], dtype=values.dtype )
+            out[sel] = values
+            start = end
+        return out
+
+    def getBeadParamsArray(self,pos,flow=slice(None)):
+        '''
+        Batch version of getBeadParams, pos is a (N,2) array of (row,col) positions.
+        Returns a structured array with one record per position, per flow parameters are
+        sub-arrays over flow.
+        '''
+        pos = self.__positions(pos)
+        rows, cols = pos[:,0], pos[:,1]
+        base = self.__readWells( self.__data['bead_base_parameters'], rows, cols, slice(None) )
+        columns = [ ('row',rows), ('col',cols) ]
+        columns += [ (name, base[:,k]) for k, name in enumerate(self.BEAD_BASE_PARAMS) ]
+        for name, key in self.BEAD_FLOW_PARAMS:
+            columns.append( (name, self.__readWells( self.__data[key], rows, cols, flow )) )
+        return _structured(columns)
+
     def getBeadParams(self,pos,flow=slice(None)):
+        beads = self.getBeadParamsArray(pos,flow)
         params={}
-        params['kmult']=[self.__data['kmult'][row,col,flow] for row,col in pos]
-        params['copies']=[self.__data['bead_base_parameters'][row,col,0] for row,col in pos]
-        params['etbR']=[self.__data['bead_base_parameters'][row,col,1] for row,col in pos]
-        params['dmult']=[self.__data['bead_base_parameters'][row,col,2] for row,col in pos]
-        params['gain']=[self.__data['bead_base_parameters'][row,col,3] for row,col in pos]
-        params['deltaTime']=[self.__data['bead_base_parameters'][row,col,4] for row,col in pos]
-        params['amplitude']=[self.__data['amplitude'][row,col,flow] for row,col in pos]
-        params['resError']=[self.__data['residual_error'][row,col,flow] for row,col in pos]
+        for name in beads.dtype.names[2:]:
+            params[name]=list(beads[name])
         #params['errByBlock']=[self.__data['average_error_by_block'][row,col,flow] for row,col in pos]
-        params['dcOffset']=[self.__data['trace_dc_offset'][row,col,flow] for row,col in pos]
         return params
 
     def _getRegParams( self, pos ):
@@ -130,6 +229,7 @@ class DebugParams(object):
             self.step = np.array( [np.diff(np.sort(np.unique(cols)))[0], np.diff(np.sort(np.unique(rows)))[0]] )
         else:
             self.step=100000
+        self.__region_grid = self.__make_region_grid()
 
     def getParamsForWells(self, pos):
         params = self.getBeadParams( pos )
@@ -139,6 +239,6 @@ class DebugParams(object):
 
     def getEmptyTrace( self, pos, flow ):
         reg = self.getRegionIdxByPos(pos)
-        return( self.__region_param.getNode('/region/empty_trace')[reg,:,flow] )
+        return( self.__outsideToNan( self.__getNode(self.__region_param,'/region/empty_trace')[reg,:,flow], reg ) )
 
 